@@ -2,23 +2,94 @@
 
 '''
 USAGE
-    2ac_client.py [OPTION] [FILE...]
+    2ac_client.py [OPTION] FLAG [FLAG...]
+    2ac_client.py --daemon [OPTION] [FILE...]
+    2ac_client.py --replay=FILE [--speed=FACTOR] [OPTION]
+    2ac_client.py --stats
+    2ac_client.py --session
+    2ac_client.py --dashboard=SECONDS [PORT...]
 
 DESCRIPTION
-    Send information to a running instance of '2ac_server.py'.
+    Send information to a running instance of '2ac_server.py'. FLAG is
+    one of STOP, MOUSE_IN, MOUSE_OUT, LEFT_NOSE_POKE or RIGHT_NOSE_POKE.
+    A single FLAG is sent with its own connection (legacy protocol), 
+    several FLAGs are streamed through a single connection without 
+    waiting for their echoes (see --stream).
 
 OPTIONS
+    --stream
+        Open a persistent connection and send every FLAG through it as
+        timestamped and numbered frames, even a single one.
+    
+    --daemon
+        Resident mode: keep a persistent connection open and send the
+        FLAG read on each line of the FILEs, or of the standard input 
+        (no FILE or -). The connection is opened again if the server 
+        closes it, e.g. when restarted, and the client stops with an 
+        error if the server cannot be reached.
+        Named pipes (FIFO) are reopened when their writer closes them,
+        so other programs can send flags with e.g.
+            echo MOUSE_IN > FIFO
+    
+    --latency
+        Report the round trip time of each flag sent, then their number,
+        the number of flags not echoed and the round trip time quantiles
+        on the standard error.
+    
+    --stats
+        Write the server's latency histograms of each stage of the event
+        pipeline (in milliseconds).
+    
+    --session
+        Write the statistics of the server's session: number of trials 
+        of each outcome, accuracy, rolling accuracy and reaction time 
+        quantiles (in seconds).
+    
+    --dashboard=SECONDS
+        Display the statistics of the sessions of the rigs listening to
+        the PORTs (default 13013) side by side, updated every SECONDS, 
+        until interrupted with Ctrl-C.
+    
+    --replay=FILE
+        Send the flags recorded by a server in FILE (see --tape in 
+        2ac_gpioserver.py) with their recorded timing, connections and
+        protocols, and report how the server keeps up: round trip times,
+        flags in flight and dropped flags.
+    
+    --speed=FACTOR
+        Replay speed factor, 0 to replay as fast as possible (default 1)
+    
     --help
         Display this message
 
 '''
 
-import getopt, sys, fileinput, socket
+import getopt, sys, fileinput, os, socket, stat, struct, time
 from os import path
+from collections import OrderedDict
+from threading import Lock, Thread
 
 HOST = '127.0.0.1'  # localhost
 PORT = 13013       # listen port
 
+# flags
+FLAGS = {
+         "STOP"            : b'0',
+         "MOUSE_IN"        : b'1',
+         "MOUSE_OUT"       : b'2',
+         "LEFT_NOSE_POKE"  : b'3',
+         "RIGHT_NOSE_POKE" : b'4' }
+NAMES = dict( (v, k) for k, v in FLAGS.items() )
+
+# persistent connections start with the STREAM byte, then send frames
+# made of a flag, a sequence number and a timestamp
+STREAM = b'S'
+FRAME = struct.Struct('!cId')
+
+# requests the server's statistics, and those of its session
+STATS = b'?'
+SESSION = b'='
+
 class Options(dict):
 
     def __init__(self, argv):
@@ -28,13 +99,32 @@ class Options(dict):
         
         # handle options with getopt
         try:
-            opts, args = getopt.getopt(argv[1:], "", ['help'])
-        except (getopt.GetoptError, e):
+            opts, args = getopt.getopt(argv[1:], "", ['stream', 'daemon', 'latency', 
+                                                     'replay=', 'speed=', 
+                                                     'stats', 'session', 
+                                                     'dashboard=', 'help'])
+        except getopt.GetoptError as e:
             sys.stderr.write(str(e) + '\n\n' + __doc__)
             sys.exit(1)
 
         for o, a in opts:
-            if o == '--help':
+            if o == '--stream':
+                self['stream'] = True
+            elif o == '--daemon':
+                self['daemon'] = True
+            elif o == '--latency':
+                self['latency'] = True
+            elif o == '--stats':
+                self['stats'] = True
+            elif o == '--session':
+                self['session'] = True
+            elif o == '--dashboard':
+                self['dashboard'] = float(a)
+            elif o == '--replay':
+                self['replay'] = a
+            elif o == '--speed':
+                self['speed'] = float(a)
+            elif o == '--help':
                 sys.stdout.write(__doc__)
                 sys.exit(0)
 
@@ -43,7 +133,360 @@ class Options(dict):
     def set_default(self):
     
         # default parameter value
-        pass
+        self['stream'] = False
+        self['daemon'] = False
+        self['latency'] = False
+        self['replay'] = None
+        self['stats'] = False
+        self['session'] = False
+        self['dashboard'] = None
+        self['speed'] = 1.
+
+class Client(object):
+    '''
+    Persistent connection to a running server. Flags are streamed as
+    frames holding the flag, a sequence number and a timestamp, without
+    waiting for the server's echo.
+    '''
+    
+    def __init__(self, host=HOST, port=PORT, callback=None):
+        '''
+        host        server's address
+        port        server's port
+        callback    called as callback(flag, seq, round_trip) for each
+                    frame echoed by the server (default None)
+        '''
+        
+        self.host, self.port = host, port
+        self.callback = callback
+        
+        # sequence number of the next frame
+        self.seq = 0
+        
+        # the socket and the thread reading the echoes
+        self.s = None
+        self.t = None
+    
+    def __enter__(self):
+        self.connect()
+        return self
+    
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+    
+    def connect(self):
+        self.s = socket.create_connection((self.host, self.port))
+        self.s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.s.sendall(STREAM)
+        self.t = Thread(target=self.receive, args=(), daemon=True)
+        self.t.start()
+    
+    def send(self, flag):
+        '''
+        Send a flag and returns its sequence number.
+        '''
+        
+        seq = self.seq
+        self.s.sendall(FRAME.pack(flag, seq, time.time()))
+        self.seq += 1
+        return seq
+    
+    def connected(self):
+        '''
+        Returns False once the server closed the connection.
+        '''
+        
+        return self.t is not None and self.t.is_alive()
+    
+    def deliver(self, flag):
+        '''
+        Send a flag, reconnecting first if the server closed the 
+        connection (e.g. stopped or restarted). Returns the flag's 
+        sequence number, raises OSError if the server cannot be reached.
+        '''
+        
+        if not self.connected():
+            self.close()
+            self.connect()
+            sys.stderr.write("[i] reconnected to the server\n")
+        try:
+            return self.send(flag)
+        except OSError:
+            
+            # the server closed the connection since the last echo
+            self.close()
+            self.connect()
+            sys.stderr.write("[i] reconnected to the server\n")
+            return self.send(flag)
+    
+    def receive(self):
+        '''
+        Read the frames echoed by the server until the connection is 
+        closed. Runs in the client's thread.
+        '''
+        
+        data = b''
+        while True:
+            try:
+                chunk = self.s.recv(4096)
+            except OSError:
+                break
+            if not chunk:
+                break
+            now = time.time()
+            data += chunk
+            size = len(data) - len(data) % FRAME.size
+            if self.callback is not None:
+                for flag, seq, timestamp in FRAME.iter_unpack(data[:size]):
+                    self.callback(flag, seq, now - timestamp)
+            data = data[size:]
+    
+    def close(self):
+        '''
+        Wait for the server to echo every frame and close the connection.
+        '''
+        
+        if self.s is None:
+            return
+        try:
+            self.s.shutdown(socket.SHUT_WR)
+        except OSError:
+            
+            # the connection is already dead
+            pass
+        self.t.join()
+        self.s.close()
+
+class RoundTrips(object):
+    '''
+    Callback of a Client collecting the round trip times of the echoed 
+    flags, and writing each of them if verbose.
+    '''
+    
+    def __init__(self, verbose=False):
+        self.verbose = verbose
+        self.round_trips = []
+    
+    def __call__(self, flag, seq, round_trip):
+        self.round_trips.append(round_trip)
+        if self.verbose:
+            report(flag, seq, round_trip)
+    
+    def report(self, sent):
+        '''
+        Writes the number of flags sent and echoed, and the round trip 
+        time quantiles, on the standard error.
+        '''
+        
+        sys.stderr.write("[i] {:d} flags sent, {:d} echoed, {:d} dropped"
+                         "\n".format(sent, len(self.round_trips), 
+                         sent - len(self.round_trips)))
+        write_round_trips(self.round_trips)
+
+class Replay(object):
+    '''
+    Sends the raw flags recorded by a server (see --tape in 
+    2ac_gpioserver.py) back to a running server, through as many 
+    connections as recorded and with their protocol, and measures how 
+    the server keeps up: the round trip time of each flag, that includes
+    the actions it triggers since the server echoes a flag once it is 
+    applied, the number of flags sent but not echoed yet (in flight) and
+    the flags dropped.
+    '''
+    
+    def __init__(self, fname, speed=1., host=HOST, port=PORT, callback=None):
+        '''
+        fname       tape file
+        speed       replay speed factor, 0 to send the flags as fast as
+                    possible (default 1.)
+        host        server's address
+        port        server's port
+        callback    called as callback(flag, seq, round_trip) for each
+                    flag echoed by the server (default None)
+        '''
+        
+        self.speed = speed
+        self.host, self.port = host, port
+        self.callback = callback
+        
+        # the recorded flags: (time, connection, protocol, flag)
+        with open(fname) as f:
+            f.readline()
+            self.flags = [ (float(t), int(connection), protocol, 
+                            bytes.fromhex(flag)) 
+                           for t, connection, protocol, flag in 
+                           (line.rstrip("\n").split(",") for line in f) ]
+        
+        # number of flags sent and echoed, round trip times, maximum 
+        # number of flags in flight and maximum lateness of the replay
+        self.sent = 0
+        self.echoed = 0
+        self.round_trips = []
+        self.in_flight = 0
+        self.lateness = 0.
+        self.lock = Lock()
+    
+    def echo(self, flag, seq, round_trip):
+        with self.lock:
+            self.echoed += 1
+            self.round_trips.append(round_trip)
+        if self.callback is not None:
+            self.callback(flag, seq, round_trip)
+    
+    def run(self):
+        '''
+        Replays the flags, then waits for the echoes.
+        '''
+        
+        # the persistent connections, None once failed
+        clients = {}
+        start = time.perf_counter()
+        first = self.flags[0][0] if self.flags else 0.
+        for t, connection, protocol, flag in self.flags:
+            
+            # wait for the flag's time
+            if self.speed:
+                deadline = start + (t - first) / self.speed
+                remaining = deadline - time.perf_counter()
+                if remaining > 0:
+                    time.sleep(remaining)
+                self.lateness = max(self.lateness, 
+                                    time.perf_counter() - deadline)
+            
+            with self.lock:
+                self.in_flight = max(self.in_flight, self.sent - self.echoed)
+                self.sent += 1
+            
+            # the next flags of a failed connection are dropped
+            if protocol == "stream" and connection in clients and \
+               clients[connection] is None:
+                continue
+            try:
+                if protocol == "stream":
+                    if connection not in clients:
+                        client = Client(self.host, self.port, self.echo)
+                        client.connect()
+                        clients[connection] = client
+                    clients[connection].send(flag)
+                else:
+                    self.send(flag)
+            except OSError as e:
+                sys.stderr.write("Error: flag #{:d} not sent: {}\n".format(
+                                 self.sent - 1, e))
+                if protocol == "stream":
+                    if clients.get(connection) is not None:
+                        clients[connection].close()
+                    clients[connection] = None
+        for client in clients.values():
+            if client is not None:
+                client.close()
+    
+    def send(self, flag):
+        '''
+        Sends a flag with the legacy protocol, one connection per flag.
+        '''
+        
+        t0 = time.time()
+        with socket.create_connection((self.host, self.port)) as s:
+            s.sendall(flag)
+            data = s.recv(1024)
+        if data == flag:
+            self.echo(flag, self.sent - 1, time.time() - t0)
+    
+    def report(self):
+        '''
+        Writes the replay statistics on the standard error.
+        '''
+        
+        sys.stderr.write("[i] {:d} flags sent, {:d} echoed, {:d} dropped, "
+                         "at most {:d} in flight\n".format(self.sent, 
+                         self.echoed, self.sent - self.echoed, 
+                         self.in_flight))
+        write_round_trips(self.round_trips)
+        if self.speed:
+            sys.stderr.write("[i] replay lateness: max {:.3f}ms\n".format(
+                             1000 * self.lateness))
+
+def request(query, host=HOST, port=PORT):
+    '''
+    Send a query to the server and return its whole answer.
+    '''
+    
+    with socket.create_connection((host, port)) as s:
+        s.sendall(query)
+        data = b''
+        while True:
+            chunk = s.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+    return data.decode()
+
+def dashboard(ports, interval):
+    '''
+    Poll the session's statistics of the servers listening to ports and
+    display them side by side on the terminal, every interval seconds.
+    '''
+    
+    while True:
+        columns = OrderedDict()
+        for port in ports:
+            
+            # servers without session statistics answer nothing
+            try:
+                columns[port] = dict( line.split("\t") for line in 
+                                      request(SESSION, port=port).splitlines() )
+            except (OSError, ValueError):
+                columns[port] = None
+            if not columns[port]:
+                columns[port] = None
+        names = []
+        for column in columns.values():
+            for name in column or ():
+                if name not in names:
+                    names.append(name)
+        
+        # clear the terminal and write the table
+        lines = ["\x1b[H\x1b[J{:<18}".format(time.strftime("%H:%M:%S")) + 
+                 "".join( "{:>10d}".format(port) for port in ports )]
+        for name in names:
+            lines.append("{:<18}".format(name) + "".join( 
+                "{:>10}".format("" if column is None else 
+                                column.get(name, "")) 
+                for column in columns.values() ))
+        lines.append("{:<18}".format("") + "".join( 
+            "{:>10}".format("online" if column is not None else "offline") 
+            for column in columns.values() ))
+        sys.stdout.write("\n".join(lines) + "\n")
+        sys.stdout.flush()
+        time.sleep(interval)
+
+def write_round_trips(round_trips):
+    '''
+    Write the median, 95th percentile and maximum of the round trip times
+    on the standard error.
+    '''
+    
+    if round_trips:
+        round_trips = sorted(round_trips)
+        n = len(round_trips)
+        sys.stderr.write("[i] round trip: median {:.3f}ms, 95% "
+                         "{:.3f}ms, max {:.3f}ms\n".format(
+                         1000 * round_trips[n // 2], 
+                         1000 * round_trips[min(n - 1, n * 95 // 100)],
+                         1000 * round_trips[-1]))
+
+def report(flag, seq, round_trip):
+    '''
+    Write the round trip time of an echoed frame on the standard output.
+    '''
+    
+    sys.stdout.write("#{:d}\t{}\t{:.3f}ms\n".format(
+                     seq, NAMES.get(flag, flag), round_trip * 1000))
+    sys.stdout.flush()
+
+def isfifo(fname):
+    return stat.S_ISFIFO(os.stat(fname).st_mode)
     
 def main(argv=sys.argv):
     
@@ -53,23 +496,109 @@ def main(argv=sys.argv):
     options = Options(argv)
     sys.argv[1:] = options.args
     
-    # flags
-    flags = {
-             "STOP"            : b'0',
-             "MOUSE_IN"        : b'1',
-             "MOUSE_OUT"       : b'2',
-             "LEFT_NOSE_POKE"  : b'3',
-             "RIGHT_NOSE_POKE" : b'4' }
+    callback = report if options['latency'] else None
+    round_trips = RoundTrips(options['latency'])
+    
+    # ask for the server's statistics
+    if options['stats']:
+        data = request(STATS)
+        if not data:
+            sys.stderr.write("Error: the server has no statistics\n")
+            return 1
+        sys.stdout.write(data)
+        return 0
+    
+    # ask for the statistics of the server's session
+    if options['session']:
+        data = request(SESSION)
+        if not data:
+            sys.stderr.write("Error: the server has no session statistics\n")
+            return 1
+        sys.stdout.write(data)
+        return 0
+    
+    # poll the statistics of the sessions until interrupted
+    if options['dashboard'] is not None:
+        try:
+            dashboard([ int(port) for port in options.args ] or [PORT], 
+                      options['dashboard'])
+        except KeyboardInterrupt:
+            pass
+        return 0
+    
+    # send back the flags recorded by a server
+    if options['replay'] is not None:
+        replay = Replay(options['replay'], options['speed'], 
+                        callback=callback)
+        replay.run()
+        replay.report()
+        return 0
+    
+    # resident mode: keep the connection open and send the flags as soon
+    # as they are read
+    if options['daemon']:
+        client = Client(callback=round_trips)
+        try:
+            client.connect()
+            while True:
+                for line in fileinput.input():
+                    name = line.strip()
+                    if not name:
+                        continue
+                    if name not in FLAGS:
+                        sys.stderr.write("Error: unknown flag: {}\n".format(
+                                         name))
+                        continue
+                    client.deliver(FLAGS[name])
+                    if name == "STOP":
+                        break
+                else:
+                
+                    # wait for the next writer of the named pipes
+                    if options.args and all( fname != "-" and isfifo(fname)
+                                             for fname in options.args ):
+                        continue
+                break
+        except OSError as e:
+            sys.stderr.write("Error: cannot reach the server: {}\n".format(e))
+            return 1
+        finally:
+            client.close()
+        if options['latency']:
+            round_trips.report(client.seq)
+        return 0
+    
+    for name in options.args:
+        if name not in FLAGS:
+            sys.stderr.write("Error: unknown flag: {}\n\n".format(name) + 
+                             __doc__)
+            return 1
+    if not options.args:
+        sys.stderr.write("Error: no flag to send\n\n" + __doc__)
+        return 1
+    
+    # stream all the flags through a single connection
+    if options['stream'] or len(options.args) > 1:
+        with Client(callback=round_trips) as client:
+            for name in options.args:
+                client.send(FLAGS[name])
+        if options['latency']:
+            round_trips.report(client.seq)
+        return 0
     
     # open the connection
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        t0 = time.time()
         s.connect((HOST, PORT))
-        s.sendall(flags[options.args[0]])
+        s.sendall(FLAGS[options.args[0]])
         data = s.recv(1024)
+        if data == FLAGS[options.args[0]]:
+            round_trips(data, 0, time.time() - t0)
+    if options['latency']:
+        round_trips.report(1)
             
     # return 0 if everything succeeded
     return 0
 
 # does not execute main if the script is imported as a module
 if __name__ == '__main__': sys.exit(main())
-
@@ -1,9 +1,5 @@
 #!/usr/bin/env python3
 
-### TO DO
-# - display time stamp at each tracking input
-# - reformat the output for data analysis
-
 '''
 USAGE
     2ac_server.py [OPTION] [FILE...]
@@ -14,6 +10,106 @@ DESCRIPTION
     control the different components of the device.
 
 OPTIONS
+    --address=ADDRESS
+        IPv4 address the monitoring servers listen to (default 
+        129.194.59.156)
+    
+    --rig=PORT:LEFT_PIN:RIGHT_PIN[:CHANNEL]
+        Run a maze whose monitoring server listens to PORT, with the 
+        left and right LEDs on the GPIO pins LEFT_PIN and RIGHT_PIN and
+        the sounds played on the pygame's mixer channel CHANNEL (default
+        the lowest channel not used by another maze). Repeat the option
+        to run several mazes from the same process (default 
+        13013:20:21). The channels keep the mazes from cutting off each
+        other's sounds, but they are all mixed into the same audio 
+        output: mazes needing speakers of their own must run in 
+        separate processes, with separate audio devices
+    
+    --dispenser=PORT:LEFT_PIN:RIGHT_PIN[:LEFT_SENSOR:RIGHT_SENSOR]
+        Drive the reward dispensers of the maze of PORT with the GPIO 
+        output pins LEFT_PIN and RIGHT_PIN, and confirm the deliveries 
+        with the input pins LEFT_SENSOR and RIGHT_SENSOR. Without this 
+        option, no reward is delivered
+    
+    --pulses=COUNT[:ON_TIME[:OFF_TIME]]
+        Drive the dispensers with trains of COUNT pulses of ON_TIME 
+        seconds, OFF_TIME seconds apart (default 1:0.05:0.05)
+    
+    --pokes=PORT:LEFT_PIN:RIGHT_PIN
+        Detect the nose pokes in the maze of PORT with beam breaks on the
+        GPIO input pins LEFT_PIN and RIGHT_PIN, in addition to those sent
+        by 2ac_client.py
+    
+    --dedup=SECONDS
+        A nose poke received both from the detectors and from 
+        2ac_client.py within SECONDS is applied once (default 0.5)
+    
+    --pwm
+        Drive the LEDs with PWM, so that the protocol can dim them or 
+        fade them in and out (see the waveform action)
+    
+    --cache=DIR
+        Save the synthesized sounds in DIR and load them from there at
+        the next start
+    
+    --log=PREFIX
+        Record the tracking inputs, the protocol events and the devices'
+        activity with their time stamps in PREFIX.csv during the session,
+        and export them to PREFIX.npz (NumPy) at the end
+    
+    --tape=PREFIX
+        Record the raw flags received by each rig's monitoring server 
+        with their time of arrival in PREFIX.PORT.csv, to be replayed 
+        with 2ac_client.py --replay
+    
+    --stats=SECONDS
+        Write the latency histograms of the event pipeline's stages on
+        the standard error every SECONDS, each rig's lines prefixed with 
+        its port. They are also served to 2ac_client.py --stats at any 
+        time by the port of each rig
+    
+    --threads
+        Play each LED, dispenser and speaker from its own thread instead 
+        of the single thread of the rig's scheduler
+    
+    --protocol=FILE
+        Run the protocol described in the JSON file FILE instead of the
+        default two-alternative choice protocol, see the Protocol class
+        for the description of the states, events and actions
+    
+    --schedule=NAME[:BLOCK]
+        Allocate the reward positions with the schedule NAME: random 
+        (default), block (each block of BLOCK trials, default 10, is 
+        balanced), gellermann (Gellermann-style series of 10 trials) or
+        adaptive (the side the mouse errs on the most in its last BLOCK
+        trials of each side, default 20, is rewarded the most often, to
+        correct its bias)
+    
+    --max-repeat=N
+        Never allocate the reward to the same side more than N times in
+        a row (default 3)
+    
+    --trials=FILE
+        Allocate the reward positions listed in FILE, one per line, 
+        before those of the schedule
+    
+    --save-trials=PREFIX[:LENGTH]
+        Write the first LENGTH reward positions (default 1000) of the 
+        session of each rig in PREFIX.PORT.txt, to be played again with 
+        --trials. The adaptive schedule only writes the list given with 
+        --trials, the positions that follow depending on the mouse
+    
+    --simulate=VISITS
+        Run the protocol offline on a virtual clock, with simulated 
+        devices and a synthetic mouse visiting the maze VISITS times 
+        instead of the tracking inputs. Needs neither GPIO nor audio 
+        hardware, and writes the same trial log as the rigs
+    
+    --seed=SEED
+        Seed of the trials' schedule and, in simulations, of the 
+        synthetic mouse. Each rig uses SEED + PORT, so that the mazes 
+        run from the same process get different schedules
+    
     --help
         Display this message
 
@@ -21,11 +117,13 @@ NOTE
     Compatible with Python 3
 '''
 
-import getopt, sys, fileinput, socket, random, subprocess, time, gpiozero, pygame
+import asyncio, getopt, sys, fileinput, socket, struct, random, subprocess, time, gpiozero, pygame
+import bisect, hashlib, heapq, itertools, json, math
 import numpy as np
-from os import path
+from collections import OrderedDict
+from os import environ, makedirs, path
 from queue import Queue
-from threading import Event, Thread
+from threading import Condition, Event, Lock, Thread
 
 ### MOCK PINS (TEST)
 #from gpiozero.pins.mock import MockFactory
@@ -41,22 +139,289 @@ class Options(dict):
         
         # handle options with getopt
         try:
-            opts, args = getopt.getopt(argv[1:], "", ['help'])
-        except (getopt.GetoptError, e):
+            opts, args = getopt.getopt(argv[1:], "", ['address=', 'rig=', 
+                                                      'cache=', 'log=', 
+                                                      'protocol=', 
+                                                      'simulate=', 'seed=',
+                                                      'tape=', 'pwm', 
+                                                      'dispenser=', 'pulses=',
+                                                      'pokes=', 'dedup=', 
+                                                      'stats=', 'threads', 
+                                                      'schedule=', 
+                                                      'max-repeat=', 
+                                                      'trials=', 
+                                                      'save-trials=', 
+                                                      'help'])
+        except getopt.GetoptError as e:
             sys.stderr.write(str(e) + '\n\n' + __doc__)
             sys.exit(1)
 
         for o, a in opts:
-            if o == '--help':
+            if o == '--address':
+                self['address'] = a
+            elif o == '--rig':
+                try:
+                    rig = tuple( int(x) for x in a.split(':') )
+                    if len(rig) not in (3, 4): raise ValueError
+                except ValueError:
+                    sys.stderr.write("Error: invalid rig definition: {}"
+                                     "\n\n".format(a) + __doc__)
+                    sys.exit(1)
+                self['rigs'].append(rig)
+            elif o == '--cache':
+                self['cache'] = a
+            elif o == '--log':
+                self['log'] = a
+            elif o == '--protocol':
+                self['protocol'] = a
+            elif o == '--simulate':
+                try:
+                    self['simulate'] = int(a)
+                    if self['simulate'] < 0: raise ValueError
+                except ValueError:
+                    sys.stderr.write("Error: invalid simulate definition: "
+                                     "{}\n\n".format(a) + __doc__)
+                    sys.exit(1)
+            elif o == '--seed':
+                try:
+                    self['seed'] = int(a)
+                    if self['seed'] < 0: raise ValueError
+                except ValueError:
+                    sys.stderr.write("Error: invalid seed definition: "
+                                     "{}\n\n".format(a) + __doc__)
+                    sys.exit(1)
+            elif o == '--tape':
+                self['tape'] = a
+            elif o == '--pwm':
+                self['pwm'] = True
+            elif o == '--dispenser':
+                try:
+                    dispenser = tuple( int(x) for x in a.split(':') )
+                    if len(dispenser) not in (3, 5): raise ValueError
+                except ValueError:
+                    sys.stderr.write("Error: invalid dispenser definition: "
+                                     "{}\n\n".format(a) + __doc__)
+                    sys.exit(1)
+                self['dispensers'][dispenser[0]] = dispenser[1:]
+            elif o == '--pokes':
+                try:
+                    pokes = tuple( int(x) for x in a.split(':') )
+                    if len(pokes) != 3: raise ValueError
+                except ValueError:
+                    sys.stderr.write("Error: invalid pokes definition: "
+                                     "{}\n\n".format(a) + __doc__)
+                    sys.exit(1)
+                self['pokes'][pokes[0]] = pokes[1:]
+            elif o == '--dedup':
+                try:
+                    self['dedup'] = float(a)
+                    if self['dedup'] < 0: raise ValueError
+                except ValueError:
+                    sys.stderr.write("Error: invalid dedup definition: "
+                                     "{}\n\n".format(a) + __doc__)
+                    sys.exit(1)
+            elif o == '--stats':
+                try:
+                    self['stats'] = float(a)
+                    if self['stats'] <= 0: raise ValueError
+                except ValueError:
+                    sys.stderr.write("Error: invalid stats definition: "
+                                     "{}\n\n".format(a) + __doc__)
+                    sys.exit(1)
+            elif o == '--threads':
+                self['threads'] = True
+            elif o == '--schedule':
+                try:
+                    schedule = a.split(':')
+                    if schedule[0] not in Trials.schedules + \
+                       AdaptiveTrials.schedules or len(schedule) > 2: 
+                        raise ValueError
+                    self['schedule'] = schedule[0]
+                    if len(schedule) == 2:
+                        self['block'] = int(schedule[1])
+                except ValueError:
+                    sys.stderr.write("Error: invalid schedule definition: "
+                                     "{}\n\n".format(a) + __doc__)
+                    sys.exit(1)
+            elif o == '--max-repeat':
+                try:
+                    self['max_repeat'] = int(a)
+                    if self['max_repeat'] < 1: raise ValueError
+                except ValueError:
+                    sys.stderr.write("Error: invalid max-repeat definition: "
+                                     "{}\n\n".format(a) + __doc__)
+                    sys.exit(1)
+            elif o == '--trials':
+                self['trials'] = a
+            elif o == '--save-trials':
+                try:
+                    save = a.split(':')
+                    if len(save) > 2: raise ValueError
+                    self['save_trials'] = save[0]
+                    if len(save) == 2:
+                        self['save_length'] = int(save[1])
+                except ValueError:
+                    sys.stderr.write("Error: invalid save-trials definition:"
+                                     " {}\n\n".format(a) + __doc__)
+                    sys.exit(1)
+            elif o == '--pulses':
+                try:
+                    pulses = a.split(':')
+                    if not 1 <= len(pulses) <= 3: raise ValueError
+                    self['pulses'] = (int(pulses[0]),) + tuple( 
+                        float(x) for x in pulses[1:] ) + \
+                        self['pulses'][len(pulses):]
+                except ValueError:
+                    sys.stderr.write("Error: invalid pulses definition: "
+                                     "{}\n\n".format(a) + __doc__)
+                    sys.exit(1)
+            elif o == '--help':
                 sys.stdout.write(__doc__)
                 sys.exit(0)
+        
+        # one rig with the default ports
+        if not self['rigs']:
+            self['rigs'].append((13013, 20, 21))
+        
+        # each rig plays its sounds on a mixer channel of its own
+        used = set( rig[3] for rig in self['rigs'] if len(rig) > 3 )
+        free = ( c for c in itertools.count() if c not in used )
+        self['rigs'] = [ rig if len(rig) > 3 else rig + (next(free),) 
+                         for rig in self['rigs'] ]
 
         self.args = args
     
     def set_default(self):
     
         # default parameter value
-        pass
+        self['address'] = "129.194.59.156"
+        self['rigs'] = []
+        self['cache'] = None
+        self['log'] = None
+        self['protocol'] = None
+        self['simulate'] = None
+        self['seed'] = None
+        self['tape'] = None
+        self['pwm'] = False
+        self['dispensers'] = {}
+        self['pulses'] = (1, 0.05, 0.05)
+        self['pokes'] = {}
+        self['dedup'] = 0.5
+        self['stats'] = None
+        self['threads'] = False
+        self['schedule'] = "random"
+        self['block'] = None
+        self['max_repeat'] = 3
+        self['trials'] = None
+        self['save_trials'] = None
+        self['save_length'] = 1000
+
+class Clock(object):
+    '''
+    Waits for absolute deadlines on the monotonic clock (time.perf_counter): 
+    sleeps until shortly before the deadline, then spins on the clock for 
+    sub-millisecond accuracy.
+    '''
+    
+    def __init__(self, spin=0.002):
+        '''
+        spin        duration of the final busy wait, in seconds (default 
+                    0.002)
+        '''
+        
+        self.spin = spin
+    
+    def now(self):
+        return time.perf_counter()
+    
+    def wait_until(self, deadline, interrupt=None):
+        '''
+        Returns when the deadline is reached, or earlier if the interrupt
+        Event is set. Returns True if interrupted.
+        '''
+        
+        remaining = deadline - time.perf_counter()
+        if remaining > self.spin:
+            if interrupt is not None:
+                if interrupt.wait(remaining - self.spin):
+                    return True
+            else:
+                time.sleep(remaining - self.spin)
+        if interrupt is not None and interrupt.is_set():
+            return True
+        while time.perf_counter() < deadline:
+            pass
+        return False
+
+# timing engine shared by the controllers and the protocol
+CLOCK = Clock()
+
+class Gate(object):
+    '''
+    Holds the schedules parked until a condition is met (see 
+    Controller.play), for every controller, in a single thread started 
+    with the first one. The conditions are plain Events, that cannot wake
+    up a waiter of their own: they are checked every 'interval' seconds
+    while schedules are parked, the thread sleeping otherwise.
+    '''
+    
+    def __init__(self, interval=0.001):
+        '''
+        interval    time between two checks of the conditions, in seconds
+                    (default 0.001)
+        '''
+        
+        self.interval = interval
+        
+        # parked actions as (owner, condition, expiry, action, arguments),
+        # and the condition notified when one is added
+        self.parked = []
+        self.changed = Condition()
+        
+        # the thread running the actions
+        self.t = None
+    
+    def park(self, owner, condition, timeout, action, *args):
+        '''
+        Runs action(*args) from the gate's thread as soon as the condition
+        (an Event) is set, or when timeout seconds have passed (None: 
+        never), unless the owner's actions are discarded meanwhile.
+        '''
+        
+        expiry = None if timeout is None else CLOCK.now() + timeout
+        with self.changed:
+            if self.t is None:
+                self.t = Thread(target=self.waiter, args=(), daemon=True)
+                self.t.start()
+            self.parked.append((owner, condition, expiry, action, args))
+            self.changed.notify()
+    
+    def discard(self, owner):
+        with self.changed:
+            self.parked = [ p for p in self.parked if p[0] is not owner ]
+    
+    def waiter(self):
+        while True:
+            with self.changed:
+                while not self.parked:
+                    self.changed.wait()
+                now = CLOCK.now()
+                ready, pending = [], []
+                for p in self.parked:
+                    owner, condition, expiry, action, args = p
+                    if condition.is_set() or \
+                       expiry is not None and expiry <= now:
+                        ready.append(p)
+                    else:
+                        pending.append(p)
+                self.parked = pending
+                if not ready:
+                    self.changed.wait(self.interval)
+            for owner, condition, expiry, action, args in ready:
+                action(*args)
+
+# waiter of the condition-gated schedules of every controller
+GATE = Gate()
 
 class Device(object):
     '''
@@ -93,6 +458,202 @@ class Device(object):
         while self.running():
             pass
         
+class Histogram(object):
+    '''
+    Counts durations (in seconds) in logarithmic bins, 10% wide from 1µs
+    to about 100s, so that recording a duration is cheap and its 
+    quantiles are known within the bin width.
+    '''
+    
+    # upper bounds of the bins, the last bin counting the longer durations
+    bounds = [ 1e-6 * 1.1 ** i for i in range(194) ]
+    
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        
+        # number, sum and maximum of the durations
+        self.n = 0
+        self.total = 0.
+        self.max = 0.
+    
+    def record(self, duration):
+        self.counts[bisect.bisect_left(self.bounds, duration)] += 1
+        self.n += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+    
+    def quantile(self, q):
+        '''
+        Returns the upper bound of the bin holding the q quantile, or the
+        maximum if lower.
+        '''
+        
+        rank, count = q * self.n, 0
+        for i, n in enumerate(self.counts):
+            count += n
+            if n and count >= rank:
+                break
+        return self.max if i == len(self.bounds) else \
+               min(self.bounds[i], self.max)
+
+class Stats(Device):
+    '''
+    Latency histograms of the stages of the event pipeline:
+        transit     from the client's send to the server's reception
+        apply       from the reception to the monitor's state change,
+                    triggered actions included
+        reaction    from the monitor's state change to the protocol's 
+                    state transition
+        timeout     from a state timeout's deadline to the transition
+        queue       from a controller's play() to its thread picking the
+                    schedule, or to the scheduler committing it
+        on          from the intended onset to the on() call
+        skew        between the first and the last controller of a 
+                    compound stimulus
+    The histograms can be written periodically from the device's thread.
+    '''
+    
+    stages = ("transit", "apply", "reaction", "timeout", "queue", "on", 
+              "skew")
+    
+    def __init__(self, interval=None, prefix=""):
+        '''
+        interval    time between two reports written on the standard 
+                    error, in seconds (default None, no report)
+        prefix      prefix of the lines of these reports, e.g. the rig's 
+                    port (default "")
+        '''
+        
+        self.interval = interval
+        self.prefix = prefix
+        self.histograms = dict( (stage, Histogram()) 
+                                for stage in self.stages )
+        self.lock = Lock()
+        
+        # the thread writing the reports
+        self.t = Thread(target=self.dumper, args=(), daemon=True)
+        
+        # a stop value
+        self.stop = Event()
+    
+    def start(self):
+        if self.interval is not None:
+            self.t.start()
+    
+    def end(self):
+        self.stop.set()
+        if self.t.is_alive():
+            self.t.join()
+    
+    def record(self, stage, duration):
+        with self.lock:
+            self.histograms[stage].record(duration)
+    
+    def report(self):
+        '''
+        Returns the number of durations of each stage with their mean, 
+        median, 95th and 99th percentiles and maximum, in milliseconds.
+        '''
+        
+        lines = ["stage\tn\tmean\tp50\tp95\tp99\tmax\n"]
+        with self.lock:
+            for stage in self.stages:
+                h = self.histograms[stage]
+                if not h.n:
+                    continue
+                lines.append("{}\t{:d}\t{}\n".format(stage, h.n, "\t".join(
+                    "{:.3f}".format(1000 * x) for x in (h.total / h.n, 
+                    h.quantile(0.5), h.quantile(0.95), h.quantile(0.99), 
+                    h.max))))
+        return "".join(lines)
+    
+    def dumper(self):
+        while not self.stop.wait(self.interval):
+            sys.stderr.write("".join( self.prefix + line for line in 
+                                      self.report().splitlines(True) ))
+
+class SessionStats(object):
+    '''
+    Statistics of a rig's session, updated at each trial's outcome in 
+    constant time: the number of trials of each outcome, the accuracy of
+    the session and of its last 'window' choices (ring buffer with a 
+    running sum), and the reaction times in a Histogram, that gives their
+    quantiles at any time. The report is computed on request only, and 
+    kept until the next outcome.
+    '''
+    
+    # outcomes of the trials where the mouse chose, and listed first
+    choices = ("correct", "incorrect")
+    outcomes = ("correct", "incorrect", "time out")
+    
+    def __init__(self, window=20):
+        '''
+        window      number of choices in the rolling accuracy (default 20)
+        '''
+        
+        self.window = window
+        self.lock = Lock()
+        
+        # number of trials of each outcome
+        self.counts = OrderedDict( (outcome, 0) for outcome in self.outcomes )
+        self.trials = 0
+        
+        # ring buffer of the last choices (1 if correct), its next slot, 
+        # its number of choices and their sum
+        self.hits = [0] * window
+        self.head = 0
+        self.count = 0
+        self.hits_sum = 0
+        
+        # reaction times of the choices
+        self.reaction = Histogram()
+        
+        # the last report, None once outdated
+        self.cache = None
+    
+    def record(self, outcome, t):
+        with self.lock:
+            self.trials += 1
+            self.counts[outcome] = self.counts.get(outcome, 0) + 1
+            if outcome in self.choices:
+                hit = int(outcome == "correct")
+                self.hits_sum += hit - self.hits[self.head]
+                self.hits[self.head] = hit
+                self.head = (self.head + 1) % self.window
+                self.count = min(self.count + 1, self.window)
+                self.reaction.record(t)
+            self.cache = None
+    
+    def report(self):
+        '''
+        Returns the statistics, one "name<TAB>value" line each, the times
+        in seconds.
+        '''
+        
+        with self.lock:
+            if self.cache is not None:
+                return self.cache
+            choices = sum( self.counts[outcome] for outcome in self.choices )
+            h = self.reaction
+            lines = [("trials", "{:d}".format(self.trials))]
+            lines += [ (outcome, "{:d}".format(n)) 
+                       for outcome, n in self.counts.items() ]
+            lines += [("accuracy", "{:.3f}".format(
+                          self.counts["correct"] / choices if choices 
+                          else float('nan'))),
+                      ("rolling accuracy", "{:.3f}".format(
+                          self.hits_sum / self.count if self.count 
+                          else float('nan')))]
+            if h.n:
+                lines += [("reaction mean", "{:.3f}".format(h.total / h.n)),
+                          ("reaction p50", "{:.3f}".format(h.quantile(0.5))),
+                          ("reaction p90", "{:.3f}".format(h.quantile(0.9))),
+                          ("reaction max", "{:.3f}".format(h.max))]
+            self.cache = "".join( "{}\t{}\n".format(name, value) 
+                                  for name, value in lines )
+            return self.cache
+
 class Monitor(Device):
     '''
     Receives information from Ethovision via 2ac_client.py. 'Event' type
@@ -106,6 +667,23 @@ class Monitor(Device):
     LEFT_NOSE_POKE  = b'3'
     RIGHT_NOSE_POKE = b'4'
     
+    # Persistent connections start with the STREAM byte, then send frames
+    # made of a flag, a sequence number and a timestamp
+    STREAM          = b'S'
+    FRAME           = struct.Struct('!cId')
+    
+    # Legacy connections sending the STATS byte receive the statistics, 
+    # those sending the SESSION byte the session's statistics
+    STATS           = b'?'
+    SESSION         = b'='
+    
+    # Names of the flags, in the event log
+    NAMES           = { STOP            : "STOP",
+                        MOUSE_IN        : "MOUSE_IN",
+                        MOUSE_OUT       : "MOUSE_OUT",
+                        LEFT_NOSE_POKE  : "LEFT_NOSE_POKE",
+                        RIGHT_NOSE_POKE : "RIGHT_NOSE_POKE" }
+    
     def __init__(self, address="127.0.0.1", port=13013):
         '''
         Open a connection in a child thread, that will continuously
@@ -128,9 +706,55 @@ class Monitor(Device):
         # nose poke recorded on the right
         self.right_nose_poke = Event()
         
+        # side of the first nose poke since the last clear_nose_poke(), 
+        # that scores the trial whatever the pokes that follow
+        self.first_poke = None
+        
         # stop signal
         self.stop = Event()
         
+        # notified at each state transition (entry, exit, nose poke, stop)
+        self.transition = Condition()
+        
+        # time of the last state transition (time.perf_counter)
+        self.updated = 0.
+        
+        # the server's event loop, and its event set when stop is received
+        self.loop = None
+        self.stopping = None
+        
+        # number of frames received and their transit time from the 
+        # client's timestamp to their reception (in seconds)
+        self.events = 0
+        self.latency_sum = 0.
+        self.latency_max = 0.
+        
+        # records each state transition if set, see EventLog
+        self.log = None
+        
+        # file the raw flags are written to as they arrive, if set, and
+        # the number of connections served (see write_tape())
+        self.tape = None
+        self.connections = 0
+        
+        # actions waiting for a state, see when(), and the clock timing 
+        # their expiry
+        self.triggers = []
+        self.clock = CLOCK
+        
+        # the nose pokes received from another source within dedup 
+        # seconds of the same poke are dropped, if set: time and source 
+        # of the last poke of each side, and number of pokes dropped
+        self.dedup = None
+        self.pokes = {}
+        self.duplicates = 0
+        
+        # latency histograms of the pipeline's stages if set, see Stats
+        self.stats = None
+        
+        # statistics of the session's trials if set, see SessionStats
+        self.session = None
+        
         # setup the server thread
         self.t = Thread(target=self.open_connection, args=())
         
@@ -145,107 +769,538 @@ class Monitor(Device):
             return "none"
     
     def clear_nose_poke(self):
-        self.left_nose_poke.clear()
-        self.right_nose_poke.clear()
+        with self.transition:
+            self.left_nose_poke.clear()
+            self.right_nose_poke.clear()
+            self.first_poke = None
 
-    def wait_for_entrance(self, timeout=None):
-        t0 = time.time()
-        while not self.in_trial_zone.is_set():
-            t = time.time()-t0
-            if timeout is not None and t >= timeout: 
-                return False
-            if self.stop.is_set():
+    def update(self, flag, source=None):
+        '''
+        Apply a flag sent by the client app, or by another source (e.g. a
+        GPIO input), to the monitor state and wake up every thread waiting
+        for a state transition. Returns False if the flag is unknown.
+        '''
+        
+        with self.transition:
+            if self.duplicate(flag, source):
+                return True
+            if flag == self.STOP:
+                if self.stop.is_set():
+                    return True
+                self.stop.set()
+                if self.loop is not None:
+                    self.loop.call_soon_threadsafe(self.stopping.set)
+            elif flag == self.MOUSE_IN:
+                self.in_trial_zone.set()
+            elif flag == self.MOUSE_OUT:
+                self.in_trial_zone.clear()
+            elif flag == self.LEFT_NOSE_POKE:
+                self.left_nose_poke.set()
+                if self.first_poke is None:
+                    self.first_poke = "left"
+            elif flag == self.RIGHT_NOSE_POKE:
+                self.right_nose_poke.set()
+                if self.first_poke is None:
+                    self.first_poke = "right"
+            else:
                 return False
+            self.updated = time.perf_counter()
+            
+            # run the triggered actions before waking up the waiting threads
+            if self.triggers:
+                for action in self.fire():
+                    action()
+            self.transition.notify_all()
+        if self.log is not None:
+            self.log.record("monitor", self.NAMES[flag])
         return True
+    
+    def duplicate(self, flag, source):
+        '''
+        Returns True if a nose poke was already received from another 
+        source within dedup seconds. Called with the transition lock held.
+        '''
+        
+        if self.dedup is None or source is None or \
+           flag not in (self.LEFT_NOSE_POKE, self.RIGHT_NOSE_POKE):
+            return False
+        now = time.perf_counter()
+        last = self.pokes.get(flag)
+        if last is not None and last[1] != source and \
+           now - last[0] < self.dedup:
+            self.duplicates += 1
+            if self.log is not None:
+                self.log.record("monitor", "duplicate " + self.NAMES[flag])
+            return True
+        self.pokes[flag] = (now, source)
+        return False
+    
+    def when(self, predicate, action, timeout=None):
+        '''
+        Calls action() from the thread applying the flags as soon as 
+        predicate() returns True after a state transition, or right away
+        if it already does. The action runs before the waiting threads 
+        are woken up, with the transition lock held, and must return 
+        quickly. The trigger is dropped if it does not fire within timeout
+        seconds. Returns the trigger, that can be passed to discard().
+        '''
+        
+        expiry = None if timeout is None else self.clock.now() + timeout
+        trigger = (predicate, action, expiry)
+        with self.transition:
+            if predicate():
+                action()
+            else:
+                self.triggers.append(trigger)
+        return trigger
+    
+    def discard(self, trigger):
+        with self.transition:
+            if trigger in self.triggers:
+                self.triggers.remove(trigger)
+    
+    def fire(self):
+        '''
+        Removes the expired triggers and those whose predicate returns 
+        True, and returns the actions of the latter. Called with the 
+        transition lock held.
+        '''
+        
+        now = self.clock.now()
+        actions, pending = [], []
+        for predicate, action, expiry in self.triggers:
+            if expiry is not None and expiry <= now:
+                continue
+            if predicate():
+                actions.append(action)
+            else:
+                pending.append((predicate, action, expiry))
+        self.triggers = pending
+        return actions
+    
+    def end(self):
+        '''
+        Stops the device's thread, waking up every waiting thread
+        '''
+        
+        self.update(self.STOP)
+        self.t.join()
+    
+    def wait_for(self, predicate, timeout=None):
+        '''
+        Block until predicate() returns True, the stop signal is received 
+        or the timeout (in seconds) expires. Returns the value of 
+        predicate() when waking up.
+        '''
+        
+        with self.transition:
+            self.transition.wait_for(
+                lambda: predicate() or self.stop.is_set(), timeout)
+            return predicate()
+    
+    def wait_for_entrance(self, timeout=None):
+        return self.wait_for(self.in_trial_zone.is_set, timeout)
         
     def wait_for_leaving(self, timeout=None):
-        t0 = time.time()
-        while self.in_trial_zone.is_set():
-            t = time.time()-t0
-            if timeout is not None and t >= timeout: 
-                return False
-            if self.stop.is_set():
-                return False
-        return True
+        return self.wait_for(lambda: not self.in_trial_zone.is_set(), timeout)
             
     def wait_for_nose_poke(self, timeout=None):
-        t0 = time.time()
-        while not any((self.left_nose_poke.is_set(), 
-                       self.right_nose_poke.is_set())):
-            t = time.time()-t0
-            if timeout is not None and t >= timeout:
-                return False
+        return self.wait_for(lambda: any((self.left_nose_poke.is_set(), 
+                                          self.right_nose_poke.is_set())),
+                             timeout)
+    
+    def signal(self, flag, addr):
+        '''
+        Apply a flag received from addr, stopping the monitor if the flag
+        is unknown.
+        '''
+        
+        if flag == self.STOP:
+            sys.stderr.write("Received stop signal from"
+                             " {}\n".format(addr))
+        if not self.update(flag, "client"):
+            sys.stderr.write('Error: unknown signal received from'
+                             ' {}: {}\n'.format(addr, flag))
+            self.update(self.STOP)
+    
+    def write_tape(self, connection, protocol, flag):
+        '''
+        Write a raw flag to the tape with its time of arrival, the number
+        of its connection and the protocol (legacy or stream), so that the
+        session can be replayed with 2ac_client.py --replay.
+        '''
+        
+        if self.tape is not None:
+            self.tape.write("{:.6f},{:d},{},{}\n".format(
+                            time.perf_counter(), connection, protocol, 
+                            flag.hex()))
+    
+    async def handle(self, reader, writer):
+        '''
+        Serve a connection. A legacy connection sends a single flag that
+        is echoed back. A persistent connection starts with the STREAM 
+        byte: the flag of each complete frame received is applied and the 
+        frames are echoed back, until the client closes the connection or
+        the monitor stops.
+        '''
+        
+        addr = writer.get_extra_info('peername')
+        connection = self.connections
+        self.connections += 1
+        try:
+            data = await reader.read(1024)
+            received = time.perf_counter()
+            if data == self.STATS:
+                if self.stats is not None:
+                    writer.write(self.stats.report().encode())
+                    await writer.drain()
+                return
+            if data == self.SESSION:
+                if self.session is not None:
+                    writer.write(self.session.report().encode())
+                    await writer.drain()
+                return
+            if data[:1] != self.STREAM:
+                self.write_tape(connection, "legacy", data)
+                self.signal(data, addr)
+                if self.stats is not None:
+                    self.stats.record("apply", time.perf_counter() - received)
+                
+                # echoes back the signal
+                writer.write(data)
+                await writer.drain()
+                return
+            
+            writer.get_extra_info('socket').setsockopt(
+                socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            data, expected = data[1:], None
+            while self.running():
+                
+                # many frames can arrive with a single read
+                size = len(data) - len(data) % self.FRAME.size
+                now = time.time()
+                for flag, seq, timestamp in self.FRAME.iter_unpack(data[:size]):
+                    if expected is not None and seq != expected:
+                        sys.stderr.write('Warning: expected event #{} from {},'
+                                         ' received #{}\n'.format(
+                                         expected, addr, seq))
+                    expected = seq + 1
+                    self.events += 1
+                    self.latency_sum += now - timestamp
+                    self.latency_max = max(self.latency_max, now - timestamp)
+                    self.write_tape(connection, "stream", flag)
+                    self.signal(flag, addr)
+                    if self.stats is not None:
+                        self.stats.record("transit", now - timestamp)
+                        self.stats.record("apply", 
+                                          time.perf_counter() - received)
+                if size:
+                    writer.write(data[:size])
+                    await writer.drain()
+                data = data[size:]
+                
+                chunk = await reader.read(4096)
+                received = time.perf_counter()
+                if not chunk:
+                    break
+                data += chunk
+        except (ConnectionError, asyncio.CancelledError):
+            
+            # cancelled when the monitor stops with the connection open, 
+            # the handler ends normally (asyncio reports the cancelled 
+            # handlers of a server as errors)
+            pass
+        finally:
+            writer.close()
+    
+    async def serve(self):
+        '''
+        Accept connections from any number of clients until the stop 
+        signal is received.
+        '''
+        
+        with self.transition:
+            self.stopping = asyncio.Event()
+            self.loop = asyncio.get_running_loop()
             if self.stop.is_set():
-                return False
-        return True
+                self.stopping.set()
+        try:
+            server = await asyncio.start_server(self.handle, self.address, 
+                                                self.port)
+        except OSError as e:
+            
+            # e.g. the address is already in use: the rig stops instead 
+            # of waiting for flags that cannot arrive
+            sys.stderr.write("Error: cannot listen to {}:{}: {}\n".format(
+                             self.address, self.port, e))
+            with self.transition:
+                self.loop = None
+            self.update(self.STOP)
+            return
+        try:
+            await self.stopping.wait()
+        finally:
+            with self.transition:
+                self.loop = None
+            server.close()
+            
+            # the connections still open are closed by their handlers
+            handlers = asyncio.all_tasks() - {asyncio.current_task()}
+            for handler in handlers:
+                handler.cancel()
+            await asyncio.gather(*handlers, return_exceptions=True)
     
     def open_connection(self):
         '''
         Create a socket, listen to connection form host and port (class
-        attributes)
+        attributes). Connections are served concurrently by an asyncio 
+        event loop running in the monitor's thread.
         '''
         
-        # open the connection
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.bind((self.address, self.port))
-            s.listen()
-            while self.running():
-                conn, addr = s.accept()
-                with conn:
-                    data = conn.recv(1024)
-                    if data == self.STOP:
-                        self.stop.set()
-                        sys.stderr.write("Received stop signal from"
-                                         " {}\n".format(addr))
-                    elif data == self.MOUSE_IN:
-                        self.in_trial_zone.set()
-                    elif data == self.MOUSE_OUT:
-                        self.in_trial_zone.clear()
-                    elif data == self.LEFT_NOSE_POKE:
-                        self.left_nose_poke.set()
-                    elif data == self.RIGHT_NOSE_POKE:
-                        self.right_nose_poke.set()
-                    else:
-                        sys.stderr.write('Error: unknown signal received from'
-                                         ' {}: {}\n'.format(addr, data))
-                        self.stop.set()
-                    
-                    # echoes back the signal
-                    conn.sendall(data)
-            sys.stderr.write('Stopping...\n')
+        asyncio.run(self.serve())
+        sys.stderr.write('Stopping...\n')
+
+class NosePokeInput(object):
+    '''
+    Nose poke detector (e.g. a beam break) on a GPIO input. The poke flag
+    is applied to the Monitor from gpiozero's edge callback, so that the
+    poke is time stamped at the interrupt instead of going through 
+    2ac_client.py and the TCP connection.
+    '''
+    
+    def __init__(self, pin, flag, bounce_time=0.005, pull_up=True):
+        '''
+        pin         GPIO pin of the detector
+        flag        the flag applied at each poke, Monitor.LEFT_NOSE_POKE
+                    or Monitor.RIGHT_NOSE_POKE
+        bounce_time debouncing time, in seconds (default 0.005)
+        pull_up     True if the detector pulls the pin low when the beam
+                    is broken (default True)
+        '''
+        
+        self.button = gpiozero.Button(pin, pull_up=pull_up, 
+                                      bounce_time=bounce_time)
+        self.flag = flag
+        
+        # the monitor receiving the pokes, and the number of pokes
+        self.monitor = None
+        self.pokes = 0
+    
+    def attach(self, monitor):
+        self.monitor = monitor
+        self.button.when_pressed = self.poke
+    
+    def detach(self):
+        self.button.when_pressed = None
+        self.monitor = None
+    
+    def poke(self):
+        monitor = self.monitor
+        if monitor is not None:
+            self.pokes += 1
+            monitor.update(self.flag, "gpio")
 
 class Controller(Device):
+    '''
+    Plays off/on/off schedules from the controller's thread or, once 
+    attached to a Scheduler, from the scheduler's thread, that can be
+    shared by every controller.
+    '''
+    
+    # the recorder of the on and off events, see EventLog, the name of 
+    # the device in the records and the latency histograms, see Stats
+    log = None
+    name = None
+    stats = None
+    
+    # the Scheduler playing the schedules if attached, the end of the 
+    # last schedule and whether the device is on, see attach()
+    scheduler = None
+    end_time = 0.
+    lit = False
+    
+    def attach(self, scheduler):
+        '''
+        Plays the schedules from the scheduler's thread instead of the 
+        controller's thread, which is not started. Must be called before
+        start(). Returns the controller.
+        '''
+        
+        self.scheduler = scheduler
+        return self
+    
+    def start(self):
+        if self.scheduler is None:
+            self.t.start()
 
     def play(self, duration, offset=.0, rest=.0, condition=None, 
-                condition_timeout=None):
+                condition_timeout=None, preempt=False):
         '''
         Inject a off/on/off schedule. The first argument (duration) is 
         mandatory and sets the duration of the on phase, offset sets the 
         duration of a delay before the on phase and rest sets a duration 
         after the on phase. The play function calls will put each 
-        schedule in a queue.
+        schedule in a queue. If preempt is True, the pending schedules
+        are cancelled and the new one is played right away. 
+        
+        If condition (an Event) is given and not set, the schedule is 
+        parked until the condition is set or condition_timeout expires, 
+        without blocking the following schedules.
         '''        
         
-        if condition is None:
-            condition = Event()
-            condition.set()
-        self.Q.put((duration, offset, rest, condition, condition_timeout))
+        if preempt:
+            self.cancel()
+        if condition is not None and not condition.is_set():
+            GATE.park(self, condition, condition_timeout, self.resume, 
+                      self.generation, duration, offset, rest)
+            return
+        self.submit((self.generation, CLOCK.now(), duration, offset, rest))
+    
+    def resume(self, generation, duration, offset, rest):
+        '''
+        Queues a schedule parked until its condition was met, unless it 
+        was cancelled meanwhile.
+        '''
+        
+        with self.Q.mutex:
+            if generation != self.generation or self.stop.is_set():
+                return
+        self.submit((generation, CLOCK.now(), duration, offset, rest))
+    
+    def submit(self, schedule):
+        '''
+        Queues a schedule for the controller's thread or, if attached, 
+        commits its on and off actions to the scheduler. A schedule starts
+        when it is submitted or when the previous one ends.
+        '''
+        
+        if self.scheduler is None:
+            self.Q.put(schedule)
+            return
+        generation, queued, duration, offset, rest = schedule
+        if self.stats is not None:
+            self.stats.record("queue", CLOCK.now() - queued)
+        with self.Q.mutex:
+            if generation != self.generation:
+                return
+            onset = max(queued, self.end_time) + offset
+            self.end_time = onset + duration + rest
+        self.scheduler.at(onset, self.switch, generation, onset, True)
+        self.scheduler.at(onset + duration, self.switch, generation, 
+                          onset + duration, False)
+    
+    def switch(self, generation, deadline, on):
+        '''
+        Turns the device on or off from the scheduler's thread, unless the
+        schedule was cancelled.
+        '''
+        
+        if generation != self.generation:
+            return
+        self.lit = on
+        if on:
+            self.on()
+        else:
+            self.off()
+        lateness = CLOCK.now() - deadline
+        if on and self.stats is not None:
+            self.stats.record("on", lateness)
+        if self.log is not None:
+            self.log.record(self.name, "on" if on else "off", lateness)
+    
+    def play_when(self, monitor, predicate, duration, offset=.0, rest=.0, 
+                  timeout=None):
+        '''
+        Queue a schedule as soon as predicate() returns True after a state
+        transition of the monitor, e.g. dispense a reward at a nose poke. 
+        The schedule is dropped if the predicate does not return True 
+        within timeout seconds. Returns the monitor's trigger.
+        '''
+        
+        return monitor.when(predicate, 
+                            lambda: self.play(duration, offset, rest), 
+                            timeout)
+    
+    def cancel(self):
+        '''
+        Drop the schedules waiting in the queue and interrupt the one 
+        being played, turning the device off.
+        '''
+        
+        with self.Q.mutex:
+            self.generation += 1
+            self.Q.queue.clear()
+            self.end_time = 0.
+        GATE.discard(self)
+        self.interrupt.set()
+        if self.scheduler is not None:
+            self.scheduler.at(CLOCK.now(), self.release, self.generation)
+    
+    def release(self, generation):
+        if generation == self.generation and self.lit:
+            self.lit = False
+            self.off()
+    
+    def end(self):
+        '''
+        Stops the device's thread, interrupting the current schedule
+        '''
+        
+        if self.scheduler is not None:
+            self.stop.set()
+            self.cancel()
+            self.release(self.generation)
+            return
+        self.stop.set()
+        GATE.discard(self)
+        self.interrupt.set()
+        self.Q.put(None)
+        self.t.join()
     
     def player(self):
         '''
         Retrieve the schedules from the queue and play them as soon as 
-        they become available.
+        they become available. Blocks on the queue until a schedule or 
+        the stop sentinel (None) is received. The on and off actions are
+        timed against absolute deadlines: a schedule starts when it is 
+        queued (after its condition is met, if any) or when the previous 
+        one ends, so that delays do not add up. The lateness of each action 
+        (actual minus intended time, in seconds) is recorded as the 
+        event's value.
         '''
         
+        end = 0.
         while self.running():
-            if not self.Q.empty():
-                duration, offset, rest, condition, condition_timeout = self.Q.get()
-                condition.wait(condition_timeout)
-                time.sleep(offset)
-                self.on()
-                time.sleep(duration)
-                self.off()
-                time.sleep(rest)    
+            schedule = self.Q.get()
+            if schedule is None:
+                break
+            generation, queued, duration, offset, rest = schedule
+            
+            # skip schedules cancelled after being retrieved
+            self.interrupt.clear()
+            if generation != self.generation:
+                continue
+            start = max(queued, end)
+            if self.stats is not None:
+                self.stats.record("queue", CLOCK.now() - queued)
+            
+            onset = start + offset
+            end = onset + duration + rest
+            if CLOCK.wait_until(onset, self.interrupt):
+                end = 0.
+                continue
+            self.on()
+            if self.stats is not None:
+                self.stats.record("on", CLOCK.now() - onset)
+            if self.log is not None:
+                self.log.record(self.name, "on", CLOCK.now() - onset)
+            CLOCK.wait_until(onset + duration, self.interrupt)
+            self.off()
+            if self.log is not None:
+                self.log.record(self.name, "off", 
+                                CLOCK.now() - onset - duration)
+            if CLOCK.wait_until(end, self.interrupt):
+                end = 0.
 
 class MockController(Controller):
     '''
@@ -263,6 +1318,11 @@ class MockController(Controller):
         # a stop value
         self.stop = Event()
         
+        # set to interrupt the current schedule, and the number of 
+        # cancellations
+        self.interrupt = Event()
+        self.generation = 0
+        
     def on(self):
         pass
         
@@ -275,12 +1335,35 @@ class MockController(Controller):
 class LEDPlayer(Controller):
     '''
     Allowing turning on and off a LED according to a given time schedule.
+    During the on phase, the LED shows its waveform if one is set: blink 
+    trains and fades are handed to gpiozero's background thread, and 
+    brightness levels to the pin's PWM, so that the player does no work 
+    per edge. The waveforms (see 'waveforms') are described by their name
+    followed by their parameters, e.g. ("blink", 0.1, 0.1). The PWM 
+    waveforms need a gpiozero.PWMLED, a LED being turned on instead.
     '''
     
-    def __init__(self, LED):
+    # the waveforms, and their parameters:
+    #   blink ON_TIME OFF_TIME      blink train
+    #   pulse FADE_IN FADE_OUT      fade in and out, repeatedly (PWM)
+    #   ramp FADE_IN                fade in, then stay on (PWM)
+    #   level BRIGHTNESS            dimmed light, from 0 to 1 (PWM)
+    waveforms = { "blink" : 2,
+                  "pulse" : 2,
+                  "ramp"  : 1,
+                  "level" : 1 }
+    
+    def __init__(self, LED, waveform=None):
+        '''
+        LED         a LED object returned by gpiozero.LED(...) or 
+                    gpiozero.PWMLED(...)
+        waveform    waveform shown during the on phase (default None, 
+                    steady light)
+        '''
         
         # a LED object returned by gpiozero.LED(...)
         self.LED = LED
+        self.waveform = waveform
         
         # Command queue
         self.Q = Queue()
@@ -291,8 +1374,26 @@ class LEDPlayer(Controller):
         # a stop value
         self.stop = Event()
         
+        # set to interrupt the current schedule, and the number of 
+        # cancellations
+        self.interrupt = Event()
+        self.generation = 0
+        
     def on(self):
-        return self.LED.on()
+        if self.waveform is None:
+            return self.LED.on()
+        name, args = self.waveform[0], self.waveform[1:]
+        if name == "blink":
+            return self.LED.blink(*args)
+        if not isinstance(self.LED, gpiozero.PWMLED):
+            return self.LED.on()
+        if name == "pulse":
+            return self.LED.pulse(*args)
+        if name == "ramp":
+            
+            # stays on until turned off, i.e. at most a day
+            return self.LED.blink(86400, 0, args[0], 0, n=1)
+        self.LED.value = args[0]
         
     def off(self):
         return self.LED.off()
@@ -301,127 +1402,2044 @@ class LEDPlayer(Controller):
         if isinstance(other, LED):
             return self.LED == other.LED
 
-class SoundPlayer(Controller):
+class DispenserPlayer(Controller):
     '''
-    Allowing playing a WAV file according to a given time schedule.
+    Drives a reward dispenser (motor or solenoid) on a GPIO output: a 
+    train of pulses is played by gpiozero's background thread at the 
+    start of each on phase. If a sensor input is given (e.g. a pellet 
+    detector), the delivery is confirmed by its activation during the on
+    phase, and the dispense latency, from the request of the reward (the
+    correct nose poke, see play_when) to the confirmation, is recorded as
+    the value of a "delivered" event. A "missed" event is recorded if the
+    delivery is not confirmed by the end of the on phase.
     '''
     
-    def __init__(self, sound=None):
+    def __init__(self, output, sensor=None, pulses=1, on_time=0.05, 
+                 off_time=0.05):
+        '''
+        output      gpiozero.DigitalOutputDevice driving the dispenser
+        sensor      gpiozero.DigitalInputDevice confirming the delivery
+                    (default None)
+        pulses      number of pulses of the train (default 1)
+        on_time     duration of each pulse, in seconds (default 0.05)
+        off_time    duration between two pulses, in seconds (default 0.05)
+        '''
         
-        # check if the mixer is available
-        if pygame.mixer.get_init() is None:
+        self.output, self.sensor = output, sensor
+        self.pulses, self.on_time, self.off_time = pulses, on_time, off_time
+        
+        # time of the last request, whether a confirmation is expected, 
+        # the number of confirmed and missed deliveries and the sum and 
+        # maximum of the dispense latency
+        self.requested = None
+        self.waiting = False
+        self.delivered = 0
+        self.missed = 0
+        self.latency_sum = 0.
+        self.latency_max = 0.
+        self.lock = Lock()
+        if sensor is not None:
+            sensor.when_activated = self.confirm
+        
+        # Command queue
+        self.Q = Queue()
+        
+        # the thread running the command sequences
+        self.t = Thread(target=self.player, args=())
+        
+        # a stop value
+        self.stop = Event()
+        
+        # set to interrupt the current schedule, and the number of 
+        # cancellations
+        self.interrupt = Event()
+        self.generation = 0
+    
+    def play(self, duration, offset=.0, rest=.0, condition=None, 
+                condition_timeout=None, preempt=False):
+        self.requested = CLOCK.now()
+        return Controller.play(self, duration, offset, rest, condition, 
+                               condition_timeout, preempt)
+    
+    def confirm(self):
+        '''
+        Called by gpiozero when the sensor is activated.
+        '''
+        
+        with self.lock:
+            if not self.waiting:
+                return
+            self.waiting = False
+            latency = CLOCK.now() - self.requested
+            self.delivered += 1
+            self.latency_sum += latency
+            self.latency_max = max(self.latency_max, latency)
+        if self.log is not None:
+            self.log.record(self.name, "delivered", latency)
+    
+    def on(self):
+        if self.sensor is not None:
+            with self.lock:
+                self.waiting = True
+        return self.output.blink(self.on_time, self.off_time, self.pulses)
+    
+    def off(self):
+        self.output.off()
+        with self.lock:
+            missed, self.waiting = self.waiting, False
+            if missed:
+                self.missed += 1
+        if missed and self.log is not None:
+            self.log.record(self.name, "missed")
+
+class SoundPlayer(Controller):
+    '''
+    Allowing playing a WAV file according to a given time schedule.
+    '''
+    
+    def __init__(self, sound=None, channel=None):
+        
+        # check if the mixer is available
+        if pygame.mixer.get_init() is None:
             TypeError("pygame's mixer is not initialized. Call" 
                       " pygame.mixer.init(...) before making a" 
                       " SoundPlayer instance.")
         
-        # a Sound object returned by pygame.mixer.Sound(...), or None
-        self.sound = sound
+        # a Sound object returned by pygame.mixer.Sound(...), or None
+        self.sound = sound
+        
+        # the mixer's channel playing the sound, or None to play it on 
+        # any free channel
+        self.channel = None if channel is None else pygame.mixer.Channel(channel)
+        
+        # the channel the sound was last played on
+        self.playing = None
+        
+        # Command queue
+        self.Q = Queue()
+       
+        # the thread running the command sequences
+        self.t = Thread(target=self.player, args=())
+        
+        # a stop value
+        self.stop = Event()
+        
+        # set to interrupt the current schedule, and the number of 
+        # cancellations
+        self.interrupt = Event()
+        self.generation = 0
+        
+    def on(self):
+        if self.sound is None:
+            return None
+        if self.channel is None:
+            self.playing = self.sound.play()
+            return self.playing
+        self.playing = self.channel
+        return self.channel.play(self.sound)
+        
+    def off(self):
+        
+        # the sounds are shared by the rigs (see StimulusBank): stop the 
+        # channel playing this one, never Sound.stop() that would stop it
+        # on every channel, nor another sound played since on the channel
+        if self.sound is None or self.playing is None:
+            return None
+        if self.playing.get_sound() is self.sound:
+            return self.playing.stop()
+        return None
+    
+    def __eq__(self, other):
+        if isinstance(other, SoundPlayer):
+            return self.wavfile == other.wavfile
+
+class StreamPlayer(Controller):
+    '''
+    Allowing playing long sounds according to a given time schedule. The 
+    sound is synthesized block by block and the blocks are queued on a 
+    mixer's channel as the previous ones are played, so that only a few
+    blocks are kept in memory.
+    '''
+    
+    def __init__(self, blocks, channel=0):
+        '''
+        blocks      a function returning an iterator over the sample 
+                    arrays of the sound, e.g.
+                    lambda: whitenoise_blocks(600, 0.3, block_length=1)
+        channel     the pygame's mixer channel id (default 0)
+        '''
+        
+        # check if the mixer is available
+        if pygame.mixer.get_init() is None:
+            raise TypeError("pygame's mixer is not initialized. Call" 
+                            " pygame.mixer.init(...) before making a" 
+                            " StreamPlayer instance.")
+        
+        self.blocks = blocks
+        self.channel = pygame.mixer.Channel(channel)
+        
+        # the thread feeding the channel, set to stop it, the number of 
+        # blocks played and the number of blocks that were not ready when
+        # the previous one ended
+        self.feeder = None
+        self.halt = Event()
+        self.played = 0
+        self.underruns = 0
+        
+        # Command queue
+        self.Q = Queue()
+       
+        # the thread running the command sequences
+        self.t = Thread(target=self.player, args=())
+        
+        # a stop value
+        self.stop = Event()
+        
+        # set to interrupt the current schedule, and the number of 
+        # cancellations
+        self.interrupt = Event()
+        self.generation = 0
+    
+    def feed(self, blocks):
+        '''
+        Queue the blocks on the channel, one at a time, until the sound 
+        ends or the halt signal is received.
+        '''
+        
+        for sample_array in blocks:
+            sound = pygame.mixer.Sound(sample_array)
+            
+            # wait for the queued block to start, checking four times per
+            # block length
+            while self.channel.get_queue() is not None:
+                if self.halt.wait(sound.get_length() / 4):
+                    return
+            if self.halt.is_set():
+                return
+            
+            if self.channel.get_busy():
+                self.channel.queue(sound)
+            else:
+                if self.played:
+                    self.underruns += 1
+                self.channel.play(sound)
+            self.played += 1
+    
+    def on(self):
+        self.halt.clear()
+        self.feeder = Thread(target=self.feed, args=(self.blocks(),))
+        self.feeder.start()
+    
+    def off(self):
+        self.halt.set()
+        if self.feeder is not None:
+            self.feeder.join()
+            self.feeder = None
+        self.channel.stop()
+
+class Scheduler(Device):
+    '''
+    Runs actions at absolute deadlines from a single thread, keeping the 
+    pending actions in a heap ordered by deadline. Compound stimuli played
+    through the scheduler turn their controllers on back to back at a 
+    shared deadline, without going through each controller's thread.
+    '''
+    
+    def __init__(self, log=None, stats=None):
+        '''
+        log         Recorder of the controllers' on and off events and of
+                    the skew of each compound stimulus (default None)
+        stats       Stats recording the same latencies (default None)
+        '''
+        
+        self.log = log
+        self.stats = stats
+        
+        # pending actions as (deadline, order, action, args), and the 
+        # condition notified when an action is added
+        self.heap = []
+        self.counter = itertools.count()
+        self.changed = Condition()
+        
+        # number of compound stimuli fired and their skew, i.e. the time
+        # between the first and the last controller's on() call
+        self.fired = 0
+        self.skew = self.skew_sum = self.skew_max = 0.
+        
+        # the thread running the actions
+        self.t = Thread(target=self.dispatcher, args=())
+        
+        # a stop value
+        self.stop = Event()
+    
+    def end(self):
+        '''
+        Stops the device's thread, dropping the pending actions except 
+        the release of the controllers left on by a compound stimulus, 
+        e.g. the light of a cue interrupted by the end of the session
+        '''
+        
+        with self.changed:
+            self.stop.set()
+            self.changed.notify()
+        self.t.join()
+        with self.changed:
+            pending, self.heap = self.heap, []
+        for deadline, order, action, args in sorted(pending):
+            if action == self.release and args[1].lit:
+                action(*args)
+    
+    def at(self, deadline, action, *args):
+        '''
+        Run action(*args) at the given CLOCK time.
+        '''
+        
+        with self.changed:
+            heapq.heappush(self.heap, (deadline, next(self.counter), action,
+                                       args))
+            self.changed.notify()
+    
+    def dispatcher(self):
+        '''
+        Waits for the earliest deadline and runs every action due at that
+        deadline.
+        '''
+        
+        while True:
+            with self.changed:
+                while self.running():
+                    if not self.heap:
+                        self.changed.wait()
+                        continue
+                    remaining = self.heap[0][0] - CLOCK.now()
+                    if remaining <= CLOCK.spin:
+                        break
+                    self.changed.wait(remaining - CLOCK.spin)
+                else:
+                    return
+                deadline = self.heap[0][0]
+                actions = []
+                while self.heap and self.heap[0][0] == deadline:
+                    actions.append(heapq.heappop(self.heap))
+            CLOCK.wait_until(deadline)
+            for deadline, order, action, args in actions:
+                action(*args)
+    
+    def play(self, parts, delay=.0):
+        '''
+        Commits a compound stimulus and returns its onset. parts is a list
+        of (controller, duration) or (controller, duration, offset) 
+        tuples: the controllers with the same offset are turned on at the 
+        same deadline, delay + offset seconds from now, and each is turned
+        off after its duration.
+        '''
+        
+        start = CLOCK.now() + delay
+        onsets = OrderedDict()
+        for part in parts:
+            controller, duration, offset = (tuple(part) + (.0,))[:3]
+            onsets.setdefault(start + offset, []).append(controller)
+            self.at(start + offset + duration, self.release, 
+                    start + offset + duration, controller)
+        for onset, controllers in onsets.items():
+            self.at(onset, self.fire, onset, controllers)
+        return start
+    
+    def fire(self, onset, controllers):
+        times = []
+        for controller in controllers:
+            times.append(CLOCK.now())
+            controller.lit = True
+            controller.on()
+        self.skew = times[-1] - times[0]
+        self.fired += 1
+        self.skew_sum += self.skew
+        self.skew_max = max(self.skew_max, self.skew)
+        if self.stats is not None:
+            for t in times:
+                self.stats.record("on", t - onset)
+            self.stats.record("skew", self.skew)
+        if self.log is not None:
+            for controller, t in zip(controllers, times):
+                self.log.record(controller.name, "on", t - onset)
+            self.log.record("scheduler", "skew", self.skew)
+    
+    def release(self, deadline, controller):
+        controller.lit = False
+        controller.off()
+        if self.log is not None:
+            self.log.record(controller.name, "off", CLOCK.now() - deadline)
+
+class Trials(object):
+    '''
+    Yields the trial number and the reward position according to a 
+    precomputed schedule or an input list. The schedule is computed by 
+    chunks of whole sessions with the instance's own random generator, so
+    that a seeded session is reproducible and known in advance:
+        random      positions drawn independently
+        block       each block of 'block' trials holds every position 
+                    the same number of times
+        gellermann  Gellermann-style series of 10 trials, for two 
+                    positions: 5 of each, at least 2 of each in both 
+                    halves and 4 or 5 switches
+    In every schedule, no position is allocated more than max_repeat 
+    times in a row.
+    '''
+    
+    schedules = ("random", "block", "gellermann")
+    
+    def __init__(self, max_repeat=3, seed=None, schedule="random", 
+                 positions=("left", "right"), block=None, length=1000, 
+                 sequence=None):
+        '''
+        Returns an instance of the Trials class. 
+            
+        max_repeat  the maximum number of time the reward is allocated
+                    to the same side (default 3)
+        
+        seed        random seed (default None)
+        
+        schedule    one of 'schedules' (default "random")
+        
+        positions   the reward positions (default ("left", "right"))
+        
+        block       number of trials of a block, a multiple of the number
+                    of positions (default None, 5 trials per position)
+        
+        length      number of trials computed at once (default 1000)
+        
+        sequence    list of reward positions played first, e.g. read 
+                    from a file written by save(), then the schedule goes
+                    on (default None)
+        '''
+    
+        # parameter values
+        self.max_repeat = max_repeat
+        self.seed = seed
+        self.schedule = schedule
+        self.positions = tuple(positions)
+        self.block = 5 * len(self.positions) if block is None else block
+        self.length = length
+        self.rng = np.random.default_rng(seed)
+        if schedule not in Trials.schedules:
+            raise ValueError("unknown schedule: {}".format(schedule))
+        if len(self.positions) < 2 or max_repeat < 1 or \
+           self.block % len(self.positions):
+            raise ValueError("invalid positions, block or max_repeat")
+        if schedule == "gellermann":
+            if len(self.positions) != 2:
+                raise ValueError("Gellermann series need two positions")
+            self.series = self.gellermann_series()
+            if not len(self.series):
+                raise ValueError("no Gellermann series without runs longer "
+                                 "than max_repeat={}".format(max_repeat))
+        
+        # blocks mostly holding longer runs would take too many draws
+        if schedule == "block" and self.valid_blocks() < 0.01:
+            raise ValueError("blocks of {} trials seldom hold no run longer "
+                             "than max_repeat={}".format(self.block, 
+                                                         max_repeat))
+        
+        # the precomputed positions, as indices of self.positions
+        self.sequence = np.array([ self.positions.index(p) 
+                                   for p in sequence or () ], 
+                                 dtype=np.int64)
+        if not len(self.sequence):
+            self.extend(length)
+        
+        # record
+        self.i = 0
+        self.reward_position = None
+        
+    def gellermann_series(self):
+        '''
+        Returns the array of the Gellermann-style series of 10 trials, one
+        per row.
+        '''
+        
+        series = np.array(list(itertools.product((0, 1), repeat=10)))
+        switches = (series[:, 1:] != series[:, :-1]).sum(axis=1)
+        keep = (series.sum(axis=1) == 5) & \
+               (series[:, :5].sum(axis=1) >= 2) & \
+               (series[:, :5].sum(axis=1) <= 3) & \
+               (switches >= 4) & (switches <= 5)
+        series = series[keep]
+        return series[[ self.longest_run(s) <= self.max_repeat 
+                        for s in series ]]
+    
+    def longest_run(self, sequence):
+        starts = np.flatnonzero(np.diff(sequence)) + 1
+        return np.diff(np.concatenate(([0], starts, [len(sequence)]))).max()
+    
+    def runs(self, length):
+        '''
+        Returns length trials drawn independently, except that a run of 
+        max_repeat trials at the same position is always followed by a 
+        switch. The lengths of the runs and the switches are drawn at once.
+        '''
+        
+        n = len(self.positions)
+        lengths = np.minimum(self.rng.geometric(1 - 1 / n, size=length), 
+                             self.max_repeat)
+        last = self.sequence[-1] if len(self.sequence) else \
+               self.rng.integers(n)
+        switches = self.rng.integers(1, n, size=length)
+        return np.repeat((last + np.cumsum(switches)) % n, lengths)[:length]
+    
+    def draw(self, count, rng=None):
+        '''
+        Returns count units of the schedule: blocks or series, drawn with
+        rng (default the instance's random generator).
+        '''
+        
+        rng = self.rng if rng is None else rng
+        n = len(self.positions)
+        if self.schedule == "block":
+            blocks = np.tile(np.repeat(np.arange(n), self.block // n), 
+                             (count, 1))
+            return rng.permuted(blocks, axis=1).ravel()
+        return self.series[rng.integers(len(self.series), 
+                                        size=count)].ravel()
+    
+    def valid_blocks(self, count=1000):
+        '''
+        Returns the fraction of count blocks holding no run longer than 
+        max_repeat, drawn with a generator of their own so that the 
+        schedule is not changed.
+        '''
+        
+        blocks = self.draw(count, np.random.default_rng(0)).reshape(count, 
+                                                                    -1)
+        return np.mean([ self.longest_run(b) <= self.max_repeat 
+                         for b in blocks ])
+    
+    def extend(self, length):
+        '''
+        Appends at least length trials to the sequence. From the first 
+        block or series making a run longer than max_repeat, each one is 
+        drawn again until it continues the previous ones without such a
+        run. A valid unit can always be drawn (see __init__), so that the
+        schedule never fails in the middle of a session.
+        '''
+        
+        if self.schedule == "random":
+            self.sequence = np.concatenate((self.sequence, 
+                                            self.runs(length)))
+            return
+        start = len(self.sequence)
+        unit = self.block if self.schedule == "block" else 10
+        self.sequence = np.concatenate((self.sequence, 
+                                        self.draw(-(-length // unit))))
+            
+        # first trial exceeding max_repeat in each run
+        starts = np.flatnonzero(np.diff(self.sequence)) + 1
+        starts = np.concatenate(([0], starts))
+        runs = np.diff(np.concatenate((starts, [len(self.sequence)])))
+        bad = starts[runs > self.max_repeat] + self.max_repeat
+        bad = bad[bad >= start]
+        if not len(bad):
+            return
+        
+        # the trials before a unit are valid, so that a run longer than 
+        # max_repeat going on in the unit shows within its max_repeat 
+        # previous trials and itself
+        r = self.max_repeat
+        first = start + (bad.min() - start) // unit * unit
+        for k in range(first, len(self.sequence), unit):
+            while self.longest_run(self.sequence[max(k - r, 0):k + unit]) > r:
+                self.sequence[k:k + unit] = self.draw(1)
+    
+    def save(self, fname, length=None):
+        '''
+        Writes the first length reward positions (default the number of 
+        trials computed at once), one per line, computing more if needed.
+        '''
+        
+        length = self.length if length is None else length
+        if len(self.sequence) < length:
+            self.extend(length - len(self.sequence))
+        with open(fname, "w") as f:
+            f.write("".join( self.positions[k] + "\n" 
+                             for k in self.sequence[:length] ))
+    
+    def record(self, position, choice, t):
+        '''
+        Records the outcome of a trial: the reward position, the position
+        chosen by the mouse (None if it did not choose) and its reaction 
+        time. The schedules ignore it.
+        '''
+        
+        pass
+    
+    def next(self):
+        
+        # compute the next chunk of the session if needed
+        if self.i >= len(self.sequence):
+            self.extend(self.length)
+        self.reward_position = int(self.sequence[self.i])
+        
+        # increments the trial number
+        self.i += 1
+        
+        # return the trial number and the reward position
+        return (self.i, self.positions[self.reward_position])                
+
+class AdaptiveTrials(Trials):
+    '''
+    Trials whose reward positions counter the mouse's side bias: the 
+    reward is allocated to each position with a probability proportional
+    to the error rate of the last trials rewarded there, raised to the 
+    power strength, so that a mouse preferring one side gets more trials
+    on the others. The rolling accuracy, choices and reaction times of
+    the last 'window' trials are kept in ring buffers with running sums:
+    each trial takes a constant time however long the session.
+    '''
+    
+    schedules = ("adaptive",)
+    
+    def __init__(self, max_repeat=3, seed=None, positions=("left", "right"),
+                 window=20, strength=1., length=1000, sequence=None):
+        '''
+        See Trials, and:
+        window      number of trials of each position, and of choices, 
+                    in the rolling statistics (default 20)
+        strength    exponent of the error rates, 0 to allocate the 
+                    positions at random (default 1.)
+        length      number of random numbers drawn at once (default 1000)
+        sequence    list of reward positions played first, before the
+                    allocation adapts (default None)
+        '''
+        
+        Trials.__init__(self, max_repeat, seed, "random", positions, 
+                        length=0, sequence=sequence)
+        self.window = window
+        self.strength = strength
+        self.length = length
+        n = len(self.positions)
+        
+        # ring buffers of the outcomes (1 if correct) and reaction times of
+        # the last trials of each position, their next slot, their number 
+        # of trials and their running sums
+        self.hits = [ [0] * window for k in range(n) ]
+        self.times = [ [0.] * window for k in range(n) ]
+        self.head = [0] * n
+        self.count = [0] * n
+        self.hits_sum = [0] * n
+        self.times_sum = [0.] * n
+        
+        # ring buffer of the last choices, and number of each choice in it
+        self.choices = [None] * window
+        self.choice_head = 0
+        self.choice_count = [0] * n
+        
+        # number of trials allocated to each position, last position 
+        # allocated and length of its current run
+        self.allocated = [0] * n
+        self.last = None
+        self.run = 0
+        
+        # random numbers drawn by chunks of length
+        self.uniform = []
+    
+    def save(self, fname, length=None):
+        '''
+        Writes the input list only, the positions that follow depending 
+        on the mouse's choices.
+        '''
+        
+        Trials.save(self, fname, len(self.sequence))
+    
+    def accuracy(self, k):
+        '''
+        Returns the rolling accuracy of the trials rewarded at the k-th 
+        position, with one correct and one incorrect trial of prior, that
+        weights the positions without dividing by zero. The reports use 
+        the accuracy without prior.
+        '''
+        
+        return (self.hits_sum[k] + 1) / (self.count[k] + 2)
+    
+    def record(self, position, choice, t):
+        
+        # time outs tell nothing of the mouse's preference
+        if choice is None:
+            return
+        k = self.positions.index(position)
+        hit = int(choice == position)
+        
+        # replace the oldest trial of the position
+        j = self.head[k]
+        self.hits_sum[k] += hit - self.hits[k][j]
+        self.times_sum[k] += t - self.times[k][j]
+        self.hits[k][j], self.times[k][j] = hit, t
+        self.head[k] = (j + 1) % self.window
+        self.count[k] = min(self.count[k] + 1, self.window)
+        
+        # replace the oldest choice
+        c = self.positions.index(choice)
+        old = self.choices[self.choice_head]
+        if old is not None:
+            self.choice_count[old] -= 1
+        self.choices[self.choice_head] = c
+        self.choice_count[c] += 1
+        self.choice_head = (self.choice_head + 1) % self.window
+    
+    def next(self):
+        
+        # play the input list first
+        if self.i < len(self.sequence):
+            i, position = Trials.next(self)
+            k = self.reward_position
+        else:
+            
+            # weight each position with its error rate, the position 
+            # repeated max_repeat times excluded
+            weights = [ (1 - self.accuracy(k)) ** self.strength 
+                        for k in range(len(self.positions)) ]
+            if self.run >= self.max_repeat:
+                weights[self.last] = 0.
+            
+            if not self.uniform:
+                self.uniform = self.rng.random(self.length).tolist()
+            u = self.uniform.pop() * sum(weights)
+            for k, weight in enumerate(weights):
+                if weight and u < weight:
+                    break
+                u -= weight
+            else:
+                k = max( k for k, weight in enumerate(weights) if weight )
+            self.reward_position = k
+            self.i += 1
+            i, position = self.i, self.positions[k]
+        
+        # update the current run
+        self.run = self.run + 1 if k == self.last else 1
+        self.last = k
+        self.allocated[k] += 1
+        return (i, position)
+    
+    def report(self, prefix=""):
+        '''
+        Writes the rolling statistics of each position on the standard 
+        error, the accuracy being that of the position's last trials 
+        (n/a if none were scored).
+        '''
+        
+        chosen = max(sum(self.choice_count), 1)
+        for k, position in enumerate(self.positions):
+            accuracy = "n/a" if not self.count[k] else \
+                       "{:.2f}".format(self.hits_sum[k] / self.count[k])
+            sys.stderr.write("[i] {}{}: {:d} trials, rolling accuracy "
+                             "{}, chosen {:.0f}%, reaction time "
+                             "{:.3f}s\n".format(prefix, position, 
+                             self.allocated[k], accuracy, 
+                             100 * self.choice_count[k] / chosen, 
+                             self.times_sum[k] / max(self.count[k], 1)))
+
+class EventLog(Device):
+    '''
+    Records time stamped events and writes them to a CSV file from a 
+    background thread, by batches. Each event holds its time (in seconds,
+    from a monotonic clock started with the log), the rig, the trial 
+    number, the device, the event name and a value (NaN if none). The 
+    events can be exported to a NumPy's .npz file at the end, with one 
+    array per column.
+    '''
+    
+    columns = ("time", "rig", "trial", "device", "event", "value")
+    
+    def __init__(self, fname=None, batch=256):
+        '''
+        fname       CSV file path, or None to keep the events in memory 
+                    only
+        batch       maximum number of events written at once (default
+                    256)
+        '''
+        
+        self.fname = fname
+        self.batch = batch
+        
+        # clock origin, in nanoseconds, and the matching wall-clock time
+        self.t0 = time.perf_counter_ns()
+        self.start_time = time.time()
+        
+        # the recorded events
+        self.events = []
+        
+        # Event queue
+        self.Q = Queue()
+        
+        # the thread writing the events
+        self.t = Thread(target=self.writer, args=())
+        
+        # a stop value
+        self.stop = Event()
+    
+    def end(self):
+        '''
+        Stops the writer thread once every event is written
+        '''
+        
+        self.stop.set()
+        self.Q.put(None)
+        self.t.join()
+    
+    def record(self, rig, trial, device, event, value=float('nan'), t=None):
+        '''
+        Records an event, at time t (in seconds) if given.
+        '''
+        
+        self.Q.put((time.perf_counter_ns() - self.t0 if t is None else 
+                    int(t * 1e9), rig, trial, device, event, value))
+    
+    def recorder(self, rig):
+        return Recorder(self, rig)
+    
+    def writer(self):
+        '''
+        Retrieve the events from the queue and write them by batches.
+        '''
+        
+        fout = open(self.fname, "w") if self.fname is not None else None
+        if fout is not None:
+            fout.write(",".join(self.columns) + "\n")
+        done = False
+        while not done:
+            batch = [self.Q.get()]
+            while len(batch) < self.batch and not self.Q.empty():
+                batch.append(self.Q.get())
+            if batch[-1] is None:
+                batch.pop()
+                done = True
+            self.events.extend(batch)
+            if fout is not None:
+                fout.write("".join( "{:.9f},{},{},{},{},{}\n".format(
+                    t * 1e-9, rig, trial, device, event, value)
+                    for t, rig, trial, device, event, value in batch ))
+                fout.flush()
+        if fout is not None:
+            fout.close()
+    
+    def export(self, fname):
+        '''
+        Save the events to a NumPy's .npz file. rig, device and event are
+        saved as integer codes indexing the 'rigs', 'devices' and 'events'
+        arrays.
+        '''
+        
+        t, rig, trial, device, event, value = zip(*self.events) \
+            if self.events else ((),) * 6
+        arrays = { "time": np.array(t, dtype=np.int64) * 1e-9,
+                   "trial": np.array(trial, dtype=np.int32),
+                   "value": np.array(value, dtype=np.float64),
+                   "start_time": np.float64(self.start_time) }
+        for name, column in (("rig", rig), ("device", device), 
+                             ("event", event)):
+            labels, codes = np.unique(np.array(column, dtype=str), 
+                                      return_inverse=True)
+            arrays[name] = codes.astype(np.uint16)
+            arrays[name + "s"] = labels
+        np.savez(fname, **arrays)
+
+class Recorder(object):
+    '''
+    Records the events of a rig in an EventLog, with the rig's current 
+    trial number, and the time of the rig's clock if set (e.g. a 
+    VirtualClock).
+    '''
+    
+    def __init__(self, log, rig):
+        self.log, self.rig = log, rig
+        self.trial = 0
+        self.clock = None
+    
+    def record(self, device, event, value=float('nan')):
+        self.log.record(self.rig, self.trial, device, event, value,
+                        None if self.clock is None else self.clock.now())
+
+class StimulusBank(object):
+    '''
+    Synthesizes each sound once and keeps it as a pygame's Sound object, 
+    ready to be played. Sounds are described by the function returning 
+    their sample array followed by its arguments, e.g. 
+    (sinetone_samples, 440, 0.1), and are identified by this description 
+    and the mixer's format. The least recently used sounds are dropped 
+    when more than maxsize are stored.
+    '''
+    
+    def __init__(self, maxsize=256, cache=None):
+        '''
+        maxsize     maximum number of sounds kept in memory (default 256)
+        cache       directory where the sample arrays are saved, so that
+                    they are not synthesized again at the next start 
+                    (default None)
+        '''
+        
+        self.maxsize = maxsize
+        self.cache = cache
+        if cache is not None:
+            makedirs(cache, exist_ok=True)
+        self.sounds = OrderedDict()
+        self.lock = Lock()
+    
+    def key(self, generator, *args):
+        return (generator.__name__,) + args + pygame.mixer.get_init()
+    
+    def store(self, key, sound):
+        with self.lock:
+            self.sounds[key] = sound
+            self.sounds.move_to_end(key)
+            while len(self.sounds) > self.maxsize:
+                self.sounds.popitem(last=False)
+    
+    def lookup(self, key):
+        with self.lock:
+            sound = self.sounds.get(key)
+            if sound is not None:
+                self.sounds.move_to_end(key)
+            return sound
+    
+    def synthesize(self, generator, *args):
+        '''
+        Returns the sample array of a sound, loaded from the cache 
+        directory if it was saved there.
+        '''
+        
+        if self.cache is None:
+            return generator(*args)
+        fname = path.join(self.cache, hashlib.sha1(
+            repr(self.key(generator, *args)).encode()).hexdigest() + ".npy")
+        if path.exists(fname):
+            return np.load(fname)
+        sample_array = generator(*args)
+        np.save(fname, sample_array)
+        return sample_array
+    
+    def get(self, generator, *args):
+        '''
+        Returns the Sound object of a sound description.
+        '''
+        
+        key = self.key(generator, *args)
+        sound = self.lookup(key)
+        if sound is None:
+            sound = pygame.mixer.Sound(self.synthesize(generator, *args))
+            self.store(key, sound)
+        return sound
+    
+    def sequence(self, descriptions):
+        '''
+        Returns the Sound object of the given sounds played one after the 
+        other.
+        '''
+        
+        key = tuple( self.key(*d) for d in descriptions )
+        sound = self.lookup(key)
+        if sound is None:
+            sound = pygame.mixer.Sound(np.concatenate([ 
+                pygame.sndarray.samples(self.get(*d)) for d in descriptions ]))
+            self.store(key, sound)
+        return sound
+    
+    def prepare(self, descriptions):
+        '''
+        Synthesizes the sequences of every order of the given sounds, so
+        that shuffled sequences are served without being built.
+        '''
+        
+        for order in itertools.permutations(descriptions):
+            self.sequence(order)
+
+class Protocol(object):
+    '''
+    A trial protocol described as a state machine, e.g. loaded from a JSON
+    file. The description maps the name of each state to:
+        "do"        the actions run when the state is entered, as lists 
+                    made of the action name followed by its arguments,
+                    e.g. ["play", "speaker", 1]
+        "on"        the state entered on a monitor event, by event name
+        "after"     [DURATION, STATE], the state entered if no event
+                    occurred DURATION seconds after the state was entered
+        "next"      the state entered right after the actions
+    and "initial" names the first state. The description is checked and
+    compiled once into a table indexed by the state numbers. 
+    
+    Events: entrance, leaving, poke, left_poke, right_poke, correct_poke
+    and incorrect_poke, the last two relative to the trial's reward 
+    position.
+    
+    Actions:
+        trial                   allocate the reward position of the next
+                                trial and shuffle its cue
+        start                   record the reward position, the trial 
+                                begins
+        clear                   clear the nose pokes
+        write TEXT              write TEXT, formatted with the trial's 
+                                fields i, correct, incorrect, outcome and t
+        record EVENT [VALUE]    record EVENT in the event log
+        play DEVICE DURATION [OFFSET]
+                                play a device for DURATION seconds
+        group DEVICES DURATION [DELAY]
+                                play the devices together, DELAY seconds
+                                later (default 0)
+        timer                   start the response timer
+        reward DEVICE DURATION EVENT TIMEOUT
+                                play the device as soon as EVENT occurs,
+                                within TIMEOUT seconds
+        outcome LABEL [TIME]    record and write the trial outcome with
+                                the response time (default: time since
+                                the timer was started)
+        done                    count a completed trial
+        waveform DEVICE [NAME PARAMETER...]
+                                set the waveform of a light, see 
+                                LEDPlayer, or a steady light if no NAME
+    
+    Devices: speaker, cue speaker, left light, right light, left 
+    dispenser, right dispenser, and the trial's light (above the no 
+    reward port) and dispenser (of the reward port).
+    '''
+    
+    events = ("entrance", "leaving", "poke", "left_poke", "right_poke", 
+              "correct_poke", "incorrect_poke")
+    
+    # minimum and maximum number of arguments of each action
+    actions = { "trial"   : (0, 0),
+                "start"   : (0, 0),
+                "clear"   : (0, 0),
+                "write"   : (1, 1),
+                "record"  : (1, 2),
+                "play"    : (2, 3),
+                "group"   : (2, 3),
+                "timer"   : (0, 0),
+                "reward"  : (4, 4),
+                "outcome" : (1, 2),
+                "done"    : (0, 0),
+                "waveform": (1, 4) }
+    
+    # positions of the numeric arguments of each action: VALUE, DURATION,
+    # OFFSET, DELAY, TIMEOUT, TIME and the waveforms' parameters
+    numbers = { "record"  : (1,),
+                "play"    : (1, 2),
+                "group"   : (1, 2),
+                "reward"  : (1, 3),
+                "outcome" : (1,),
+                "waveform": (2, 3) }
+    
+    devices = ("speaker", "cue speaker", "left light", "right light", 
+               "left dispenser", "right dispenser", "light", "dispenser")
+    
+    # sample trial's fields, that the texts written are checked with
+    fields = dict(i=0, correct="left", incorrect="right", outcome="correct", 
+                  t=0.)
+    
+    def __init__(self, description):
+        '''
+        description     dict describing the states, see above. Raises 
+                        ValueError if it is not valid.
+        '''
+        
+        states = description.get("states")
+        if not states:
+            raise ValueError("no state defined")
+        self.names = list(states)
+        index = dict( (name, i) for i, name in enumerate(self.names) )
+        
+        def target(name):
+            if name not in index:
+                raise ValueError("unknown state: {}".format(name))
+            return index[name]
+        
+        # the first state
+        self.initial = target(description.get("initial", self.names[0]))
+        
+        # one row per state: (name, actions, transitions, timeout, next),
+        # transitions being (event, state) pairs and timeout a (duration, 
+        # state) pair
+        self.table = []
+        for name in self.names:
+            state = states[name]
+            unknown = set(state) - set(("do", "on", "after", "next"))
+            if unknown:
+                raise ValueError("unknown key in state {}: {}".format(
+                                 name, ", ".join(sorted(unknown))))
+            actions = tuple( self.action(name, a) 
+                             for a in state.get("do", ()) )
+            transitions = []
+            if not isinstance(state.get("on", {}), dict):
+                raise ValueError("invalid 'on' in state {}: {!r}".format(
+                                 name, state["on"]))
+            for event, to in state.get("on", {}).items():
+                if event not in self.events:
+                    raise ValueError("unknown event in state {}: {}".format(
+                                     name, event))
+                transitions.append((event, target(to)))
+            timeout = None
+            if "after" in state:
+                after = state["after"]
+                if not isinstance(after, (list, tuple)) or len(after) != 2 or \
+                   isinstance(after[0], bool) or \
+                   not isinstance(after[0], (int, float)):
+                    raise ValueError("invalid 'after' in state {}: {!r}"
+                                     "".format(name, after))
+                duration, to = after
+                timeout = (float(duration), target(to))
+            then = None
+            if "next" in state:
+                if transitions or timeout is not None:
+                    raise ValueError("state {} has both 'next' and events "
+                                     "or timeout".format(name))
+                then = target(state["next"])
+            elif not transitions and timeout is None:
+                raise ValueError("state {} has no way out".format(name))
+            self.table.append((name, actions, tuple(transitions), timeout, 
+                               then))
+    
+    def action(self, state, action):
+        '''
+        Checks an action's name, number of arguments, numeric arguments 
+        and devices, and returns it as a (name, arguments) pair.
+        '''
+        
+        name, args = action[0], tuple(action[1:])
+        if name not in self.actions:
+            raise ValueError("unknown action in state {}: {}".format(
+                             state, name))
+        low, high = self.actions[name]
+        if not low <= len(args) <= high:
+            raise ValueError("wrong number of arguments for {} in state {}"
+                             "".format(name, state))
+        
+        # e.g. a duration given as a string would only fail when played
+        for i in self.numbers.get(name, ()):
+            if i < len(args) and (isinstance(args[i], bool) or 
+                                  not isinstance(args[i], (int, float))):
+                raise ValueError("invalid number for {} in state {}: {!r}"
+                                 "".format(name, state, args[i]))
+        
+        # e.g. an unknown field would only fail at the first trial
+        if name == "write":
+            try:
+                args[0].format(**self.fields)
+            except (AttributeError, LookupError, TypeError, ValueError) as e:
+                raise ValueError("invalid text for write in state {}: {!r}"
+                                 " ({!r})".format(state, args[0], e))
+        if name == "waveform" and (args[0] not in ("light", "left light", 
+                                                   "right light") or 
+                len(args) > 1 and LEDPlayer.waveforms.get(args[1]) != 
+                len(args) - 2):
+            raise ValueError("invalid waveform in state {}: {}".format(
+                             state, " ".join(map(str, args))))
+        if name in ("play", "reward", "waveform"):
+            devices = [args[0]]
+        elif name == "group":
+            devices = args[0]
+        else:
+            devices = []
+        for device in devices:
+            if device not in self.devices:
+                raise ValueError("unknown device in state {}: {}".format(
+                                 state, device))
+        if name == "reward" and args[2] not in self.events:
+            raise ValueError("unknown event in state {}: {}".format(
+                             state, args[2]))
+        return (name, args)
+
+# the two-alternative choice protocol: white noise at the mouse entrance, 
+# the light above the no reward port and the cue tones 1 second later, 
+# then 10 seconds to poke and 5 (correct) or 15 seconds between trials
+PROTOCOL = {
+    "initial": "trial",
+    "states": {
+        "trial": {
+            "do": [["trial"]],
+            "next": "waiting" },
+        "waiting": {
+            "on": {"entrance": "noise"} },
+        "noise": {
+            "do": [["clear"],
+                   ["write", "Starting trial #{i:04d}: reward on the "
+                             "{correct}\n"],
+                   ["start"],
+                   ["play", "speaker", 1],
+                   ["group", ["light", "cue speaker"], 1, 1.0]],
+            "after": [1.0, "cue"] },
+        "cue": {
+            "do": [["record", "cue"],
+                   ["write", "#{i:04d}: light on the {incorrect}\n"],
+                   ["write", "#{i:04d}: tone played\n"],
+                   ["timer"],
+                   ["reward", "dispenser", 1, "correct_poke", 10.0]],
+            "on": {"correct_poke": "correct", 
+                   "incorrect_poke": "incorrect"},
+            "after": [10.0, "time out"] },
+        "correct": {
+            "do": [["write", "#{i:04d}: Cheerio on the {correct}\n"],
+                   ["outcome", "correct"]],
+            "on": {"leaving": "short interval"} },
+        "incorrect": {
+            "do": [["outcome", "incorrect"]],
+            "on": {"leaving": "long interval"} },
+        "time out": {
+            "do": [["outcome", "time out", 10.0]],
+            "on": {"leaving": "long interval"} },
+        "short interval": {
+            "do": [["write", "#{i:04d}: mouse out... \n"], ["done"]],
+            "after": [5, "next"] },
+        "long interval": {
+            "do": [["write", "#{i:04d}: mouse out... \n"], ["done"]],
+            "after": [15, "next"] },
+        "next": {
+            "do": [["write", "-- waiting for the next trial.\n"]],
+            "next": "trial" } } }
+
+class Rig(object):
+    '''
+    A two-alternative choice maze: its monitoring server, LEDs, speaker, 
+    reward dispensers and trials. The protocol runs in a thread of its 
+    own, so that several rigs can share the same process.
+    '''
+    
+    def __init__(self, address, port, left_pin, right_pin, channel=None, 
+                 name=None, log=None, protocol=None, tape=None, pwm=False,
+                 dispenser=None, pulses=(1, 0.05, 0.05), pokes=None, 
+                 dedup=0.5, stats=None, threads=False, trials=None):
+        '''
+        address     IPv4 address the monitoring server listens to
+        port        port the monitoring server listens to
+        left_pin    GPIO pin of the left LED
+        right_pin   GPIO pin of the right LED
+        channel     pygame's mixer channel playing the sounds, to be 
+                    distinct from the other rigs' (default None, any 
+                    free channel)
+        name        prefix of the output lines (default None)
+        log         EventLog recording the rig's events (default None)
+        protocol    Protocol run by the rig (default None, the 
+                    two-alternative choice protocol)
+        tape        prefix of the file recording the raw flags received 
+                    (default None)
+        pwm         drive the LEDs with PWM, to dim them (default False)
+        dispenser   GPIO pins of the left and right dispensers' outputs, 
+                    optionally followed by those of their sensors 
+                    (default None, no dispenser)
+        pulses      number of pulses driving the dispensers, duration of
+                    each pulse and between pulses, in seconds (default
+                    (1, 0.05, 0.05))
+        pokes       GPIO pins of the left and right nose poke detectors 
+                    (default None, pokes received from the client only)
+        dedup       a poke received from both the detectors and the 
+                    client within dedup seconds is applied once (default
+                    0.5)
+        stats       Stats recording the latency of the pipeline's stages
+                    (default None)
+        threads     play each controller from its own thread instead of
+                    the scheduler's thread (default False)
+        trials      Trials allocating the reward positions (default None,
+                    random positions)
+        '''
+        
+        self.address, self.port = address, port
+        self.channel = channel
+        self.prefix = "" if name is None else "[{}] ".format(name)
+        self.log = None if log is None else log.recorder(port)
+        self.tape = None if tape is None else "{}.{}.csv".format(tape, port)
+        
+        # LED objects returned by gpiozero.LED(...) or gpiozero.PWMLED(...)
+        LED = gpiozero.PWMLED if pwm else gpiozero.LED
+        self.left_LED = LED(left_pin)
+        self.right_LED = LED(right_pin)
+        
+        # dispensers' outputs and sensors, by side
+        self.outputs, self.sensors = {}, {}
+        if dispenser is not None:
+            for i, side in enumerate(("left", "right")):
+                self.outputs[side] = gpiozero.DigitalOutputDevice(
+                                     dispenser[i])
+                if len(dispenser) > 2:
+                    self.sensors[side] = gpiozero.DigitalInputDevice(
+                                         dispenser[i+2])
+        self.pulses = pulses
+        
+        # nose poke detectors
+        self.pokes = [] if pokes is None else [ 
+            NosePokeInput(pokes[0], Monitor.LEFT_NOSE_POKE),
+            NosePokeInput(pokes[1], Monitor.RIGHT_NOSE_POKE) ]
+        self.dedup = dedup
+        self.stats = stats
+        self.threads = threads
+        
+        # an instance of the protocol
+        self.trials = Trials() if trials is None else trials
+        
+        # statistics of the trials, served by the monitoring server
+        self.session = SessionStats()
+        self.protocol = Protocol(PROTOCOL) if protocol is None else protocol
+        
+        # the devices, the current trial's fields (see Protocol), its 
+        # pending rewards and response timer, set when the protocol runs
+        self.devices = {}
+        self.bank = self.tones = None
+        self.fields = {}
+        self.triggers = []
+        self.timer = None
+        
+        # the monitoring server and the stimulus scheduler, set when the 
+        # protocol starts
+        self.monitor = None
+        self.scheduler = None
+        
+        # number of completed trials and protocol start and end times, on
+        # the rig's clock
+        self.completed = 0
+        self.t0 = self.t1 = None
+        
+        # the clock timing the protocol
+        self.clock = CLOCK
+        
+        # number of exits of each state, sum and maximum of their lateness
+        self.timing = {}
+        
+        # the protocol's thread, and the exception that stopped it if any
+        self.t = None
+        self.error = None
+    
+    def start(self, bank, white_noise, tones):
+        '''
+        Starts the protocol's thread. bank is the StimulusBank serving the
+        sounds, white_noise describes the sound played at the mouse 
+        entrance and tones maps each reward position to the list of sounds 
+        played in a random order as the cue.
+        '''
+        
+        self.t = Thread(target=self.guard, args=(bank, white_noise, tones))
+        self.t.start()
+    
+    def guard(self, bank, white_noise, tones):
+        '''
+        Runs the protocol, keeping the exception that stops it early, if 
+        any, before it is reported by the thread. The protocol's end time 
+        is taken however it ends.
+        '''
+        
+        try:
+            self.run(bank, white_noise, tones)
+        except Exception as e:
+            self.error = e
+            raise
+        finally:
+            self.t1 = self.clock.now()
+    
+    def end(self):
+        '''
+        Sends the stop signal to the monitoring server and waits for the 
+        protocol to end.
+        '''
+        
+        if self.monitor is not None:
+            self.monitor.update(Monitor.STOP)
+        self.t.join()
+    
+    def dispenser(self, side):
+        '''
+        Returns the controller of a side's dispenser, a MockController if
+        the rig has none.
+        '''
+        
+        if side not in self.outputs:
+            return MockController()
+        return DispenserPlayer(self.outputs[side], self.sensors.get(side),
+                               *self.pulses)
+    
+    def write(self, line):
+        sys.stdout.write(self.prefix + line)
+    
+    def record(self, event, value=float('nan')):
+        if self.log is not None:
+            self.log.record("protocol", event, value)
+    
+    def report(self):
+        '''
+        Writes the trial throughput, the event latency, the timing of the
+        protocol and the dispense latency of the rig.
+        '''
+        
+        now = self.clock.now()
+        elapsed = (now if self.t1 is None else self.t1) - \
+                  (now if self.t0 is None else self.t0)
+        monitor = self.monitor
+        sys.stderr.write("[i] {}{:d} trials in {:.1f}s ({:.2f} trials/min)"
+                         "\n".format(self.prefix, self.completed, elapsed,
+                         60 * self.completed / elapsed if elapsed else 0))
+        if monitor is not None and monitor.events:
+            sys.stderr.write("[i] {}{:d} events, latency: mean {:.3f}ms, "
+                             "max {:.3f}ms\n".format(self.prefix, 
+                             monitor.events, 
+                             1000 * monitor.latency_sum / monitor.events,
+                             1000 * monitor.latency_max))
+        if self.pokes and monitor is not None:
+            sys.stderr.write("[i] {}{:d} pokes detected, {:d} duplicates "
+                             "dropped\n".format(self.prefix, 
+                             sum( d.pokes for d in self.pokes ), 
+                             monitor.duplicates))
+        if self.scheduler is not None and self.scheduler.fired:
+            sys.stderr.write("[i] {}{:d} cues, light/tone skew: mean {:.3f}ms, "
+                             "max {:.3f}ms\n".format(self.prefix, 
+                             self.scheduler.fired, 
+                             1000 * self.scheduler.skew_sum / self.scheduler.fired,
+                             1000 * self.scheduler.skew_max))
+        for name in ("left dispenser", "right dispenser"):
+            dispenser = self.devices.get(name)
+            if not isinstance(dispenser, DispenserPlayer) or \
+               dispenser.sensor is None:
+                continue
+            sys.stderr.write("[i] {}{}: {:d} delivered, {:d} missed, "
+                             "latency: mean {:.3f}ms, max {:.3f}ms\n".format(
+                             self.prefix, name, dispenser.delivered, 
+                             dispenser.missed, 1000 * dispenser.latency_sum / 
+                             max(dispenser.delivered, 1), 
+                             1000 * dispenser.latency_max))
+        if isinstance(self.trials, AdaptiveTrials):
+            self.trials.report(self.prefix)
+        for state, (n, total, highest) in self.timing.items():
+            sys.stderr.write("[i] {}state {}: {:d} exits, lateness: mean "
+                             "{:.3f}ms, max {:.3f}ms\n".format(self.prefix, 
+                             state, n, 1000 * total / n, 1000 * highest))
+    
+    def run(self, bank, white_noise, tones):
+        
+        # create an instance of the monitoring server, open connection to 
+        # receive signals from 2ac_client.py, create a Controller class 
+        # instance for each control to be run in parallel
+        self.monitor = Monitor(address=self.address, port=self.port)
+        self.monitor.stats = self.stats
+        self.monitor.session = self.session
+        if self.pokes:
+            self.monitor.dedup = self.dedup
+        if self.tape is not None:
+            self.monitor.tape = open(self.tape, "w")
+            self.monitor.tape.write("time,connection,protocol,flag\n")
         
-        # Command queue
-        self.Q = Queue()
-       
-        # the thread running the command sequences
-        self.t = Thread(target=self.player, args=())
+        # the controllers are played by the scheduler's thread, unless 
+        # each has its own thread
+        self.scheduler = Scheduler(self.log, self.stats)
+        shared = None if self.threads else self.scheduler
+        self.t0 = self.clock.now()
+        with self.monitor as monitor,                                   \
+             self.scheduler,                                            \
+             LEDPlayer(self.left_LED).attach(shared) as L_light,        \
+             LEDPlayer(self.right_LED).attach(shared) as R_light,       \
+             self.dispenser("right").attach(shared) as R_dispenser,     \
+             self.dispenser("left").attach(shared) as L_dispenser,      \
+             SoundPlayer(bank.get(*white_noise), 
+                         self.channel).attach(shared) as speaker,       \
+             SoundPlayer(None, self.channel).attach(shared) as cue_speaker:
         
-        # a stop value
-        self.stop = Event()
+            # record the devices' activity
+            if self.log is not None:
+                monitor.log = self.log
+                for name, controller in (("left light", L_light),
+                                         ("right light", R_light),
+                                         ("left dispenser", L_dispenser),
+                                         ("right dispenser", R_dispenser),
+                                         ("speaker", speaker),
+                                         ("cue speaker", cue_speaker)):
+                    controller.log, controller.name = self.log, name
+            for controller in (L_light, R_light, L_dispenser, R_dispenser,
+                               speaker, cue_speaker):
+                controller.stats = self.stats
+            
+            # display connection info
+            sys.stderr.write("[i] {}listening to {}:{}\n".format(
+                             self.prefix, monitor.address, monitor.port))
+                             
+            # apply the pokes of the detectors
+            for detector in self.pokes:
+                detector.attach(monitor)
+            
+            # the devices played by the protocol, the trial's light and
+            # dispenser being set at each trial
+            self.devices = { "speaker"         : speaker,
+                             "cue speaker"     : cue_speaker,
+                             "left light"      : L_light,
+                             "right light"     : R_light,
+                             "left dispenser"  : L_dispenser,
+                             "right dispenser" : R_dispenser }
+            self.bank, self.tones = bank, tones
+                
+            # run the protocol until the stop signal
+            self.execute(self.protocol)
+            for detector in self.pokes:
+                detector.detach()
+        if self.monitor.tape is not None:
+            self.monitor.tape.close()
+                
+    def compile(self, protocol):
+        '''
+        Returns the protocol's table with the actions and the events bound
+        to the rig's methods.
+        '''
+
+        table = []
+        for name, actions, transitions, timeout, then in protocol.table:
+            actions = tuple( (getattr(self, "do_" + action), args)
+                             for action, args in actions )
+            transitions = tuple( (getattr(self, "is_" + event), to)
+                                 for event, to in transitions )
+            table.append((name, actions, transitions, timeout, then))
+        return table
+                
+    def execute(self, protocol):
+        '''
+        Runs the protocol's state machine. Waits for the monitor events 
+        and the timeouts of each state without polling, and measures the
+        lateness of each transition: from the monitor's state transition
+        for the events, from the intended deadline for the timeouts.
+        '''
+                
+        table = self.compile(protocol)
+        monitor, clock = self.monitor, self.clock
+        state = protocol.initial
+        while monitor.running():
+            name, actions, transitions, timeout, then = table[state]
+            entered = clock.now()
+            for action, args in actions:
+                action(*args)
+            if then is not None:
+                state = then
+                continue
+                
+            # wait for an event, until the timeout's deadline
+            ready = lambda: next(( (to,) for event, to in transitions 
+                                   if event() ), None)
+            if timeout is None:
+                fired = monitor.wait_for(ready)
+            else:
+                deadline = entered + timeout[0]
+                fired = monitor.wait_for(ready, 
+                            max(0, deadline - clock.now() - clock.spin))
+                if not fired:
+                    clock.wait_until(deadline, monitor.stop)
+                    fired = ready()
+            if not monitor.running(): break
+            now = clock.now()
+            if fired:
+                intended = max(monitor.updated, entered)
+                state = fired[0]
+            else:
+                intended = deadline
+                state = timeout[1]
+            self.measure(name, now - intended)
+            if self.stats is not None:
+                self.stats.record("reaction" if fired else "timeout", 
+                                  now - intended)
+                
+    def measure(self, state, lateness):
+        '''
+        Records the lateness of a state's exit.
+        '''
+
+        n, total, highest = self.timing.get(state, (0, 0., 0.))
+        self.timing[state] = (n + 1, total + lateness, max(highest, lateness))
+        self.record("exit " + state, lateness)
+                
+    def is_entrance(self):
+        return self.monitor.in_trial_zone.is_set()
+                
+    def is_leaving(self):
+        return not self.monitor.in_trial_zone.is_set()
+                
+    def is_poke(self):
+        return self.monitor.nose_poke_side() != "none"
+                
+    def is_left_poke(self):
+        return self.monitor.left_nose_poke.is_set()
+                
+    def is_right_poke(self):
+        return self.monitor.right_nose_poke.is_set()
+                
+    # the reward's trigger and the outcome are both decided by the first 
+    # poke, so that a later poke on the other side cannot score a 
+    # rewarded trial as incorrect
+    def is_correct_poke(self):
+        return self.monitor.first_poke == self.fields["correct"]
+    
+    def is_incorrect_poke(self):
+        return self.monitor.first_poke == self.fields["incorrect"]
+    
+    def do_trial(self):
         
-    def on(self):
-        return self.sound.play() if self.sound is not None else None
+        # get the trial number and reward position
+        i, correct = self.trials.next()
+        incorrect = "right" if correct == "left" else "left"
+        self.fields = dict(i=i, correct=correct, incorrect=incorrect,
+                           outcome=None, t=None)
+        self.devices["light"] = self.devices[incorrect + " light"]
+        self.devices["dispenser"] = self.devices[correct + " dispenser"]
+        tone = list(self.tones[correct])
+        self.trials.rng.shuffle(tone)
+        self.devices["cue speaker"].sound = self.bank.sequence(tone)
+    
+    def do_start(self):
+        if self.log is not None:
+            self.log.trial = self.fields["i"]
+        self.record("reward " + self.fields["correct"])
+    
+    def do_clear(self):
+        self.monitor.clear_nose_poke()
+    
+    def do_write(self, text):
+        self.write(text.format(**self.fields))
+    
+    def do_record(self, event, value=float('nan')):
+        self.record(event, value)
+    
+    def do_play(self, device, duration, offset=.0):
+        self.devices[device].play(duration, offset)
+    
+    def do_group(self, devices, duration, delay=.0):
+        self.scheduler.play([ (self.devices[device], duration)
+                              for device in devices ], delay)
+    
+    def do_timer(self):
+        self.timer = self.clock.now()
+    
+    def do_reward(self, device, duration, event, timeout):
+        device = self.devices[device]
+        self.triggers.append(self.monitor.when(getattr(self, "is_" + event), 
+            lambda: device.play(duration), timeout=timeout))
+    
+    def do_outcome(self, outcome, t=None):
         
-    def off(self):
-        return self.sound.stop() if self.sound is not None else None
+        # the pending rewards are dropped with the trial's outcome
+        for trigger in self.triggers:
+            self.monitor.discard(trigger)
+        self.triggers = []
+        
+        if t is None:
+            t = self.clock.now() - self.timer
+        self.fields.update(outcome=outcome, t=t)
+        self.record(outcome, t)
+        self.session.record(outcome, t)
+        
+        # the side chosen by the mouse, if any, for adaptive trials
+        choice = self.fields[outcome] if outcome in ("correct", 
+                                                     "incorrect") else None
+        self.trials.record(self.fields["correct"], choice, t)
+        self.write("#{:04d}: outcome: {}\n".format(self.fields["i"], outcome))
+        self.write("#{:04d}: time: {:f}s\n".format(self.fields["i"], t))
     
-    def __eq__(self, other):
-        if isinstance(other, SoundPlayer):
-            return self.wavfile == other.wavfile
+    def do_done(self):
+        self.completed += 1
 
-class Trials(object):
+    def do_waveform(self, device, *waveform):
+        self.devices[device].waveform = waveform or None
+
+class VirtualClock(Clock):
     '''
-    Yields the trial number and the reward position according to a 
-    random algorithm or an input list.
+    Simulated time for the offline simulations: the time only moves 
+    forward when a thread waits, running the actions scheduled meanwhile
+    in chronological order, so that hours of protocol take a fraction of
+    a second. Used by a single thread.
     '''
     
-    positions = ("left", "right")
+    def __init__(self):
+        Clock.__init__(self, spin=0.)
+        
+        # the current time, in seconds
+        self.time = 0.
+        
+        # heap of the scheduled actions: (time, number, action, arguments)
+        self.pending = []
+        self.counter = itertools.count()
+    
+        # actions waiting for a condition: (condition, action, arguments)
+        self.waiting = []
     
-    def __init__(self, max_repeat=3, seed=None):
+    def now(self):
+        return self.time
+    
+    def at(self, deadline, action, *args):
+        heapq.heappush(self.pending, 
+                       (deadline, next(self.counter), action, args))
+    
+    def when(self, condition, timeout, action, *args):
+        '''
+        Runs action(*args) as soon as the condition (an Event) is found 
+        set, i.e. after the clock's action setting it, or when timeout 
+        seconds have passed (None: never).
         '''
-        Returns an instance of the Trials class. 
-            
-        max_repeat  the maximum number of time the reward is allocated
-                    to the same side (default 3)
         
-        seed        random seed (default None)
+        waiting = (condition, action, args)
+        self.waiting.append(waiting)
+        if timeout is not None:
+            self.at(self.time + timeout, self.expire, waiting)
+    
+    def expire(self, waiting):
+        '''
+        Runs a waiting action whose timeout expired, unless its condition
+        was set meanwhile.
         '''
+        
+        for i, w in enumerate(self.waiting):
+            if w is waiting:
+                del self.waiting[i]
+                condition, action, args = waiting
+                action(*args)
+                return
     
-        # parameter values
-        self.max_repeat = max_repeat
-        self.seed = seed
-        if self.seed is not None: random.seed(self.seed)
+    def check(self):
+        '''
+        Runs the waiting actions whose condition is set.
+        '''
         
-        # record
-        self.buffer = []
-        self.i = 0
-        self.reward_position = None
+        if not self.waiting:
+            return
+        ready = [ w for w in self.waiting if w[0].is_set() ]
+        self.waiting = [ w for w in self.waiting if not w[0].is_set() ]
+        for condition, action, args in ready:
+            action(*args)
+    
+    def advance(self, deadline=None, until=None):
+        '''
+        Runs the actions scheduled up to the deadline (None: until there 
+        is none left) and moves the time to the deadline, or returns 
+        earlier if until() returns True. Returns True in that case.
+        '''
         
-    def next(self):
+        self.check()
+        while self.pending and (deadline is None or 
+                                self.pending[0][0] <= deadline):
+            if until is not None and until():
+                return True
+            t, n, action, args = heapq.heappop(self.pending)
+            self.time = max(self.time, t)
+            action(*args)
+            self.check()
+        if until is not None and until():
+            return True
+        if deadline is not None:
+            self.time = max(self.time, deadline)
+        return False
+    
+    def wait_until(self, deadline, interrupt=None):
+        return self.advance(deadline, 
+                            None if interrupt is None else interrupt.is_set)
+
+class SimulatedMonitor(Monitor):
+    '''
+    A Monitor without server, receiving the flags of a simulated Mouse 
+    through a VirtualClock.
+    '''
+    
+    def __init__(self, clock, address="127.0.0.1", port=13013):
+        '''
+        clock       VirtualClock
+        address     IPv4 address of the simulated maze
+        port        port of the simulated maze
+        '''
+        
+        Monitor.__init__(self, address, port)
+        self.clock = clock
+    
+    def start(self):
+        pass
+    
+    def end(self):
+        self.update(self.STOP)
+    
+    def update(self, flag, source=None):
+        known = Monitor.update(self, flag, source)
+        self.updated = self.clock.now()
+        return known
+    
+    def wait_for(self, predicate, timeout=None):
+        '''
+        Moves the virtual time forward until predicate() returns True, the
+        stop signal is received or the timeout expires. The simulation 
+        stops if nothing is left to happen.
+        '''
+        
+        deadline = None if timeout is None else self.clock.now() + timeout
+        if not self.clock.advance(deadline, 
+                lambda: predicate() or self.stop.is_set()) \
+                and deadline is None:
+            self.update(self.STOP)
+        return predicate()
+
+class SimulatedController(Controller):
+    '''
+    Plays the schedules on a VirtualClock instead of a thread, and tells
+    an observer, e.g. a simulated Mouse, when the device is switched on
+    or off.
+    '''
+    
+    def __init__(self, clock, sound=None):
+        '''
+        clock       VirtualClock
+        sound       the pygame's Sound object of a speaker (default None)
+        '''
+        
+        self.clock = clock
+        self.sound = sound
+        
+        # called as observer(name, on) when the device is switched
+        self.observer = None
+        
+        # a stop value
+        self.stop = Event()
+        
+        # number of cancellations, end of the last schedule and device 
+        # state
+        self.generation = 0
+        self.end_time = 0.
+        self.is_on = False
+    
+    def start(self):
+        pass
+    
+    def end(self):
+        self.stop.set()
+    
+    def play(self, duration, offset=.0, rest=.0, condition=None, 
+                condition_timeout=None, preempt=False):
+        if preempt:
+            self.cancel()
+        
+        # parked on the clock until the condition is set or the timeout 
+        # expires, as the GATE does for a Controller
+        if condition is not None and not condition.is_set():
+            self.clock.when(condition, condition_timeout, self.resume, 
+                            self.generation, duration, offset, rest)
+            return
+        self.resume(self.generation, duration, offset, rest)
+    
+    def resume(self, generation, duration, offset, rest):
+        '''
+        Commits a schedule to the clock, unless it was cancelled while 
+        parked.
+        '''
+        
+        if generation != self.generation or self.stop.is_set():
+            return
+        onset = max(self.clock.now(), self.end_time) + offset
+        self.end_time = onset + duration + rest
+        self.clock.at(onset, self.switch, self.generation, True)
+        self.clock.at(onset + duration, self.switch, self.generation, False)
+    
+    def cancel(self):
+        self.generation += 1
+        self.end_time = 0.
+        if self.is_on:
+            self.switch(self.generation, False)
+    
+    def switch(self, generation, on):
+        if generation != self.generation:
+            return
+        self.is_on = on
+        if self.log is not None:
+            self.log.record(self.name, "on" if on else "off", 0.)
+        if self.observer is not None:
+            self.observer(self.name, on)
+
+class SimulatedScheduler(Scheduler):
+    '''
+    Plays groups of SimulatedController together on a VirtualClock.
+    '''
+    
+    def __init__(self, clock, log=None):
+        Scheduler.__init__(self, log)
+        self.clock = clock
+    
+    def start(self):
+        pass
+    
+    def end(self):
+        self.stop.set()
+    
+    def play(self, parts, delay=.0):
+        for part in parts:
+            controller, duration = part[0], part[1]
+            offset = part[2] if len(part) > 2 else .0
+            controller.play(duration, delay + offset)
+        self.fired += 1
+        return self.clock.now() + delay
+
+class Mouse(object):
+    '''
+    A synthetic mouse for the simulations. It enters the maze after an
+    exponentially distributed absence, answers the light (above the no 
+    reward port) with a nose poke after a log-normal reaction time, on 
+    the other side with a given accuracy, or misses it, then goes out 
+    after an exponentially distributed dwell time. It stops the 
+    simulation after its last visit.
+    '''
+    
+    def __init__(self, clock, monitor, visits=100, accuracy=0.8, miss=0.05,
+                 reaction=1.0, dwell=2.0, absence=10.0, patience=15.0, 
+                 seed=None):
+        '''
+        clock       VirtualClock
+        monitor     SimulatedMonitor receiving the mouse's flags
+        visits      number of visits in the maze (default 100)
+        accuracy    probability to poke on the reward side (default 0.8)
+        miss        probability not to poke at all (default 0.05)
+        reaction    median reaction time, in seconds (default 1.0)
+        dwell       mean time spent in the maze after the nose poke, in
+                    seconds (default 2.0)
+        absence     mean time out of the maze, in seconds (default 10.0)
+        patience    time spent in the maze after a missed cue, in 
+                    seconds (default 15.0)
+        seed        seed of the mouse's random generator (default None)
+        '''
         
-        # change if lasts self.max_repeat are the same
-        if len(set(self.buffer)) == 1:
-            self.reward_position = abs(self.reward_position - 1)
+        self.clock, self.monitor = clock, monitor
+        self.visits = visits
+        self.accuracy, self.miss = accuracy, miss
+        self.reaction, self.dwell = reaction, dwell
+        self.absence, self.patience = absence, patience
+        self.random = random.Random(seed)
+        
+        # number of visits so far
+        self.visited = 0
+    
+    def send(self, t, flag):
+        self.clock.at(t, self.monitor.update, flag)
+    
+    def start(self):
+        self.come_back(self.clock.now())
+    
+    def come_back(self, t):
+        if self.visited < self.visits:
+            self.visited += 1
+            self.send(t + self.random.expovariate(1 / self.absence), 
+                      Monitor.MOUSE_IN)
+        else:
+            self.send(t + self.absence, Monitor.STOP)
+    
+    def see(self, device, on):
+        '''
+        Observer of the SimulatedController: answers the light.
+        '''
         
-        # ...or define the reward position randomly
+        if not on or device not in ("left light", "right light"):
+            return
+        now = self.clock.now()
+        if self.random.random() < self.miss:
+            out = now + self.patience
         else:
-            self.reward_position = random.randint(0,1)
+            lit = device.split()[0]
+            if self.random.random() < self.accuracy:
+                side = "right" if lit == "left" else "left"
+            else:
+                side = lit
+            t = now + self.random.lognormvariate(math.log(self.reaction), 
+                                                 0.5)
+            self.send(t, Monitor.LEFT_NOSE_POKE if side == "left" 
+                         else Monitor.RIGHT_NOSE_POKE)
+            out = t + self.random.expovariate(1 / self.dwell)
+        self.send(out, Monitor.MOUSE_OUT)
+        self.come_back(out)
+
+class SimulatedRig(Rig):
+    '''
+    A Rig whose protocol runs offline, on a VirtualClock, with simulated
+    devices and a synthetic Mouse instead of the tracking inputs. Writes
+    the same trial log as the real rig, time stamped with the virtual 
+    clock.
+    '''
+    
+    def __init__(self, address, port, left_pin, right_pin, channel=None, 
+                 name=None, log=None, protocol=None, visits=100, seed=None,
+                 pwm=False, trials=None):
+        '''
+        See Rig, and:
+        visits      number of visits of the simulated mouse (default 100)
+        seed        seed of the trials and of the mouse (default None)
+        '''
         
-        # append to buffer
-        self.buffer.append(self.reward_position)
-        self.buffer = self.buffer[-self.max_repeat:]
+        Rig.__init__(self, address, port, left_pin, right_pin, channel, 
+                     name, log, protocol, pwm=pwm, 
+                     trials=Trials(seed=seed) if trials is None else trials)
+        self.clock = VirtualClock()
+        if self.log is not None:
+            self.log.clock = self.clock
+        self.visits = visits
+        self.seed = seed
+    
+    def run(self, bank, white_noise, tones):
+        clock = self.clock
+        self.monitor = monitor = SimulatedMonitor(clock, self.address, 
+                                                  self.port)
+        self.scheduler = SimulatedScheduler(clock, self.log)
+        mouse = Mouse(clock, monitor, self.visits, 
+                      seed=None if self.seed is None else self.seed + self.port)
+        self.t0 = clock.now()
         
-        # increments the trial number
-        self.i += 1
+        # the simulated devices, watched by the mouse
+        self.devices = dict( (name, SimulatedController(clock)) 
+                             for name in ("speaker", "cue speaker", 
+                                          "left light", "right light",
+                                          "left dispenser", 
+                                          "right dispenser") )
+        self.devices["speaker"].sound = bank.get(*white_noise)
+        for name, controller in self.devices.items():
+            controller.name = name
+            controller.log = self.log
+            controller.observer = mouse.see
+        if self.log is not None:
+            monitor.log = self.log
+        self.bank, self.tones = bank, tones
         
-        # return the trial number and the reward position
-        return (self.i, self.positions[self.reward_position])                
+        # run the protocol until the mouse's last visit
+        mouse.start()
+        self.execute(self.protocol)
 
-def fader(sample_array, fade_in=0, fade_out=0):
+def fader(sample_array, fade_in=0, fade_out=0, start=0, total=None):
+    '''
+    Applies a quadratic fade in and fade out, of the given durations in
+    seconds, to a float sample array. The array is modified in place and
+    returned. When a sound is processed by blocks, start is the index of
+    the first sample of the block and total the number of samples of the
+    whole sound.
+    '''
 
     # get the sound format from the pygame's mixer
     sample_rate, format, channels = pygame.mixer.get_init()
     length = len(sample_array)
+    if total is None:
+        total = length
     
+    # the enveloppes are truncated if their length exceeds that of the 
+    # sound
     if fade_in:
-        enveloppe = np.linspace(0, 1, num=int(round(sample_rate * fade_in)))**2
-        
-        # considers only the beginning of the enveloppe if its length exceeds
-        # that of the sample array
-        if fade_in > length/sample_rate: enveloppe = enveloppe[:length]
-        sample_array = np.concatenate(( 
-            enveloppe * sample_array[:len(enveloppe)],
-            sample_array[len(enveloppe):] ))
+        enveloppe = np.linspace(0, 1, num=int(round(sample_rate * fade_in)))
+        enveloppe = enveloppe[:total][start:start+length]
+        enveloppe **= 2
+        sample_array[:len(enveloppe)] *= enveloppe
             
     if fade_out:
-        enveloppe = np.flip(np.linspace(0, 1, num=int(round(sample_rate * fade_out))),
-                            axis=0)**2
+        enveloppe = np.linspace(0, 1, num=int(round(sample_rate * fade_out)))
+        enveloppe = enveloppe[::-1][:total]
         
-        # considers only the beginning of the enveloppe if its length exceeds
-        # that of the sample array
-        if fade_out > length/sample_rate: enveloppe = enveloppe[:length]
-        sample_array = np.concatenate(( 
-            sample_array[:-len(enveloppe)],     
-            enveloppe * sample_array[-len(enveloppe):] ))
+        # index of the first faded sample in the sound, then in the block
+        first = total - len(enveloppe)
+        lo = max(first, start)
+        if lo < start + length:
+            enveloppe = enveloppe[lo-first:start+length-first]
+            enveloppe **= 2
+            sample_array[lo-start:] *= enveloppe
     
     return sample_array
 
-def whitenoise_samples(length, amplitude=1, fade_in=0, fade_out=0):
+def mixer_format():
+    '''
+    Returns the sample rate, the number of channels, whether the samples
+    are signed, the maximum amplitude and the numpy's dtype of the samples
+    of the pygame's mixer.
+    '''
     
     # get the sound format from the pygame's mixer
     sample_rate, format, channels = pygame.mixer.get_init()
     
-    # check the amplitude value
-    if amplitude < 0 or amplitude > 1:
-        raise ValueError("amplitude must be between 0 and 1")
-    
     # the maximum amplitude is the greatest positive integer value that a sample
     # can take, given the sound format
     if format < 0:
@@ -433,75 +3451,115 @@ def whitenoise_samples(length, amplitude=1, fade_in=0, fade_out=0):
         max_amplitude = 2**(format)
         dtype = np.dtype('uint' + str(format))
     
-    # --- sample array in radians
-    sample_number = int(round(sample_rate * length))
-    low = -1 if signed else 0
-    high = 1
-    sample_array = np.random.uniform(low, high, sample_number)
+    return sample_rate, channels, signed, max_amplitude, dtype
+
+def block_starts(sample_rate, length, block_length):
+    '''
+    Returns the number of samples of a sound of the given length and the
+    range of the indices of its blocks' first samples. A single block is
+    made if block_length is None.
+    '''
     
-    # --- add the fade effects
-    sample_array = fader(sample_array, fade_in, fade_out)
+    sample_number = int(round(sample_rate * length))
+    if block_length is None:
+        block_number = max(sample_number, 1)
+    else:
+        block_number = max(int(round(sample_rate * block_length)), 1)
+    return sample_number, range(0, max(sample_number, 1), block_number)
+
+def whitenoise_blocks(length, amplitude=1, fade_in=0, fade_out=0, 
+                      block_length=None):
+    '''
+    Yields the sample arrays of consecutive blocks of block_length seconds
+    of a white noise of the given length (in seconds). The whole sound is 
+    yielded at once if block_length is None.
+    '''
     
-    # --- sample array in the sound value format
-    sample_array *= max_amplitude * amplitude
+    sample_rate, channels, signed, max_amplitude, dtype = mixer_format()
     
-    # duplicates in channels
-    if channels > 1:
-        sample_array = list(zip(*[sample_array]*channels))
-    sample_array = np.array(sample_array, dtype=dtype)
+    # check the amplitude value
+    if amplitude < 0 or amplitude > 1:
+        raise ValueError("amplitude must be between 0 and 1")
     
-    return sample_array
+    sample_number, starts = block_starts(sample_rate, length, block_length)
+    low = -1 if signed else 0
+    high = 1
+    for start in starts:
+        
+        # --- sample array in radians
+        sample_array = np.random.uniform(low, high, 
+            min(starts.step, sample_number - start))
+        
+        # --- add the fade effects
+        fader(sample_array, fade_in, fade_out, start, sample_number)
+        
+        # --- sample array in the sound value format
+        sample_array *= max_amplitude * amplitude
+        
+        # duplicates in channels
+        sample_array = sample_array.astype(dtype)
+        if channels > 1:
+            sample_array = np.repeat(sample_array[:, np.newaxis], channels, 
+                                     axis=1)
+        
+        yield sample_array
 
-def sinetone_samples(frequency, length, amplitude=1, fade_in=0, fade_out=0):
+def whitenoise_samples(length, amplitude=1, fade_in=0, fade_out=0):
+    return next(whitenoise_blocks(length, amplitude, fade_in, fade_out))
+
+def sinetone_blocks(frequency, length, amplitude=1, fade_in=0, fade_out=0,
+                    block_length=None):
     '''
-    Returns an array of sample values for a sine tone of the given length 
-    (in seconds) and frequency (in Herz) an the current pygame's mixer 
-    sample rate and format. Fade in and fade out can be defined in seconds as 
-    well.
+    Yields the sample arrays of consecutive blocks of block_length seconds
+    of a sine tone of the given length (in seconds) and frequency (in 
+    Herz). The whole sound is yielded at once if block_length is None.
     '''
     
-    # get the sound format from the pygame's mixer
-    sample_rate, format, channels = pygame.mixer.get_init()
+    sample_rate, channels, signed, max_amplitude, dtype = mixer_format()
     
     # check the amplitude value
     if amplitude < 0 or amplitude > 1:
         raise ValueError("amplitude must be between 0 and 1")
     
-    # the maximum amplitude is the greatest positive integer value that a sample
-    # can take, given the sound format
-    if format < 0:
-        signed = True
-        max_amplitude = 2**(abs(format) - 1)
-        dtype = np.dtype('int' + str(abs(format)))
-    else:
-        signed = False
-        max_amplitude = 2**(format)
-        dtype = np.dtype('uint' + str(format))
-    
     # make the sample array given the length, the frequency and the sound format
     # --- parameters
-    frequency = frequency
-    length = length
     omega = 2 * np.pi * frequency
-
-    # --- sample array in radians
-    sample_number = int(round(sample_rate * length))
-    sample_array = np.sin([ omega * x/sample_rate for x in range(sample_number) ])
-    
-    # --- add the fade effects
-    sample_array = fader(sample_array, fade_in, fade_out)
     
-    # --- sample array in the sound value format
-    if not signed:
-        sample_array = (sample_array/2) + 0.5
-    sample_array *= max_amplitude * amplitude
-    
-    # duplicates in channels
-    if channels > 1:
-        sample_array = list(zip(*[sample_array]*channels))
-    sample_array = np.array(sample_array, dtype=dtype)
+    sample_number, starts = block_starts(sample_rate, length, block_length)
+    for start in starts:
+        
+        # --- sample array in radians
+        sample_array = omega * np.arange(start, 
+            min(start + starts.step, sample_number), dtype=float)
+        sample_array /= sample_rate
+        np.sin(sample_array, out=sample_array)
+        
+        # --- add the fade effects
+        fader(sample_array, fade_in, fade_out, start, sample_number)
+        
+        # --- sample array in the sound value format
+        if not signed:
+            sample_array = (sample_array/2) + 0.5
+        sample_array *= max_amplitude * amplitude
+        
+        # duplicates in channels
+        sample_array = sample_array.astype(dtype)
+        if channels > 1:
+            sample_array = np.repeat(sample_array[:, np.newaxis], channels, 
+                                     axis=1)
+        
+        yield sample_array
+
+def sinetone_samples(frequency, length, amplitude=1, fade_in=0, fade_out=0):
+    '''
+    Returns an array of sample values for a sine tone of the given length 
+    (in seconds) and frequency (in Herz) an the current pygame's mixer 
+    sample rate and format. Fade in and fade out can be defined in seconds as 
+    well.
+    '''
     
-    return sample_array
+    return next(sinetone_blocks(frequency, length, amplitude, fade_in, 
+                                fade_out))
 
 def main(argv=sys.argv):
     
@@ -515,127 +3573,148 @@ def main(argv=sys.argv):
     options = Options(argv)
     sys.argv[1:] = options.args
     
-    # create an instance of the protocol
-    trials = Trials()
-    
     ### MANUAL CONFIG ------------------------------------------------###
 
-    # GPIO pins
+    # the protocol's state machine
+    protocol = None
+    if options['protocol'] is not None:
+        try:
+            with open(options['protocol']) as f:
+                protocol = Protocol(json.load(f))
+        except (OSError, ValueError, TypeError, KeyError) as e:
+            sys.stderr.write("Error: invalid protocol: {}: {}\n".format(
+                             options['protocol'], e))
+            return 1
+    
+    # the reward positions to play first
+    sequence = None
+    if options['trials'] is not None:
+        try:
+            with open(options['trials']) as f:
+                sequence = f.read().split()
+        except OSError as e:
+            sys.stderr.write("Error: invalid trials: {}: {}\n".format(
+                             options['trials'], e))
+            return 1
+    
+    # the schedule of each rig's trials, seeded with the seed plus the 
+    # rig's port
+    seeds = [ None if options['seed'] is None else options['seed'] + rig[0]
+              for rig in options['rigs'] ]
+    try:
+        if options['schedule'] in AdaptiveTrials.schedules:
+            trials = [ AdaptiveTrials(options['max_repeat'], seed, 
+                                      window=options['block'] or 20, 
+                                      sequence=sequence)
+                       for seed in seeds ]
+        else:
+            trials = [ Trials(options['max_repeat'], seed, 
+                              options['schedule'], block=options['block'], 
+                              sequence=sequence)
+                       for seed in seeds ]
+    except ValueError as e:
+        sys.stderr.write("Error: invalid trials: {}\n".format(e))
+        return 1
+    
+    # simulations run without GPIO nor audio hardware
+    if options['simulate'] is not None:
+        from gpiozero.pins.mock import MockFactory, MockPWMPin
+        gpiozero.Device.pin_factory = MockFactory(pin_class=MockPWMPin)
+        environ.setdefault("SDL_AUDIODRIVER", "dummy")
+    
+    # GPIO pins, one rig per maze
     sys.stderr.write("[i] Initializaing LED connections...\n")
-    LEFT_LED = gpiozero.LED(20)
-    RIGHT_LED = gpiozero.LED(21)
+    several = len(options['rigs']) > 1
+    log = None if options['log'] is None else \
+          EventLog(options['log'] + ".csv")
+    stats = [ Stats(options['stats'], "[{}] ".format(rig[0])) 
+              for rig in options['rigs'] ]
+    if options['simulate'] is None:
+        rigs = [ Rig(options['address'], *rig, 
+                     name=rig[0] if several else None, log=log, 
+                     protocol=protocol, tape=options['tape'], 
+                     pwm=options['pwm'], 
+                     dispenser=options['dispensers'].get(rig[0]), 
+                     pulses=options['pulses'], 
+                     pokes=options['pokes'].get(rig[0]), 
+                     dedup=options['dedup'], stats=stats[i], 
+                     threads=options['threads'], trials=trials[i])
+                 for i, rig in enumerate(options['rigs']) ]
+    else:
+        rigs = [ SimulatedRig(options['address'], *rig, 
+                              name=rig[0] if several else None, log=log,
+                              protocol=protocol, 
+                              visits=options['simulate'], 
+                              seed=options['seed'], pwm=options['pwm'], 
+                              trials=trials[i])
+                 for i, rig in enumerate(options['rigs']) ]
+    if options['save_trials'] is not None:
+        for rig in rigs:
+            rig.trials.save("{}.{}.txt".format(options['save_trials'], 
+                                               rig.port), 
+                            options['save_length'])
     sys.stderr.write("[i] done\n")
     
     # Mixer
     sys.stderr.write("[i] Initializaing the audio mixer...\n")
     pygame.mixer.init(44100, -16, 1, 1024)
+    channels = max( rig[3] for rig in options['rigs'] ) + 1
+    if pygame.mixer.get_num_channels() < channels:
+        pygame.mixer.set_num_channels(channels)
     sys.stderr.write("[i] done\n")
     
-    # Sounds
+    # Sounds, synthesized once with every order of the cue's tones
     sys.stderr.write("[i] Composing music...\n")
-    WHITE_NOISE = whitenoise_samples(1, 0.3, 0.2, 0.2)
-    LOW_TONE = sinetone_samples(440, 0.1, 1, 0.02, 0.02)
-    HIGH_TONE = sinetone_samples(1318.51, 0.1, 1, 0.02, 0.02)
+    bank = StimulusBank(cache=options['cache'])
+    WHITE_NOISE = (whitenoise_samples, 1, 0.3, 0.2, 0.2)
+    LOW_TONE = (sinetone_samples, 440, 0.1, 1, 0.02, 0.02)
+    HIGH_TONE = (sinetone_samples, 1318.51, 0.1, 1, 0.02, 0.02)
     DISTRACTOR_TONES = [
-        sinetone_samples(987.77, 0.1, 1, 0.02, 0.02),
-        sinetone_samples(739.99, 0.1, 1, 0.02, 0.02),
-        sinetone_samples(554.37, 0.1, 1, 0.02, 0.02),
-        sinetone_samples(392.00, 0.1, 1, 0.02, 0.02)]
+        (sinetone_samples, 987.77, 0.1, 1, 0.02, 0.02),
+        (sinetone_samples, 739.99, 0.1, 1, 0.02, 0.02),
+        (sinetone_samples, 554.37, 0.1, 1, 0.02, 0.02),
+        (sinetone_samples, 392.00, 0.1, 1, 0.02, 0.02)]
     LOW_TONE_WITH_DISTRACTOR = DISTRACTOR_TONES + [LOW_TONE]
     HIGH_TONE_WITH_DISTRACTOR = DISTRACTOR_TONES + [HIGH_TONE]
+    bank.get(*WHITE_NOISE)
+    bank.prepare(LOW_TONE_WITH_DISTRACTOR)
+    bank.prepare(HIGH_TONE_WITH_DISTRACTOR)
     sys.stderr.write("[i] done\n")
     
     ### --------------------------------------------------------------###
     
+    if log is not None:
+        log.start()
+    for rig_stats in stats:
+        rig_stats.start()
     
-    # create an instance of the monitoring server, open connection to 
-    # receive signals from 2ac_client.py, create a Controller class 
-    # instance for each control to be run in parallel
-    with Monitor(address="129.194.59.156") as monitor,                              \
-         LEDPlayer(LEFT_LED) as L_light,                    \
-         LEDPlayer(RIGHT_LED) as R_light,                   \
-         MockController() as R_dispenser,                   \
-         MockController() as L_dispenser,                   \
-         SoundPlayer(pygame.mixer.Sound(WHITE_NOISE)) as speaker:
-        
-        # display connection info
-        sys.stderr.write("[i] listening to {}:{}\n".format(monitor.address, monitor.port))
-                         
-        # loop over the trials
-        while monitor.running():
-            
-            # get the trial number and reward position
-            i, correct = trials.next()
-            incorrect = "right" if correct == "left" else "left"
-            light = R_light if correct == "left" else L_light
-            dispenser = L_dispenser if correct == "left" else R_dispenser
-            tone = HIGH_TONE_WITH_DISTRACTOR if correct == "left" else LOW_TONE_WITH_DISTRACTOR
-            random.shuffle(tone)
-            tone = np.concatenate(tone)
-            
-            # wait for the mouse entrance
-            entrance = monitor.wait_for_entrance() 
-            if not monitor.running(): break
-
-            # clear the nose poke flags
-            monitor.clear_nose_poke()
-            
-            sys.stdout.write("Starting trial #{:04d}: reward on the {}\n".format(
-                             i, correct))        
-            
-            ### protocol specific --------------------------------------#
-            # at the mouse entrance in the trail zone, play 1 second of 
-            # white noise
-            speaker.play(1)
-            
-            # ... then light up the LED above the no reward port and a
-            # specific tone indicates the reward port.
-            time.sleep(1.0)
-            speaker.sound = pygame.mixer.Sound(tone)
-            
-            light.play(1)
-            sys.stdout.write("#{:04d}: light on the {}\n".format(i, incorrect))
-            
-            speaker.play(0.2*5)
-            sys.stdout.write("#{:04d}: tone played\n".format(i))
-
-            # start the timer
-            t0 = time.time() 
-            
-            # wait for the mouse nose poke
-            nose_poke = monitor.wait_for_nose_poke(timeout=10.0)
-            t = (time.time() - t0) if nose_poke else 10.0
-            
-            # define the trial outcome and dispense a reward in case of a
-            # correct answer
-            if nose_poke:
-                if monitor.nose_poke_side() == correct:
-                    outcome = "correct"
-                    dispenser.play(1)
-                    sys.stdout.write("#{:04d}: Cheerio on the {}\n".format(i, correct))
-                else:
-                    outcome = "incorrect"
-            else:
-                outcome = "time out"
-            sys.stdout.write("#{:04d}: outcome: {}\n".format(i, outcome) +
-                             "#{:04d}: time: {:f}s\n".format(i, t))
-            
-            # wait for the mouse to go out
-            monitor.wait_for_leaving()
-            sys.stdout.write("#{:04d}: mouse out... \n".format(i))
-            
-            # delay the next trial
-            if outcome == "correct":
-                time.sleep(5)
-            else:
-                time.sleep(15)
-            speaker.sound = pygame.mixer.Sound(WHITE_NOISE)
-            sys.stdout.write("-- waiting for the next trial.\n")
-            
-            ###-------------------------------------- protocol specific #
+    # run the protocol of each rig in its own thread
+    for rig in rigs:
+        rig.start(bank, WHITE_NOISE, {"left": HIGH_TONE_WITH_DISTRACTOR,
+                                      "right": LOW_TONE_WITH_DISTRACTOR})
+    try:
+        for rig in rigs:
+            rig.t.join()
+    except KeyboardInterrupt:
+        for rig in rigs:
+            rig.end()
+    
+    for rig in rigs:
+        rig.report()
+    for rig_stats in stats:
+        rig_stats.end()
+    
+    # write the last events and export them
+    if log is not None:
+        log.end()
+        log.export(options['log'] + ".npz")
     
     # return 0 if everything succeeded
-    return 0    
+    failed = [ rig for rig in rigs if rig.error is not None ]
+    for rig in failed:
+        sys.stderr.write("Error: {}protocol stopped by {!r}\n".format(
+                         rig.prefix, rig.error))
+    return 1 if failed else 0    
     
 # does not execute main if the script is imported as a module
 if __name__ == '__main__': 
@@ -22,10 +22,10 @@ NOTE
     Compatible with Python 3
 '''
 
-import getopt, sys, fileinput, socket, random, subprocess, time
+import asyncio, getopt, sys, fileinput, socket, struct, random, subprocess, time
 from os import path
 from queue import Queue
-from threading import Event, Thread
+from threading import Condition, Event, Thread
 
 HOST = '127.0.0.1'  # localhost
 PORT = 13013        # listen port
@@ -105,6 +105,18 @@ class Monitor(Device):
     LEFT_NOSE_POKE  = b'3'
     RIGHT_NOSE_POKE = b'4'
     
+    # Persistent connections start with the STREAM byte, then send frames
+    # made of a flag, a sequence number and a timestamp
+    STREAM          = b'S'
+    FRAME           = struct.Struct('!cId')
+    
+    # Legacy connections sending the STATS byte ask for the latency 
+    # statistics, and those sending the SESSION byte for the session's 
+    # statistics, that this server does not keep: they receive an empty 
+    # answer
+    STATS           = b'?'
+    SESSION         = b'='
+    
     def __init__(self, client="127.0.0.1", port=13013):
         '''
         Open a connection in a child thread, that will continuously
@@ -130,6 +142,13 @@ class Monitor(Device):
         # stop signal
         self.stop = Event()
         
+        # notified at each state transition (entry, exit, nose poke, stop)
+        self.transition = Condition()
+        
+        # the server's event loop, and its event set when stop is received
+        self.loop = None
+        self.stopping = None
+        
         # setup the server thread
         self.t = Thread(target=self.open_connection, args=())
         
@@ -144,74 +163,182 @@ class Monitor(Device):
             return "none"
     
     def clear_nose_poke(self):
-        self.left_nose_poke.clear()
-        self.right_nose_poke.clear()
+        with self.transition:
+            self.left_nose_poke.clear()
+            self.right_nose_poke.clear()
 
-    def wait_for_entrance(self, timeout=None):
-        t0 = time.time()
-        while not self.in_trial_zone.is_set():
-            t = time.time()-t0
-            if timeout is not None and t >= timeout: 
-                return False
-            if self.stop.is_set():
+    def update(self, flag):
+        '''
+        Apply a flag sent by the client app to the monitor state and wake
+        up every thread waiting for a state transition. Returns False if 
+        the flag is unknown.
+        '''
+        
+        with self.transition:
+            if flag == self.STOP:
+                if self.stop.is_set():
+                    return True
+                self.stop.set()
+                if self.loop is not None:
+                    self.loop.call_soon_threadsafe(self.stopping.set)
+            elif flag == self.MOUSE_IN:
+                self.in_trial_zone.set()
+            elif flag == self.MOUSE_OUT:
+                self.in_trial_zone.clear()
+            elif flag == self.LEFT_NOSE_POKE:
+                self.left_nose_poke.set()
+            elif flag == self.RIGHT_NOSE_POKE:
+                self.right_nose_poke.set()
+            else:
                 return False
+            self.transition.notify_all()
         return True
+    
+    def end(self):
+        '''
+        Stops the device's thread, waking up every waiting thread
+        '''
+        
+        self.update(self.STOP)
+        self.t.join()
+    
+    def wait_for(self, predicate, timeout=None):
+        '''
+        Block until predicate() returns True, the stop signal is received 
+        or the timeout (in seconds) expires. Returns the value of 
+        predicate() when waking up.
+        '''
+        
+        with self.transition:
+            self.transition.wait_for(
+                lambda: predicate() or self.stop.is_set(), timeout)
+            return predicate()
+    
+    def wait_for_entrance(self, timeout=None):
+        return self.wait_for(self.in_trial_zone.is_set, timeout)
         
     def wait_for_leaving(self, timeout=None):
-        t0 = time.time()
-        while self.in_trial_zone.is_set():
-            t = time.time()-t0
-            if timeout is not None and t >= timeout: 
-                return False
-            if self.stop.is_set():
-                return False
-        return True
+        return self.wait_for(lambda: not self.in_trial_zone.is_set(), timeout)
             
     def wait_for_nose_poke(self, timeout=None):
-        t0 = time.time()
-        while not any((self.left_nose_poke.is_set(), 
-                       self.right_nose_poke.is_set())):
-            t = time.time()-t0
-            if timeout is not None and t >= timeout:
-                return False
+        return self.wait_for(lambda: any((self.left_nose_poke.is_set(), 
+                                          self.right_nose_poke.is_set())),
+                             timeout)
+    
+    def signal(self, flag, addr):
+        '''
+        Apply a flag received from addr, stopping the monitor if the flag
+        is unknown.
+        '''
+        
+        if flag == self.STOP:
+            sys.stderr.write("Received stop signal from"
+                             " {}\n".format(addr))
+        if not self.update(flag):
+            sys.stderr.write('Error: unknown signal received from'
+                             ' {}: {}\n'.format(addr, flag))
+            self.update(self.STOP)
+    
+    async def handle(self, reader, writer):
+        '''
+        Serve a connection. A legacy connection sends a single flag that
+        is echoed back. A persistent connection starts with the STREAM 
+        byte: the flag of each complete frame received is applied and the 
+        frames are echoed back, until the client closes the connection or
+        the monitor stops.
+        '''
+        
+        addr = writer.get_extra_info('peername')
+        try:
+            data = await reader.read(1024)
+            if data in (self.STATS, self.SESSION):
+                return
+            if data[:1] != self.STREAM:
+                self.signal(data, addr)
+                
+                # echoes back the signal
+                writer.write(data)
+                await writer.drain()
+                return
+            
+            writer.get_extra_info('socket').setsockopt(
+                socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            data, expected = data[1:], None
+            while self.running():
+                
+                # many frames can arrive with a single read
+                size = len(data) - len(data) % self.FRAME.size
+                for flag, seq, timestamp in self.FRAME.iter_unpack(data[:size]):
+                    if expected is not None and seq != expected:
+                        sys.stderr.write('Warning: expected event #{} from {},'
+                                         ' received #{}\n'.format(
+                                         expected, addr, seq))
+                    expected = seq + 1
+                    self.signal(flag, addr)
+                if size:
+                    writer.write(data[:size])
+                    await writer.drain()
+                data = data[size:]
+                
+                chunk = await reader.read(4096)
+                if not chunk:
+                    break
+                data += chunk
+        except (ConnectionError, asyncio.CancelledError):
+            
+            # cancelled when the monitor stops with the connection open, 
+            # the handler ends normally (asyncio reports the cancelled 
+            # handlers of a server as errors)
+            pass
+        finally:
+            writer.close()
+    
+    async def serve(self):
+        '''
+        Accept connections from any number of clients until the stop 
+        signal is received.
+        '''
+        
+        with self.transition:
+            self.stopping = asyncio.Event()
+            self.loop = asyncio.get_running_loop()
             if self.stop.is_set():
-                return False
-        return True
+                self.stopping.set()
+        try:
+            server = await asyncio.start_server(self.handle, self.client, 
+                                                self.port)
+        except OSError as e:
+            
+            # e.g. the address is already in use: the rig stops instead 
+            # of waiting for flags that cannot arrive
+            sys.stderr.write("Error: cannot listen to {}:{}: {}\n".format(
+                             self.client, self.port, e))
+            with self.transition:
+                self.loop = None
+            self.update(self.STOP)
+            return
+        try:
+            await self.stopping.wait()
+        finally:
+            with self.transition:
+                self.loop = None
+            server.close()
+            
+            # the connections still open are closed by their handlers
+            handlers = asyncio.all_tasks() - {asyncio.current_task()}
+            for handler in handlers:
+                handler.cancel()
+            await asyncio.gather(*handlers, return_exceptions=True)
     
     def open_connection(self):
         '''
         Create a socket, listen to connection form host and port (class
-        attributes)
+        attributes). Connections are served concurrently by an asyncio 
+        event loop running in the monitor's thread.
         '''
         
-        # open the connection
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.bind((self.client, self.port))
-            s.listen()
-            while self.running():
-                conn, addr = s.accept()
-                with conn:
-                    data = conn.recv(1024)
-                    if data == self.STOP:
-                        self.stop.set()
-                        sys.stderr.write("Received stop signal from"
-                                         " {}\n".format(addr))
-                    elif data == self.MOUSE_IN:
-                        self.in_trial_zone.set()
-                    elif data == self.MOUSE_OUT:
-                        self.in_trial_zone.clear()
-                    elif data == self.LEFT_NOSE_POKE:
-                        self.left_nose_poke.set()
-                    elif data == self.RIGHT_NOSE_POKE:
-                        self.right_nose_poke.set()
-                    else:
-                        sys.stderr.write('Error: unknown signal received from'
-                                         ' {}: {}\n'.format(addr, data))
-                        self.stop.set()
-                    
-                    # echoes back the signal
-                    conn.sendall(data)
-            sys.stderr.write('Stopping...\n')
+        asyncio.run(self.serve())
+        sys.stderr.write('Stopping...\n')
             
 # for testing purpose            
 class Controller(Device):
@@ -239,14 +366,25 @@ class Controller(Device):
             condition.set()
         self.Q.put((args, offset, rest, condition, condition_timeout))
     
+    def end(self):
+        '''
+        Stops the device's thread, unblocking it with a stop sentinel
+        '''
+        
+        self.stop.set()
+        self.Q.put(None)
+        self.t.join()
+    
     def command_input(self):
         while self.running():
-            if not self.Q.empty():
-                args, offset, rest, condition, condition_timeout = self.Q.get()
-                condition.wait(condition_timeout)
-                time.sleep(offset)
-                subprocess.check_call(args)
-                time.sleep(rest)
+            schedule = self.Q.get()
+            if schedule is None:
+                break
+            args, offset, rest, condition, condition_timeout = schedule
+            condition.wait(condition_timeout)
+            time.sleep(offset)
+            subprocess.check_call(args)
+            time.sleep(rest)
 
 # for testing purpose
 class Beep(Controller):
@@ -261,9 +399,10 @@ class Beep(Controller):
 
     def command_input(self):
         while self.running():
-            if not self.Q.empty():
-                args = self.Q.get()
-                subprocess.check_call(args, shell=True)
+            args = self.Q.get()
+            if args is None:
+                break
+            subprocess.check_call(args, shell=True)
         
 class Trials(object):
     '''
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+'''
+USAGE
+    bench_client.py [OPTION]
+
+DESCRIPTION
+    Measure the end-to-end latency of the tracking events sent with
+    2ac_client.py, from the moment an event is emitted to the moment a
+    Monitor of 2ac_gpioserver.py applies it. Compares a fresh
+    2ac_client.py process per event, the way Ethovision calls it, with
+    the resident client (--daemon) reading the events from a named pipe.
+    The Monitor listens to the client's port (13013), which must be
+    free.
+
+OPTIONS
+    --events=N
+        Number of events sent with each method (default 50)
+    
+    --interval=SECONDS
+        Time between two events (default 0.05)
+    
+    --help
+        Display this message
+
+'''
+
+import getopt, sys, os, subprocess, tempfile, time
+from os import path
+from loader import HERE, load
+
+CLIENT = path.join(HERE, "2ac_client.py")
+
+class Options(dict):
+    
+    def __init__(self, argv):
+        
+        # set default
+        self.set_default()
+        
+        # handle options with getopt
+        try:
+            opts, args = getopt.getopt(argv[1:], "", ['events=', 'interval=',
+                                                     'help'])
+        except getopt.GetoptError as e:
+            sys.stderr.write(str(e) + '\n\n' + __doc__)
+            sys.exit(1)
+        
+        for o, a in opts:
+            if o == '--events':
+                self['events'] = int(a)
+            elif o == '--interval':
+                self['interval'] = float(a)
+            elif o == '--help':
+                sys.stdout.write(__doc__)
+                sys.exit(0)
+        
+        self.args = args
+    
+    def set_default(self):
+        
+        # default parameter value
+        self['events'] = 50
+        self['interval'] = 0.05
+
+def measure(monitor, send, events, interval):
+    '''
+    Send events alternating MOUSE_IN and MOUSE_OUT with send(name), and
+    return the time until the monitor applies each of them, in seconds.
+    '''
+    
+    latencies = []
+    for i in range(events):
+        entering = i % 2 == 0
+        t0 = time.perf_counter()
+        send("MOUSE_IN" if entering else "MOUSE_OUT")
+        if not monitor.wait_for(
+                lambda: monitor.in_trial_zone.is_set() == entering, 5.):
+            sys.stderr.write("Error: event #{:d} not received\n".format(i))
+            continue
+        latencies.append(time.perf_counter() - t0)
+        time.sleep(interval)
+    return latencies
+
+def write_latencies(method, latencies):
+    latencies = sorted(latencies)
+    n = len(latencies)
+    if not n:
+        return
+    sys.stdout.write("{:<10}{:>6d}{:>10.3f}{:>10.3f}{:>10.3f}{:>10.3f}\n".format(
+                     method, n, 1000 * sum(latencies) / n,
+                     1000 * latencies[n // 2],
+                     1000 * latencies[min(n - 1, n * 95 // 100)],
+                     1000 * latencies[-1]))
+
+def main(argv=sys.argv):
+    
+    options = Options(argv)
+    server, client = load("2ac_gpioserver"), load("2ac_client")
+    monitor = server.Monitor(address=client.HOST, port=client.PORT)
+    monitor.start()
+    time.sleep(0.5)
+    
+    sys.stdout.write("{:<10}{:>6}{:>10}{:>10}{:>10}{:>10}\n".format(
+                     "method", "n", "mean(ms)", "p50", "p95", "max"))
+    
+    # a fresh process per event
+    processes = []
+    latencies = measure(monitor, lambda name: processes.append(
+                        subprocess.Popen([sys.executable, CLIENT, name])),
+                        options['events'], options['interval'])
+    for process in processes:
+        process.wait()
+    write_latencies("one-shot", latencies)
+    
+    # the resident client, fed through a named pipe
+    fifo = path.join(tempfile.mkdtemp(), "events")
+    os.mkfifo(fifo)
+    connections = monitor.connections
+    process = subprocess.Popen([sys.executable, CLIENT, "--daemon", fifo])
+    with open(fifo, "w") as f:
+        
+        # wait for the daemon's connection
+        while monitor.connections == connections:
+            time.sleep(0.01)
+        
+        def send(name):
+            f.write(name + "\n")
+            f.flush()
+        
+        latencies = measure(monitor, send, options['events'],
+                            options['interval'])
+        send("STOP")
+    process.wait()
+    os.remove(fifo)
+    write_latencies("daemon", latencies)
+    
+    monitor.end()
+    return 0
+
+# does not execute main if the script is imported as a module
+if __name__ == '__main__': sys.exit(main())
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+'''
+USAGE
+    bench_monitor.py [OPTION]
+
+DESCRIPTION
+    Measure the CPU used by a protocol waiting for the mouse in a
+    Monitor of 2ac_gpioserver.py, and the wake-up latency of the wait,
+    from the moment the flag is applied to the moment the waiting
+    thread returns. Compares the former polling loop, spinning on the
+    monitor's Events, with the monitor's condition variable. The flags
+    are applied with Monitor.update(), no connection is opened.
+
+OPTIONS
+    --rounds=N
+        Number of waits measured with each method (default 50)
+    
+    --delay=SECONDS
+        Time a thread waits before the flag is applied (default 0.1)
+    
+    --help
+        Display this message
+
+'''
+
+import getopt, sys, time
+from threading import Thread
+from loader import load
+
+class Options(dict):
+    
+    def __init__(self, argv):
+        
+        # set default
+        self.set_default()
+        
+        # handle options with getopt
+        try:
+            opts, args = getopt.getopt(argv[1:], "", ['rounds=', 'delay=',
+                                                     'help'])
+        except getopt.GetoptError as e:
+            sys.stderr.write(str(e) + '\n\n' + __doc__)
+            sys.exit(1)
+        
+        for o, a in opts:
+            if o == '--rounds':
+                self['rounds'] = int(a)
+            elif o == '--delay':
+                self['delay'] = float(a)
+            elif o == '--help':
+                sys.stdout.write(__doc__)
+                sys.exit(0)
+        
+        self.args = args
+    
+    def set_default(self):
+        
+        # default parameter value
+        self['rounds'] = 50
+        self['delay'] = 0.1
+
+def polling_wait_for_entrance(monitor, timeout=None):
+    '''
+    The former Monitor.wait_for_entrance, spinning on the monitor's
+    Events.
+    '''
+    
+    t0 = time.time()
+    while not monitor.in_trial_zone.is_set():
+        t = time.time()-t0
+        if timeout is not None and t >= timeout:
+            return False
+        if monitor.stop.is_set():
+            return False
+    return True
+
+def measure(monitor, wait, rounds, delay):
+    '''
+    Apply MOUSE_IN while a thread is blocked in wait(monitor, timeout),
+    rounds times. Returns the CPU used by the process over the rounds, as
+    a fraction of the elapsed time, and the wake-up latencies in seconds.
+    '''
+    
+    latencies = []
+    cpu0, wall0 = time.process_time(), time.perf_counter()
+    for i in range(rounds):
+        monitor.update(monitor.MOUSE_OUT)
+        woken = []
+        waiter = Thread(target=lambda: woken.append(
+                        (wait(monitor, 5.), time.perf_counter())))
+        waiter.start()
+        time.sleep(delay)
+        t0 = time.perf_counter()
+        monitor.update(monitor.MOUSE_IN)
+        waiter.join()
+        entered, t = woken[0]
+        if not entered:
+            sys.stderr.write("Error: wait #{:d} timed out\n".format(i))
+            continue
+        latencies.append(t - t0)
+    cpu = (time.process_time() - cpu0) / (time.perf_counter() - wall0)
+    return cpu, latencies
+
+def write_latencies(method, cpu, latencies):
+    latencies = sorted(latencies)
+    n = len(latencies)
+    if not n:
+        return
+    sys.stdout.write("{:<10}{:>6d}{:>8.1f}{:>10.3f}{:>10.3f}{:>10.3f}{:>10.3f}"
+                     "\n".format(method, n, 100 * cpu,
+                     1000 * sum(latencies) / n, 1000 * latencies[n // 2],
+                     1000 * latencies[min(n - 1, n * 95 // 100)],
+                     1000 * latencies[-1]))
+
+def main(argv=sys.argv):
+    
+    options = Options(argv)
+    server = load("2ac_gpioserver")
+    monitor = server.Monitor()
+    
+    sys.stdout.write("{:<10}{:>6}{:>8}{:>10}{:>10}{:>10}{:>10}\n".format(
+                     "method", "n", "cpu(%)", "mean(ms)", "p50", "p95",
+                     "max"))
+    for method, wait in (("polling", polling_wait_for_entrance),
+                         ("condition", server.Monitor.wait_for_entrance)):
+        cpu, latencies = measure(monitor, wait, options['rounds'],
+                                 options['delay'])
+        write_latencies(method, cpu, latencies)
+    return 0
+
+# does not execute main if the script is imported as a module
+if __name__ == '__main__': sys.exit(main())
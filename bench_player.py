@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+'''
+USAGE
+    bench_player.py [OPTION]
+
+DESCRIPTION
+    Measure the CPU used by idle controllers of 2ac_gpioserver.py and the
+    jitter between a play() call and the controller's on() call. Compares
+    the former player, polling its queue, with the player blocking on
+    its queue. The controllers are MockControllers, each run by its own
+    thread.
+
+OPTIONS
+    --controllers=N
+        Number of idle controllers, as many as in a rig (default 5)
+    
+    --idle=SECONDS
+        Time the controllers stay idle while their CPU is measured
+        (default 2)
+    
+    --plays=N
+        Number of schedules played to measure the jitter (default 50)
+    
+    --interval=SECONDS
+        Time between two schedules (default 0.05)
+    
+    --help
+        Display this message
+
+'''
+
+import getopt, sys, time
+from threading import Event, Thread
+from loader import load
+
+class Options(dict):
+    
+    def __init__(self, argv):
+        
+        # set default
+        self.set_default()
+        
+        # handle options with getopt
+        try:
+            opts, args = getopt.getopt(argv[1:], "", ['controllers=', 'idle=',
+                                                     'plays=', 'interval=',
+                                                     'help'])
+        except getopt.GetoptError as e:
+            sys.stderr.write(str(e) + '\n\n' + __doc__)
+            sys.exit(1)
+        
+        for o, a in opts:
+            if o == '--controllers':
+                self['controllers'] = int(a)
+            elif o == '--idle':
+                self['idle'] = float(a)
+            elif o == '--plays':
+                self['plays'] = int(a)
+            elif o == '--interval':
+                self['interval'] = float(a)
+            elif o == '--help':
+                sys.stdout.write(__doc__)
+                sys.exit(0)
+        
+        self.args = args
+    
+    def set_default(self):
+        
+        # default parameter value
+        self['controllers'] = 5
+        self['idle'] = 2.
+        self['plays'] = 50
+        self['interval'] = 0.05
+
+def polling_player(controller):
+    '''
+    The former Controller.player, polling the controller's queue.
+    '''
+    
+    while controller.running():
+        if not controller.Q.empty():
+            duration, offset, rest, condition, condition_timeout = \
+                controller.Q.get()
+            condition.wait(condition_timeout)
+            time.sleep(offset)
+            controller.on()
+            time.sleep(duration)
+            controller.off()
+            time.sleep(rest)
+
+def polling_play(controller, duration):
+    '''
+    The former Controller.play, queuing a schedule for polling_player().
+    '''
+    
+    condition = Event()
+    condition.set()
+    controller.Q.put((duration, .0, .0, condition, None))
+
+class Polling(object):
+    '''
+    Runs MockControllers with the former player and play().
+    '''
+    
+    name = "polling"
+    
+    def __init__(self, server):
+        self.server = server
+    
+    def controller(self):
+        controller = self.server.MockController()
+        controller.t = Thread(target=polling_player, args=(controller,))
+        return controller
+    
+    def play(self, controller, duration):
+        polling_play(controller, duration)
+    
+    def end(self, controller):
+        
+        # the former player only checks the stop value
+        controller.stop.set()
+        controller.t.join()
+
+class Blocking(Polling):
+    '''
+    Runs MockControllers with their current player and play().
+    '''
+    
+    name = "blocking"
+    
+    def controller(self):
+        return self.server.MockController()
+    
+    def play(self, controller, duration):
+        controller.play(duration)
+    
+    def end(self, controller):
+        controller.end()
+
+def measure(method, controllers, idle, plays, interval):
+    '''
+    Returns the CPU used by the process while the controllers are idle,
+    as a fraction of the elapsed time, and the time from each play() call
+    to the on() call, in seconds.
+    '''
+    
+    devices = [ method.controller() for i in range(controllers) ]
+    onsets, played = [], Event()
+    def on():
+        onsets.append(time.perf_counter())
+        played.set()
+    devices[0].on = on
+    for device in devices:
+        device.start()
+    time.sleep(0.1)
+    
+    cpu0, wall0 = time.process_time(), time.perf_counter()
+    time.sleep(idle)
+    cpu = (time.process_time() - cpu0) / (time.perf_counter() - wall0)
+    
+    jitters = []
+    for i in range(plays):
+        played.clear()
+        t0 = time.perf_counter()
+        method.play(devices[0], interval / 2)
+        if not played.wait(5.):
+            sys.stderr.write("Error: schedule #{:d} not played\n".format(i))
+            continue
+        jitters.append(onsets.pop() - t0)
+        time.sleep(interval)
+    for device in devices:
+        method.end(device)
+    return cpu, jitters
+
+def write_jitters(method, controllers, cpu, jitters):
+    jitters = sorted(jitters)
+    n = len(jitters)
+    if not n:
+        return
+    sys.stdout.write("{:<10}{:>6d}{:>10.1f}{:>10.3f}{:>10.3f}{:>10.3f}{:>10.3f}"
+                     "\n".format(method, n, 100 * cpu / controllers,
+                     1000 * sum(jitters) / n, 1000 * jitters[n // 2],
+                     1000 * jitters[min(n - 1, n * 95 // 100)],
+                     1000 * jitters[-1]))
+
+def main(argv=sys.argv):
+    
+    options = Options(argv)
+    server = load("2ac_gpioserver")
+    
+    sys.stdout.write("{:<10}{:>6}{:>10}{:>10}{:>10}{:>10}{:>10}\n".format(
+                     "method", "n", "cpu(%)/c", "mean(ms)", "p50", "p95",
+                     "max"))
+    for method in (Polling(server), Blocking(server)):
+        cpu, jitters = measure(method, options['controllers'],
+                               options['idle'], options['plays'],
+                               options['interval'])
+        write_jitters(method.name, options['controllers'], cpu, jitters)
+    return 0
+
+# does not execute main if the script is imported as a module
+if __name__ == '__main__': sys.exit(main())
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+
+'''
+USAGE
+    bench_server.py [OPTION]
+
+DESCRIPTION
+    Load test of the Monitor's server of 2ac_gpioserver.py: many local
+    clients send flags as fast as they are echoed back, and the
+    throughput and the round trip times of the flags are reported.
+    Compares the former server, accepting one connection at a time from
+    a blocking loop, with the asyncio server, receiving either a
+    connection per flag (legacy) or the frames of persistent connections
+    (stream).
+
+OPTIONS
+    --clients=N
+        Number of concurrent clients (default 20)
+    
+    --events=N
+        Number of flags sent by each client (default 200)
+    
+    --port=PORT
+        Port the servers listen to (default 13113)
+    
+    --help
+        Display this message
+
+'''
+
+import getopt, sys, socket, time
+from threading import Thread
+from loader import load
+
+HOST = "127.0.0.1"
+
+class Options(dict):
+    
+    def __init__(self, argv):
+        
+        # set default
+        self.set_default()
+        
+        # handle options with getopt
+        try:
+            opts, args = getopt.getopt(argv[1:], "", ['clients=', 'events=',
+                                                     'port=', 'help'])
+        except getopt.GetoptError as e:
+            sys.stderr.write(str(e) + '\n\n' + __doc__)
+            sys.exit(1)
+        
+        for o, a in opts:
+            if o == '--clients':
+                self['clients'] = int(a)
+            elif o == '--events':
+                self['events'] = int(a)
+            elif o == '--port':
+                self['port'] = int(a)
+            elif o == '--help':
+                sys.stdout.write(__doc__)
+                sys.exit(0)
+        
+        self.args = args
+    
+    def set_default(self):
+        
+        # default parameter value
+        self['clients'] = 20
+        self['events'] = 200
+        self['port'] = 13113
+
+def blocking_server(monitor, s):
+    '''
+    The former Monitor.open_connection, serving one connection at a time
+    from the listening socket s until the stop signal is received.
+    '''
+    
+    while monitor.running():
+        conn, addr = s.accept()
+        with conn:
+            data = conn.recv(1024)
+            monitor.update(data)
+            
+            # echoes back the signal
+            conn.sendall(data)
+
+def legacy_client(monitor, port, events, latencies):
+    '''
+    Sends each flag on a connection of its own, as 2ac_client.py without
+    --stream, and records the round trip times.
+    '''
+    
+    for i in range(events):
+        flag = monitor.MOUSE_IN if i % 2 == 0 else monitor.MOUSE_OUT
+        t0 = time.perf_counter()
+        with socket.create_connection((HOST, port)) as s:
+            s.sendall(flag)
+            s.recv(1024)
+        latencies.append(time.perf_counter() - t0)
+
+def stream_client(monitor, port, events, latencies):
+    '''
+    Sends the flags as frames of a persistent connection, as 2ac_client.py
+    with --stream, and records the round trip times.
+    '''
+    
+    with socket.create_connection((HOST, port)) as s:
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        s.sendall(monitor.STREAM)
+        for i in range(events):
+            flag = monitor.MOUSE_IN if i % 2 == 0 else monitor.MOUSE_OUT
+            t0 = time.perf_counter()
+            s.sendall(monitor.FRAME.pack(flag, i, time.time()))
+            echo = b''
+            while len(echo) < monitor.FRAME.size:
+                chunk = s.recv(monitor.FRAME.size - len(echo))
+                if not chunk:
+                    return
+                echo += chunk
+            latencies.append(time.perf_counter() - t0)
+
+def load_test(monitor, client, options):
+    '''
+    Runs the clients concurrently. Returns the elapsed time, in seconds,
+    and the round trip times of the flags.
+    '''
+    
+    latencies = [ [] for i in range(options['clients']) ]
+    clients = [ Thread(target=client, args=(monitor, options['port'],
+                options['events'], latencies[i]))
+                for i in range(options['clients']) ]
+    t0 = time.perf_counter()
+    for t in clients:
+        t.start()
+    for t in clients:
+        t.join()
+    return time.perf_counter() - t0, sum(latencies, [])
+
+def write_results(method, elapsed, latencies):
+    latencies = sorted(latencies)
+    n = len(latencies)
+    if not n:
+        return
+    sys.stdout.write("{:<10}{:>8d}{:>10.0f}{:>10.3f}{:>10.3f}{:>10.3f}{:>10.3f}"
+                     "\n".format(method, n, n / elapsed,
+                     1000 * latencies[n // 2],
+                     1000 * latencies[min(n - 1, n * 95 // 100)],
+                     1000 * latencies[min(n - 1, n * 99 // 100)],
+                     1000 * latencies[-1]))
+
+def main(argv=sys.argv):
+    
+    options = Options(argv)
+    server = load("2ac_gpioserver")
+    
+    sys.stdout.write("{:<10}{:>8}{:>10}{:>10}{:>10}{:>10}{:>10}\n".format(
+                     "method", "n", "flags/s", "p50(ms)", "p95", "p99",
+                     "max"))
+    
+    # the former server, stopped by a last connection
+    monitor = server.Monitor(HOST, options['port'])
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        
+        # the port can be reused right after the previous server
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind((HOST, options['port']))
+        s.listen()
+        t = Thread(target=blocking_server, args=(monitor, s))
+        t.start()
+        write_results("blocking", *load_test(monitor, legacy_client, options))
+        with socket.create_connection((HOST, options['port'])) as c:
+            c.sendall(monitor.STOP)
+            c.recv(1024)
+        t.join()
+    
+    # the asyncio server
+    for method, client in (("legacy", legacy_client),
+                           ("stream", stream_client)):
+        monitor = server.Monitor(HOST, options['port'])
+        monitor.start()
+        time.sleep(0.2)
+        if not monitor.running():
+            return 1
+        write_results(method, *load_test(monitor, client, options))
+        monitor.end()
+    return 0
+
+# does not execute main if the script is imported as a module
+if __name__ == '__main__': sys.exit(main())
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+'''
+USAGE
+    bench_stream.py [OPTION]
+
+DESCRIPTION
+    Measure the memory taken by the long sounds of 2ac_gpioserver.py and
+    the underruns of their playback: a white noise of each length is
+    either synthesized whole and played as a single Sound, or streamed
+    by a StreamPlayer in blocks of each size. Only the first seconds of
+    each sound are played. The peak resident memory of the process, its
+    memory before the synthesis, the number of blocks played and the
+    number of underruns (blocks not ready when the previous one ended)
+    are reported. Each sound is played in a fresh process, with SDL's
+    dummy audio driver unless SDL_AUDIODRIVER is set.
+
+OPTIONS
+    --lengths=SECONDS[,SECONDS...]
+        Lengths of the sounds (default 10,60,600)
+    
+    --blocks=SECONDS[,SECONDS...]
+        Lengths of the blocks of the streamed sounds (default 0.1,1,10)
+    
+    --play=SECONDS
+        Time each sound is played for (default 3)
+    
+    --channels=N
+        Number of channels of the mixer (default 2)
+    
+    --run=LENGTH:BLOCK
+        Only play the sound of the given length, streamed in blocks of
+        BLOCK seconds, or synthesized whole if BLOCK is whole, in the
+        current process
+    
+    --help
+        Display this message
+
+'''
+
+import getopt, sys, resource, subprocess, time
+from os import environ, path
+from loader import load
+
+class Options(dict):
+    
+    def __init__(self, argv):
+        
+        # set default
+        self.set_default()
+        
+        # handle options with getopt
+        try:
+            opts, args = getopt.getopt(argv[1:], "", ['lengths=', 'blocks=',
+                                                     'play=', 'channels=',
+                                                     'run=', 'help'])
+        except getopt.GetoptError as e:
+            sys.stderr.write(str(e) + '\n\n' + __doc__)
+            sys.exit(1)
+        
+        for o, a in opts:
+            if o == '--lengths':
+                self['lengths'] = [ float(x) for x in a.split(",") ]
+            elif o == '--blocks':
+                self['blocks'] = [ float(x) for x in a.split(",") ]
+            elif o == '--play':
+                self['play'] = float(a)
+            elif o == '--channels':
+                self['channels'] = int(a)
+            elif o == '--run':
+                try:
+                    length, block = a.split(":")
+                    self['run'] = (float(length),
+                                   None if block == "whole" else float(block))
+                except ValueError:
+                    sys.stderr.write("Error: invalid run definition: {}"
+                                     "\n\n".format(a) + __doc__)
+                    sys.exit(1)
+            elif o == '--help':
+                sys.stdout.write(__doc__)
+                sys.exit(0)
+        
+        self.args = args
+    
+    def set_default(self):
+        
+        # default parameter value
+        self['lengths'] = [10., 60., 600.]
+        self['blocks'] = [0.1, 1., 10.]
+        self['play'] = 3.
+        self['channels'] = 2
+        self['run'] = None
+
+def peak_rss():
+    '''
+    Returns the peak resident memory of the process, in MB.
+    '''
+    
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def run(length, block, play, channels):
+    '''
+    Plays the first play seconds of a white noise of the given length,
+    streamed in blocks of block seconds or synthesized whole if block is
+    None, and writes the peak resident memory, the blocks played and the
+    underruns.
+    '''
+    
+    server = load("2ac_gpioserver")
+    pygame = server.pygame
+    pygame.mixer.init(44100, -16, channels, 1024)
+    base = peak_rss()
+    if block is None:
+        sound = pygame.sndarray.make_sound(
+            server.whitenoise_samples(length, 0.3))
+        channel = pygame.mixer.Channel(0)
+        channel.play(sound)
+        time.sleep(play)
+        channel.stop()
+        played, underruns = 1, "-"
+    else:
+        player = server.StreamPlayer(lambda: server.whitenoise_blocks(
+                                     length, 0.3, block_length=block))
+        player.on()
+        time.sleep(play)
+        player.off()
+        played, underruns = player.played, player.underruns
+    pygame.mixer.quit()
+    sys.stdout.write("{:<8}{:>8g}{:>8}{:>10.1f}{:>10.1f}{:>8d}{:>10}\n".format(
+                     "whole" if block is None else "stream", length,
+                     "-" if block is None else "{:g}".format(block), base,
+                     peak_rss(), played, underruns))
+    sys.stdout.flush()
+
+def main(argv=sys.argv):
+    
+    options = Options(argv)
+    environ.setdefault("SDL_AUDIODRIVER", "dummy")
+    if options['run'] is not None:
+        run(*options['run'], options['play'], options['channels'])
+        return 0
+    
+    sys.stdout.write("{:<8}{:>8}{:>8}{:>10}{:>10}{:>8}{:>10}\n".format(
+                     "method", "length", "block", "base(MB)", "peak(MB)",
+                     "played", "underruns"))
+    sys.stdout.flush()
+    
+    # keeps pygame's greeting out of the table
+    environ["PYGAME_HIDE_SUPPORT_PROMPT"] = "1"
+    for length in options['lengths']:
+        for block in ["whole"] + options['blocks']:
+            subprocess.run([sys.executable, path.abspath(__file__),
+                            "--run={!r}:{}".format(length, block),
+                            "--play={!r}".format(options['play']),
+                            "--channels={:d}".format(options['channels'])])
+    return 0
+
+# does not execute main if the script is imported as a module
+if __name__ == '__main__': sys.exit(main())
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+'''
+USAGE
+    bench_synthesis.py [OPTION]
+
+DESCRIPTION
+    Measure the time and the peak memory taken by the synthesis of the
+    sine tones and white noises of 2ac_gpioserver.py, across sound
+    lengths, channel numbers and mixer formats. Compares the former
+    functions, building the samples from Python lists, with the
+    vectorised ones. The pygame's mixer uses SDL's dummy audio driver
+    unless SDL_AUDIODRIVER is set.
+
+OPTIONS
+    --lengths=SECONDS[,SECONDS...]
+        Lengths of the sounds (default 0.1,1,10)
+    
+    --channels=N[,N...]
+        Numbers of channels of the mixer (default 1,2)
+    
+    --formats=FORMAT[,FORMAT...]
+        Sample formats of the mixer, in pygame's notation (default -16,8)
+    
+    --repeat=N
+        Number of syntheses timed, the fastest being reported (default 3)
+    
+    --help
+        Display this message
+
+'''
+
+import getopt, sys, time, tracemalloc
+import numpy as np
+from os import environ
+from loader import load
+
+class Options(dict):
+    
+    def __init__(self, argv):
+        
+        # set default
+        self.set_default()
+        
+        # handle options with getopt
+        try:
+            opts, args = getopt.getopt(argv[1:], "", ['lengths=', 'channels=',
+                                                     'formats=', 'repeat=',
+                                                     'help'])
+        except getopt.GetoptError as e:
+            sys.stderr.write(str(e) + '\n\n' + __doc__)
+            sys.exit(1)
+        
+        for o, a in opts:
+            if o == '--lengths':
+                self['lengths'] = [ float(x) for x in a.split(",") ]
+            elif o == '--channels':
+                self['channels'] = [ int(x) for x in a.split(",") ]
+            elif o == '--formats':
+                self['formats'] = [ int(x) for x in a.split(",") ]
+            elif o == '--repeat':
+                self['repeat'] = int(a)
+            elif o == '--help':
+                sys.stdout.write(__doc__)
+                sys.exit(0)
+        
+        self.args = args
+    
+    def set_default(self):
+        
+        # default parameter value
+        self['lengths'] = [0.1, 1., 10.]
+        self['channels'] = [1, 2]
+        self['formats'] = [-16, 8]
+        self['repeat'] = 3
+
+def list_format(pygame):
+    '''
+    The former sound format computation, shared by the former functions.
+    '''
+    
+    sample_rate, format, channels = pygame.mixer.get_init()
+    if format < 0:
+        signed = True
+        max_amplitude = 2**(abs(format) - 1)
+        dtype = np.dtype('int' + str(abs(format)))
+    else:
+        signed = False
+        max_amplitude = 2**(format)
+        dtype = np.dtype('uint' + str(format))
+    return sample_rate, channels, signed, max_amplitude, dtype
+
+def list_fader(pygame, sample_array, fade_in=0, fade_out=0):
+    '''
+    The former fader, concatenating the whole array for each fade.
+    '''
+    
+    sample_rate, format, channels = pygame.mixer.get_init()
+    length = len(sample_array)
+    
+    if fade_in:
+        enveloppe = np.linspace(0, 1, num=int(round(sample_rate * fade_in)))**2
+        if fade_in > length/sample_rate: enveloppe = enveloppe[:length]
+        sample_array = np.concatenate((
+            enveloppe * sample_array[:len(enveloppe)],
+            sample_array[len(enveloppe):] ))
+    
+    if fade_out:
+        enveloppe = np.flip(np.linspace(0, 1,
+                            num=int(round(sample_rate * fade_out))), axis=0)**2
+        if fade_out > length/sample_rate: enveloppe = enveloppe[:length]
+        sample_array = np.concatenate((
+            sample_array[:-len(enveloppe)],
+            enveloppe * sample_array[-len(enveloppe):] ))
+    
+    return sample_array
+
+def list_whitenoise_samples(pygame, length, amplitude=1, fade_in=0,
+                            fade_out=0):
+    '''
+    The former whitenoise_samples, duplicating the samples in the
+    channels through a list of tuples.
+    '''
+    
+    sample_rate, channels, signed, max_amplitude, dtype = list_format(pygame)
+    sample_number = int(round(sample_rate * length))
+    low = -1 if signed else 0
+    sample_array = np.random.uniform(low, 1, sample_number)
+    sample_array = list_fader(pygame, sample_array, fade_in, fade_out)
+    sample_array *= max_amplitude * amplitude
+    if channels > 1:
+        sample_array = list(zip(*[sample_array]*channels))
+    return np.array(sample_array, dtype=dtype)
+
+def list_sinetone_samples(pygame, frequency, length, amplitude=1, fade_in=0,
+                          fade_out=0):
+    '''
+    The former sinetone_samples, computing the phases in a list
+    comprehension and duplicating the samples in the channels through a
+    list of tuples.
+    '''
+    
+    sample_rate, channels, signed, max_amplitude, dtype = list_format(pygame)
+    omega = 2 * np.pi * frequency
+    sample_number = int(round(sample_rate * length))
+    sample_array = np.sin([ omega * x/sample_rate
+                            for x in range(sample_number) ])
+    sample_array = list_fader(pygame, sample_array, fade_in, fade_out)
+    if not signed:
+        sample_array = (sample_array/2) + 0.5
+    sample_array *= max_amplitude * amplitude
+    if channels > 1:
+        sample_array = list(zip(*[sample_array]*channels))
+    return np.array(sample_array, dtype=dtype)
+
+def measure(synthesize, repeat):
+    '''
+    Returns the shortest time taken by synthesize(), in seconds, and the
+    peak of the memory it allocates, in bytes.
+    '''
+    
+    best = float('inf')
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        synthesize()
+        best = min(best, time.perf_counter() - t0)
+    tracemalloc.start()
+    synthesize()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+def main(argv=sys.argv):
+    
+    options = Options(argv)
+    environ.setdefault("SDL_AUDIODRIVER", "dummy")
+    server = load("2ac_gpioserver")
+    pygame = server.pygame
+    
+    sys.stdout.write("{:<10}{:>8}{:>4}{:>5}{:>10}{:>10}{:>8}{:>10}{:>10}"
+                     "\n".format("sound", "length", "ch", "fmt", "old(ms)",
+                     "new(ms)", "speedup", "old(MB)", "new(MB)"))
+    for format in options['formats']:
+        for channels in options['channels']:
+            pygame.mixer.quit()
+            pygame.mixer.init(44100, format, channels, 1024)
+            for length in options['lengths']:
+                fade = min(0.02, length / 4)
+                for sound, old, new in (
+                    ("sinetone",
+                     lambda: list_sinetone_samples(pygame, 440, length, 1,
+                                                   fade, fade),
+                     lambda: server.sinetone_samples(440, length, 1, fade,
+                                                     fade)),
+                    ("whitenoise",
+                     lambda: list_whitenoise_samples(pygame, length, 0.3,
+                                                     fade, fade),
+                     lambda: server.whitenoise_samples(length, 0.3, fade,
+                                                       fade))):
+                    old_time, old_peak = measure(old, options['repeat'])
+                    new_time, new_peak = measure(new, options['repeat'])
+                    sys.stdout.write("{:<10}{:>8g}{:>4d}{:>5d}{:>10.2f}"
+                                     "{:>10.2f}{:>8.1f}{:>10.2f}{:>10.2f}"
+                                     "\n".format(sound, length, channels,
+                                     format, 1000 * old_time,
+                                     1000 * new_time, old_time / new_time,
+                                     old_peak / 2**20, new_peak / 2**20))
+    pygame.mixer.quit()
+    return 0
+
+# does not execute main if the script is imported as a module
+if __name__ == '__main__': sys.exit(main())
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+'''
+USAGE
+    bench_threads.py [OPTION]
+
+DESCRIPTION
+    Compare the controllers of 2ac_gpioserver.py each run by a thread of
+    its own (--threads) with the controllers all played from a shared
+    Scheduler's thread, the default: the number of threads, the peak
+    resident memory of the process and the lateness of the on() calls
+    are reported. Each mode is run in a fresh process with as many
+    MockControllers as the rigs have controllers, all playing a schedule
+    at each round.
+
+OPTIONS
+    --rigs=N
+        Number of rigs, of 5 controllers each (default 4)
+    
+    --rounds=N
+        Number of rounds of schedules (default 50)
+    
+    --interval=SECONDS
+        Time between two rounds (default 0.05)
+    
+    --mode=MODE
+        Only run the given mode, threads or scheduler, in the current
+        process
+    
+    --help
+        Display this message
+
+'''
+
+import getopt, sys, resource, subprocess, threading, time
+from os import path
+from loader import load
+
+MODES = ("threads", "scheduler")
+
+class Options(dict):
+    
+    def __init__(self, argv):
+        
+        # set default
+        self.set_default()
+        
+        # handle options with getopt
+        try:
+            opts, args = getopt.getopt(argv[1:], "", ['rigs=', 'rounds=',
+                                                     'interval=', 'mode=',
+                                                     'help'])
+        except getopt.GetoptError as e:
+            sys.stderr.write(str(e) + '\n\n' + __doc__)
+            sys.exit(1)
+        
+        for o, a in opts:
+            if o == '--rigs':
+                self['rigs'] = int(a)
+            elif o == '--rounds':
+                self['rounds'] = int(a)
+            elif o == '--interval':
+                self['interval'] = float(a)
+            elif o == '--mode':
+                if a not in MODES:
+                    sys.stderr.write("Error: invalid mode definition: {}"
+                                     "\n\n".format(a) + __doc__)
+                    sys.exit(1)
+                self['mode'] = a
+            elif o == '--help':
+                sys.stdout.write(__doc__)
+                sys.exit(0)
+        
+        self.args = args
+    
+    def set_default(self):
+        
+        # default parameter value
+        self['rigs'] = 4
+        self['rounds'] = 50
+        self['interval'] = 0.05
+        self['mode'] = None
+
+def run(mode, rigs, rounds, interval):
+    '''
+    Plays the rounds in the given mode and writes the number of threads
+    running, the peak resident memory and the lateness of the on() calls.
+    '''
+    
+    server = load("2ac_gpioserver")
+    stats = server.Stats()
+    scheduler = server.Scheduler(stats=stats)
+    controllers = []
+    for i in range(5 * rigs):
+        controller = server.MockController()
+        controller.stats = stats
+        if mode == "scheduler":
+            controller.attach(scheduler)
+        controllers.append(controller)
+    if mode == "scheduler":
+        scheduler.start()
+    for controller in controllers:
+        controller.start()
+    
+    for i in range(rounds):
+        for controller in controllers:
+            controller.play(interval / 2)
+        time.sleep(interval)
+    threads = threading.active_count()
+    
+    for controller in controllers:
+        controller.end()
+    if mode == "scheduler":
+        scheduler.end()
+    h = stats.histograms["on"]
+    sys.stdout.write("{:<10}{:>8d}{:>10.1f}{:>8d}{:>10.3f}{:>10.3f}{:>10.3f}"
+                     "{:>10.3f}\n".format(mode, threads,
+                     resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                     h.n, 1000 * h.total / h.n, 1000 * h.quantile(0.5),
+                     1000 * h.quantile(0.99), 1000 * h.max))
+    sys.stdout.flush()
+
+def main(argv=sys.argv):
+    
+    options = Options(argv)
+    if options['mode'] is not None:
+        run(options['mode'], options['rigs'], options['rounds'],
+            options['interval'])
+        return 0
+    
+    sys.stdout.write("{:<10}{:>8}{:>10}{:>8}{:>10}{:>10}{:>10}{:>10}\n".format(
+                     "mode", "threads", "rss(MB)", "n", "mean(ms)", "p50",
+                     "p99", "max"))
+    sys.stdout.flush()
+    for mode in MODES:
+        subprocess.run([sys.executable, path.abspath(__file__),
+                        "--mode=" + mode, "--rigs={:d}".format(options['rigs']),
+                        "--rounds={:d}".format(options['rounds']),
+                        "--interval={!r}".format(options['interval'])])
+    return 0
+
+# does not execute main if the script is imported as a module
+if __name__ == '__main__': sys.exit(main())
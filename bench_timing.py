@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+'''
+USAGE
+    bench_timing.py [OPTION]
+
+DESCRIPTION
+    Measure the timing error of the on phases played by each type of
+    controller of 2ac_gpioserver.py: trains of schedules are queued at
+    once, and the time of each on() call is compared with its intended
+    onset, the end of the previous schedule plus the offset. Compares
+    the former player, chaining time.sleep() calls, with the player
+    waiting for absolute deadlines. The LEDs and the dispenser use
+    gpiozero's mock pins, the sounds SDL's dummy audio driver unless
+    SDL_AUDIODRIVER is set.
+
+OPTIONS
+    --trains=N
+        Number of trains played by each controller (default 5)
+    
+    --schedules=N
+        Number of schedules of a train (default 20)
+    
+    --timing=DURATION:OFFSET:REST
+        Durations of the on phase, of the delay before it and of the rest
+        after it, in seconds (default 0.02:0.01:0.01)
+    
+    --help
+        Display this message
+
+'''
+
+import getopt, sys, time
+from os import environ
+from threading import Thread
+from loader import load
+
+class Options(dict):
+    
+    def __init__(self, argv):
+        
+        # set default
+        self.set_default()
+        
+        # handle options with getopt
+        try:
+            opts, args = getopt.getopt(argv[1:], "", ['trains=', 'schedules=',
+                                                     'timing=', 'help'])
+        except getopt.GetoptError as e:
+            sys.stderr.write(str(e) + '\n\n' + __doc__)
+            sys.exit(1)
+        
+        for o, a in opts:
+            if o == '--trains':
+                self['trains'] = int(a)
+            elif o == '--schedules':
+                self['schedules'] = int(a)
+            elif o == '--timing':
+                try:
+                    self['timing'] = tuple( float(x) for x in a.split(":") )
+                    if len(self['timing']) != 3:
+                        raise ValueError
+                except ValueError:
+                    sys.stderr.write("Error: invalid timing definition: {}"
+                                     "\n\n".format(a) + __doc__)
+                    sys.exit(1)
+            elif o == '--help':
+                sys.stdout.write(__doc__)
+                sys.exit(0)
+        
+        self.args = args
+    
+    def set_default(self):
+        
+        # default parameter value
+        self['trains'] = 5
+        self['schedules'] = 20
+        self['timing'] = (0.02, 0.01, 0.01)
+
+def sleeping_player(controller):
+    '''
+    The former Controller.player, blocking on its queue but timing the
+    schedules with chained sleeps.
+    '''
+    
+    while controller.running():
+        schedule = controller.Q.get()
+        if schedule is None:
+            break
+        duration, offset, rest = schedule
+        time.sleep(offset)
+        controller.on()
+        time.sleep(duration)
+        controller.off()
+        time.sleep(rest)
+
+def controllers(server):
+    '''
+    Returns the name of each type of controller with a function making
+    one.
+    '''
+    
+    gpiozero, pygame = server.gpiozero, server.pygame
+    sound = pygame.sndarray.make_sound(
+        server.sinetone_samples(440, 0.02, 1, 0.005, 0.005))
+    pins = iter(range(2, 28))
+    return (("mock", server.MockController),
+            ("led", lambda: server.LEDPlayer(gpiozero.LED(next(pins)))),
+            ("sound", lambda: server.SoundPlayer(sound, 0)),
+            ("dispenser", lambda: server.DispenserPlayer(
+                gpiozero.DigitalOutputDevice(next(pins)), on_time=0.005,
+                off_time=0.005)))
+
+def measure(controller, sleeping, trains, schedules, timing):
+    '''
+    Plays the trains with the former player if sleeping is True, and
+    returns the error of each onset, in seconds.
+    '''
+    
+    duration, offset, rest = timing
+    if sleeping:
+        controller.t = Thread(target=sleeping_player, args=(controller,))
+    onsets, on = [], controller.on
+    def record():
+        onsets.append(time.perf_counter())
+        return on()
+    controller.on = record
+    controller.start()
+    
+    errors = []
+    for i in range(trains):
+        del onsets[:]
+        t0 = time.perf_counter()
+        for j in range(schedules):
+            if sleeping:
+                controller.Q.put((duration, offset, rest))
+            else:
+                controller.play(duration, offset, rest)
+        time.sleep(schedules * (duration + offset + rest) + 0.2)
+        errors.extend( t - (t0 + j * (duration + offset + rest) + offset)
+                       for j, t in enumerate(onsets) )
+    if sleeping:
+        controller.stop.set()
+        controller.Q.put(None)
+        controller.t.join()
+    else:
+        controller.end()
+    return errors
+
+def write_errors(device, method, errors):
+    n = len(errors)
+    if not n:
+        return
+    spread = sorted( abs(e) for e in errors )
+    sys.stdout.write("{:<10}{:<10}{:>6d}{:>10.3f}{:>10.3f}{:>10.3f}{:>10.3f}"
+                     "\n".format(device, method, n, 1000 * sum(errors) / n,
+                     1000 * spread[n // 2],
+                     1000 * spread[min(n - 1, n * 95 // 100)],
+                     1000 * spread[-1]))
+
+def main(argv=sys.argv):
+    
+    options = Options(argv)
+    environ.setdefault("SDL_AUDIODRIVER", "dummy")
+    server = load("2ac_gpioserver")
+    from gpiozero.pins.mock import MockFactory
+    server.gpiozero.Device.pin_factory = MockFactory()
+    server.pygame.mixer.init(44100, -16, 1, 1024)
+    
+    sys.stdout.write("{:<10}{:<10}{:>6}{:>10}{:>10}{:>10}{:>10}\n".format(
+                     "device", "method", "n", "mean(ms)", "|p50|", "|p95|",
+                     "|max|"))
+    for device, make in controllers(server):
+        for method, sleeping in (("sleep", True), ("deadline", False)):
+            errors = measure(make(), sleeping, options['trains'],
+                             options['schedules'], options['timing'])
+            write_errors(device, method, errors)
+    server.pygame.mixer.quit()
+    return 0
+
+# does not execute main if the script is imported as a module
+if __name__ == '__main__': sys.exit(main())
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+
+'''
+USAGE
+    check_mock_devices.py [OPTION]
+
+DESCRIPTION
+    Check the output devices of 2ac_gpioserver.py on gpiozero's mock PWM
+    pins, without a Raspberry Pi: the states taken by the pins during a
+    schedule are compared with those expected from the LEDPlayer's
+    waveforms and the DispenserPlayer's pulses, and the deliveries 
+    confirmed or missed by the dispenser are counted while its sensor's
+    pin is driven. Writes the failed checks and returns 1 if any.
+
+OPTIONS
+    --verbose
+        Write the states taken by the pins
+    
+    --help
+        Display this message
+
+'''
+
+import getopt, sys, time
+from loader import load
+
+# tolerance on the times of the pins' states, in seconds, and the time
+# between two brightness steps of gpiozero's fades (25 per second)
+TOLERANCE = 0.03
+FRAME = 0.04
+
+class Options(dict):
+    
+    def __init__(self, argv):
+        
+        # set default
+        self.set_default()
+        
+        # handle options with getopt
+        try:
+            opts, args = getopt.getopt(argv[1:], "", ['verbose', 'help'])
+        except getopt.GetoptError as e:
+            sys.stderr.write(str(e) + '\n\n' + __doc__)
+            sys.exit(1)
+        
+        for o, a in opts:
+            if o == '--verbose':
+                self['verbose'] = True
+            elif o == '--help':
+                sys.stdout.write(__doc__)
+                sys.exit(0)
+        
+        self.args = args
+    
+    def set_default(self):
+        
+        # default parameter value
+        self['verbose'] = False
+
+def timeline(pin):
+    '''
+    Returns the states taken by a mock pin since its states were cleared,
+    as (time, value) tuples, the time counted from the clearing.
+    '''
+    
+    t, states = 0., []
+    for state in pin.states:
+        t += state.timestamp
+        states.append((t, state.state))
+    return states
+
+def play(controller, duration):
+    '''
+    Plays a schedule from the controller's thread and returns the states
+    taken by its pin.
+    '''
+    
+    pin = controller.LED.pin
+    controller.start()
+    pin.clear_states()
+    controller.play(duration)
+    time.sleep(duration + 0.1)
+    controller.end()
+    return timeline(pin)
+
+def dispense(controller, duration, confirm=None):
+    '''
+    Plays a schedule on a dispenser, driving its sensor's pin high confirm
+    seconds after the request if given, and returns the states taken by 
+    its output's pin.
+    '''
+    
+    pin = controller.output.pin
+    controller.start()
+    pin.clear_states()
+    controller.play(duration)
+    if confirm is not None:
+        time.sleep(confirm)
+        controller.sensor.pin.drive_high()
+        controller.sensor.pin.drive_low()
+    time.sleep(duration + 0.1 - (confirm or 0.))
+    controller.end()
+    return timeline(pin)
+
+def check_steady(server, duration):
+    states = play(server.LEDPlayer(server.gpiozero.LED(2)), duration)
+    if [ v for t, v in states ] != [0, 1, 0]:
+        return states, "expected off, on, off"
+    if abs(states[2][0] - states[1][0] - duration) > TOLERANCE:
+        return states, "on for {:.3f}s instead of {:.3f}s".format(
+               states[2][0] - states[1][0], duration)
+    return states, None
+
+def check_blink(server, duration):
+    on_time, off_time = 0.02, 0.03
+    states = play(server.LEDPlayer(server.gpiozero.LED(3),
+                  ("blink", on_time, off_time)), duration)
+    onsets = [ t for t, v in states if v == 1 ]
+    expected = int(round(duration / (on_time + off_time)))
+    if abs(len(onsets) - expected) > 1:
+        return states, "{:d} flashes instead of {:d}".format(len(onsets),
+                                                              expected)
+    periods = [ b - a for a, b in zip(onsets, onsets[1:]) ]
+    if any( abs(p - on_time - off_time) > TOLERANCE for p in periods ):
+        return states, "flashes not every {:.3f}s".format(on_time + off_time)
+    if states[-1][1] != 0:
+        return states, "left on"
+    return states, None
+
+def check_level(server, duration):
+    states = play(server.LEDPlayer(server.gpiozero.PWMLED(4),
+                  ("level", 0.3)), duration)
+    if [ v for t, v in states ] != [0, 0.3, 0]:
+        return states, "expected off, 0.3, off"
+    return states, None
+
+def check_ramp(server, duration):
+    fade_in = duration / 2
+    states = play(server.LEDPlayer(server.gpiozero.PWMLED(5),
+                  ("ramp", fade_in)), duration)
+    values = [ v for t, v in states[:-1] ]
+    if any( b < a for a, b in zip(values, values[1:]) ):
+        return states, "not increasing during the on phase"
+    full = [ t for t, v in states if v == 1 ]
+    if not full or abs(full[0] - fade_in) > FRAME + TOLERANCE:
+        return states, "not fully on after {:.3f}s".format(fade_in)
+    if states[-1][1] != 0:
+        return states, "left on"
+    return states, None
+
+def check_pulse(server, duration):
+    states = play(server.LEDPlayer(server.gpiozero.PWMLED(6),
+                  ("pulse", duration / 4, duration / 4)), duration)
+    values = [ v for t, v in states[1:-1] ]
+    if not any( 0 < v < 1 for v in values ):
+        return states, "no intermediate brightness"
+    steps = [ b - a for a, b in zip(values, values[1:]) ]
+    if not any( s > 0 for s in steps ) or not any( s < 0 for s in steps ):
+        return states, "not fading in and out"
+    if states[-1][1] != 0:
+        return states, "left on"
+    return states, None
+
+def check_fallback(server, duration):
+    
+    # a PWM waveform on a LED without PWM turns it on
+    states = play(server.LEDPlayer(server.gpiozero.LED(7),
+                  ("pulse", duration / 6, duration / 6)), duration)
+    if [ v for t, v in states ] != [0, 1, 0]:
+        return states, "expected off, on, off"
+    return states, None
+
+def check_pulses(server, duration):
+    pulses, on_time, off_time = 3, 0.02, 0.03
+    states = dispense(server.DispenserPlayer(
+                      server.gpiozero.DigitalOutputDevice(8), pulses=pulses,
+                      on_time=on_time, off_time=off_time), duration)
+    onsets = [ t for t, v in states if v == 1 ]
+    if len(onsets) != pulses:
+        return states, "{:d} pulses instead of {:d}".format(len(onsets), 
+                                                             pulses)
+    periods = [ b - a for a, b in zip(onsets, onsets[1:]) ]
+    if any( abs(p - on_time - off_time) > TOLERANCE for p in periods ):
+        return states, "pulses not every {:.3f}s".format(on_time + off_time)
+    if states[-1][1] != 0:
+        return states, "left on"
+    return states, None
+
+def check_delivered(server, duration):
+    gpiozero = server.gpiozero
+    dispenser = server.DispenserPlayer(gpiozero.DigitalOutputDevice(9), 
+                                       gpiozero.DigitalInputDevice(10))
+    states = dispense(dispenser, duration, duration / 2)
+    if (dispenser.delivered, dispenser.missed) != (1, 0):
+        return states, "{:d} delivered and {:d} missed instead of 1 and " \
+                       "0".format(dispenser.delivered, dispenser.missed)
+    if abs(dispenser.latency_max - duration / 2) > TOLERANCE:
+        return states, "dispense latency of {:.3f}s instead of {:.3f}s" \
+                       "".format(dispenser.latency_max, duration / 2)
+    return states, None
+
+def check_missed(server, duration):
+    gpiozero = server.gpiozero
+    dispenser = server.DispenserPlayer(gpiozero.DigitalOutputDevice(11), 
+                                       gpiozero.DigitalInputDevice(12))
+    
+    # an activation before the request does not confirm the delivery
+    dispenser.sensor.pin.drive_high()
+    dispenser.sensor.pin.drive_low()
+    states = dispense(dispenser, duration)
+    if (dispenser.delivered, dispenser.missed) != (0, 1):
+        return states, "{:d} delivered and {:d} missed instead of 0 and " \
+                       "1".format(dispenser.delivered, dispenser.missed)
+    return states, None
+
+def main(argv=sys.argv):
+    
+    options = Options(argv)
+    server = load("2ac_gpioserver")
+    from gpiozero.pins.mock import MockFactory, MockPWMPin
+    server.gpiozero.Device.pin_factory = MockFactory(pin_class=MockPWMPin)
+    
+    failed = 0
+    for name, check, duration in (("steady", check_steady, 0.1),
+                                  ("blink", check_blink, 0.25),
+                                  ("level", check_level, 0.1),
+                                  ("ramp", check_ramp, 0.3),
+                                  ("pulse", check_pulse, 0.8),
+                                  ("fallback", check_fallback, 0.1),
+                                  ("pulses", check_pulses, 0.2),
+                                  ("delivered", check_delivered, 0.2),
+                                  ("missed", check_missed, 0.2)):
+        states, error = check(server, duration)
+        if options['verbose']:
+            sys.stderr.write("{}\t{}\n".format(name, " ".join(
+                             "{:.3f}:{:g}".format(t, v) for t, v in states)))
+        if error is None:
+            sys.stderr.write("[i] {}: ok\n".format(name))
+        else:
+            sys.stderr.write("Error: {}: {}\n".format(name, error))
+            failed += 1
+    return 1 if failed else 0
+
+# does not execute main if the script is imported as a module
+if __name__ == '__main__': sys.exit(main())
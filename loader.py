@@ -0,0 +1,22 @@
+'''
+Imports the repository's scripts, whose names are not valid module names,
+for the benchmark and check scripts.
+'''
+
+import importlib.util
+from os import path
+
+# the directory of the repository's scripts
+HERE = path.dirname(path.abspath(__file__))
+
+def load(name):
+    '''
+    Import the script name.py of the repository, e.g. 
+    load("2ac_gpioserver"), as a module.
+    '''
+    
+    spec = importlib.util.spec_from_file_location(name.replace("2ac_", "ac_"),
+                                                  path.join(HERE, name + ".py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module